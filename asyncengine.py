@@ -0,0 +1,67 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import clock
+
+# Threads used to run blocking Reddit and database calls for the asyncio runtime. Every stream and periodic loop has at
+# most one call in flight so this only needs to be large enough for the loops to overlap their waits.
+ASYNC_IO_THREADS = 8
+
+# Sentinel returned by nextItem when a stream generator is exhausted
+STREAM_END = object()
+
+
+def nextItem(stream):
+    return next(stream, STREAM_END)
+
+
+# Pulls items from a (blocking) PRAW style stream and hands each one to handler. Both run off the event loop so other
+# loops keep going while this one waits on Reddit. The stream is restarted if it raises or ends.
+async def streamLoop(name: str, streamFactory, handler, logger: logging.Logger):
+    while True:
+        logger.debug("Starting %s stream.", name)
+        try:
+            stream = await asyncio.to_thread(streamFactory)
+            while True:
+                item = await asyncio.to_thread(nextItem, stream)
+                if item is STREAM_END:
+                    break
+                await asyncio.to_thread(handler, item)
+        except Exception as e:
+            logger.error(f"Unable to handle an item in the {name} stream. Restarting {name} stream.")
+            logger.error("Printing stack trace...")
+            logger.error(e)
+
+
+# Runs setup once then function every interval seconds, off the event loop
+async def periodicLoop(name: str, function, interval: float, setup, logger: logging.Logger):
+    if setup is not None:
+        try:
+            await asyncio.to_thread(setup)
+        except Exception as e:
+            logger.warning(f"The {name} loop setup raised an exception. It will try to continue.")
+            logger.warning(e)
+
+    while True:
+        try:
+            await asyncio.to_thread(function)
+        except Exception as e:
+            logger.warning(f"The {name} loop raised an exception. It will try to continue.")
+            logger.warning("Printing stack trace...")
+            logger.warning(e)
+        await asyncio.sleep(clock.timeout(interval))
+
+
+async def runLoops(streams: list, periodic: list, logger: logging.Logger):
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=ASYNC_IO_THREADS,
+                                                                       thread_name_prefix="asyncio-io"))
+
+    tasks = [streamLoop(name, streamFactory, handler, logger) for name, streamFactory, handler in streams]
+    tasks += [periodicLoop(name, function, interval, setup, logger) for name, function, interval, setup in periodic]
+    await asyncio.gather(*tasks)
+
+
+# streams: list of (name, streamFactory, handler). periodic: list of (name, function, interval, setup or None)
+def run(streams: list, periodic: list, logger: logging.Logger):
+    asyncio.run(runLoops(streams, periodic, logger))
@@ -0,0 +1,710 @@
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import types
+
+import sql  # sql has to be imported before main (sql imports main for its configuration)
+import main
+from dbwriter import DBWriter
+from editcoalescer import EditCoalescer
+from fakereddit import FakeReddit
+from postcache import PostCache
+from ratelimit import APIBudget, PRIORITY_REMOVAL, PRIORITY_REPLY, PRIORITY_EDIT, PRIORITY_MODMAIL
+from seenfilter import SeenFilter, SEEN_FILTER_CAPACITY
+from shardpool import ShardPool
+
+# Benchmarks for the database paths the bot loops depend on. Every benchmark runs against a fresh temporary DB.
+# Usage: python benchmark.py [name ...]  (runs every benchmark when no name is given)
+#        python benchmark.py suite [results.json]  (times the sql.py hot functions and rendering, saves the results)
+#        python benchmark.py compare baseline.json results.json  (exits with status 1 if anything got slower)
+
+# Posts that votes are spread across
+BENCHMARK_POSTS = 50
+
+
+def temporaryDatabase() -> str:
+    sql.DB_FILE = tempfile.mktemp(suffix=".dat")
+    sql.createTables()
+    return sql.DB_FILE
+
+
+def removeDatabase(file: str):
+    for suffix in ["", "-wal", "-shm", "-journal"]:
+        if os.path.exists(file + suffix):
+            os.remove(file + suffix)
+
+
+def fakeSubmission(postID: str, createdUTC: float):
+    return types.SimpleNamespace(id=postID, created_utc=createdUTC,
+                                 subreddit=types.SimpleNamespace(display_name=main.SUBREDDIT))
+
+
+def seedPosts(connection, count: int, createdUTC: float = None) -> list:
+    if createdUTC is None:
+        createdUTC = time.time()
+    postIDList = [f"p{i}" for i in range(count)]
+    for postID in postIDList:
+        reply = types.SimpleNamespace(id="r" + postID)
+        sql.insertSubmissionIntoDB(connection, fakeSubmission(postID, createdUTC), reply, main.VOTING_OPTIONS, True)
+    return postIDList
+
+
+# Fills the posts, votes and messages tables with rows directly, much faster than one insertSubmissionIntoDB per row
+def seedPostsBulk(connection, count: int, createdUTC: float = None, prefix: str = "b") -> list:
+    if createdUTC is None:
+        createdUTC = time.time()
+    postIDList = [f"{prefix}{i}" for i in range(count)]
+    encodedVoteOptions = sql.encodeVotingOptions(main.VOTING_OPTIONS)
+    encodedVotes = sql.encodeVotes([0] * len(main.VOTING_OPTIONS))
+    votingTime = createdUTC + main.VOTE_ACTION_DELAY
+    reviewTime = createdUTC + main.PASS_DELAY + sql.ADDITIONAL_PASS_DELAY
+
+    cursor = connection.cursor()
+    cursor.executemany(f"INSERT INTO {sql.TABLE_NAME} (PostID, ReviewTime, VotingTime, PostTime, ReplyID, "
+                       f"VotingOptions, Votes, Voters, IsVoteable, ReviewState) VALUES (?,?,?,?,?,?,?,?,?,?)",
+                       [(postID, reviewTime, votingTime, createdUTC, "r" + postID, encodedVoteOptions, encodedVotes,
+                         "", 1, i % 3) for i, postID in enumerate(postIDList)])
+    cursor.executemany(f"INSERT INTO {sql.VOTES_TABLE_NAME} (PostID, Voter, Option) VALUES (?,?,?)",
+                       [(postID, f"voter{i}", main.VOTING_OPTIONS[0]) for postID in postIDList for i in range(3)])
+    cursor.executemany(f"INSERT INTO {sql.MESSAGE_TABLE_NAME} (MessageID, Subject, Body, Sender, IsUserMessage, "
+                       f"MessageTime) VALUES (?,?,?,?,?,?)",
+                       [(f"{prefix}m{i}", "Subject", "Body", "user", 1, createdUTC) for i in range(count // 100)])
+    connection.commit()
+    return postIDList
+
+
+def report(name: str, operations: int, seconds: float):
+    print(f"{name:<40} {operations / seconds:>12.1f} ops/s  ({operations} ops in {seconds:.3f}s)")
+
+
+# The DB calls commentStream makes for every vote, straight to sql.py and through the PostCache
+def benchmarkVoteCache(votes: int = 2000):
+    file = temporaryDatabase()
+    connection = sql.createDBConnection(file)
+    postIDList = seedPosts(connection, BENCHMARK_POSTS)
+    option = main.VOTING_OPTIONS[0]
+
+    start = time.perf_counter()
+    for i in range(votes):
+        postID = postIDList[i % BENCHMARK_POSTS]
+        voter = f"uncached{i}"
+        sql.isVoteable(connection, postID)
+        if sql.hasVoted(connection, postID, voter):
+            continue
+        sql.castVote(connection, postID, voter, option)
+        sql.fetchVotes(connection, postID)
+    report("votes/sec without cache", votes, time.perf_counter() - start)
+
+    cache = PostCache()
+    start = time.perf_counter()
+    for i in range(votes):
+        postID = postIDList[i % BENCHMARK_POSTS]
+        voter = f"cached{i}"
+        cache.isVoteable(connection, postID)
+        if cache.hasVoted(connection, postID, voter):
+            continue
+        cache.castVote(connection, postID, voter, option)
+        cache.fetchVotes(connection, postID)
+    report("votes/sec with cache", votes, time.perf_counter() - start)
+
+    connection.close()
+    removeDatabase(file)
+
+
+# Counts the lookup API calls (fetching a comment or a submission) commentStream makes per 1,000 comments using
+# fakereddit. The old pre-filter fetched the parent of every reply to check its author and then the submission of every
+# reply to the bot to check its age. Those calls are counted from the same traffic.
+def benchmarkReplyIndex(comments: int = 1000):
+    file = temporaryDatabase()
+    connection = sql.createDBConnection(file)
+    fake = FakeReddit(main.BOT_USERNAME)
+    main.reddit = fake
+    main.tenants = main.createTenants()
+    main.apiBudget = APIBudget(main.mainLogger)
+    main.postCache = PostCache()
+    main.voteTableEditor = EditCoalescer(fake, main.renderVotingTable, main.VOTE_TABLE_EDIT_INTERVAL, main.mainLogger)
+    main.commentShards = None
+
+    botReplies = []
+    for i in range(BENCHMARK_POSTS):
+        submission = fake.postSubmission(main.SUBREDDIT, f"poster{i}", f"Build {i}")
+        reply = submission.reply(main.STANDARD_REPLY + main.VOTING_TEXT)
+        sql.insertSubmissionIntoDB(connection, submission, reply, main.VOTING_OPTIONS, True)
+        main.postCache.record(connection, submission.id)
+        botReplies.append(reply)
+
+    # 25% top level comments, 70% replies to other users and 5% votes
+    generator = random.Random(1)
+    userComments = [fake.postComment(reply.submission, reply.submission.name, "someone", "First")
+                    for reply in botReplies]
+    traffic = []
+    for i in range(comments):
+        roll = generator.random()
+        if roll < 0.25:
+            submission = generator.choice(botReplies).submission
+            traffic.append(fake.postComment(submission, submission.name, f"user{i}", "Nice build"))
+        elif roll < 0.95:
+            parent = generator.choice(userComments)
+            traffic.append(fake.postComment(parent.submission, parent.name, f"user{i}", "I agree"))
+        else:
+            parent = generator.choice(botReplies)
+            traffic.append(fake.postComment(parent.submission, parent.name, f"user{i}", "!yes"))
+
+    fake.calls.clear()
+    oldCalls = 0
+    start = time.perf_counter()
+    for comment in traffic:
+        if not comment.parent_id.startswith("t3_"):
+            oldCalls = oldCalls + 1
+            if comment.parent_id in [reply.name for reply in botReplies]:
+                oldCalls = oldCalls + 1
+        main.handleComment(comment, connection, main.mainLogger)
+    report("comments/sec through the pre-filter", comments, time.perf_counter() - start)
+
+    newCalls = fake.calls["comment"] + fake.calls["submission"]
+    scale = 1000 / comments
+    print(f"lookup API calls per 1,000 comments: before {oldCalls * scale:.0f}, after {newCalls * scale:.0f}, "
+          f"saved {(oldCalls - newCalls) * scale:.0f}")
+
+    connection.close()
+    removeDatabase(file)
+
+
+# Vote comments per second through handleComment, counting the votes on the stream's thread (0 shards) and then on
+# shard threads keyed by submission ID. Every call to the fake Reddit takes apiLatency seconds and one in slowEvery
+# takes slowLatency, like the occasional slow comment.mod.remove that holds up every vote queued behind it.
+def benchmarkCommentShards(votes: int = 2000, apiLatency: float = 0.002, slowEvery: int = 100,
+                           slowLatency: float = 0.1):
+    for shards in [0, 1, 2, 4, 8]:
+        file = temporaryDatabase()
+        connection = sql.threadConnection()
+        fake = FakeReddit(main.BOT_USERNAME)
+        main.reddit = fake
+        main.tenants = main.createTenants()
+        main.apiBudget = APIBudget(main.mainLogger)
+        main.dbWriter = DBWriter(main.mainLogger)
+        main.dbWriter.start()
+        main.postCache = PostCache(main.dbWriter)
+        main.voteTableEditor = EditCoalescer(fake, main.renderVotingTable, main.VOTE_TABLE_EDIT_INTERVAL,
+                                             main.mainLogger)
+
+        botReplies = []
+        for i in range(BENCHMARK_POSTS):
+            submission = fake.postSubmission(main.SUBREDDIT, f"poster{i}", f"Build {i}")
+            reply = submission.reply(main.STANDARD_REPLY + main.VOTING_TEXT)
+            sql.insertSubmissionIntoDB(connection, submission, reply, main.VOTING_OPTIONS, True)
+            main.postCache.record(connection, submission.id)
+            botReplies.append(reply)
+        traffic = [fake.postComment(botReplies[i % BENCHMARK_POSTS].submission, botReplies[i % BENCHMARK_POSTS].name,
+                                    f"voter{i}", "!yes") for i in range(votes)]
+
+        # Only the calls made while counting votes are slowed down
+        calls = itertools.count(1)
+
+        def slowCall(endpoint: str, fake=fake):
+            FakeReddit.countCall(fake, endpoint)
+            time.sleep(slowLatency if next(calls) % slowEvery == 0 else apiLatency)
+
+        fake.countCall = slowCall
+        main.commentShards = None
+        if shards > 0:
+            main.commentShards = ShardPool(shards, main.COMMENT_SHARD_QUEUE_SIZE,
+                                           lambda comment, record: main.handleVote(comment, record,
+                                                                                   sql.threadConnection(),
+                                                                                   main.mainLogger),
+                                           main.mainLogger, "votes")
+            main.commentShards.start()
+
+        start = time.perf_counter()
+        for comment in traffic:
+            main.handleComment(comment, connection, main.mainLogger)
+        if main.commentShards is not None:
+            main.commentShards.join()
+        report(f"votes/sec with {shards} shards", votes, time.perf_counter() - start)
+
+        counted = sum(sum(main.postCache.fetchVotes(connection, reply.submission.id).values()) for reply in botReplies)
+        print(f"    {counted} of {votes} votes counted" +
+              ("" if main.commentShards is None else f", {main.commentShards.stats()}"))
+
+        sql.closeThreadConnections()
+        removeDatabase(file)
+
+
+# Deletes 100k expired posts (with 300k votes and 1k messages) in bulk. The old one row at a time removal is timed on a
+# sample of the same rows for comparison.
+def benchmarkExpiry(rows: int = 100000, sample: int = 1000):
+    file = temporaryDatabase()
+    connection = sql.createDBConnection(file)
+    expired = time.time() - 2 * sql.REMOVE_AGE
+
+    postIDList = seedPostsBulk(connection, sample, expired, "sample")
+    start = time.perf_counter()
+    for postID in postIDList:
+        sql.removePostByIDFromDB(connection, postID)
+    report("expired rows/sec one at a time", sample, time.perf_counter() - start)
+
+    seedPostsBulk(connection, rows, expired)
+    sizeBefore = os.path.getsize(file)
+    start = time.perf_counter()
+    sql.removeExpiredPostsFromDB(connection)
+    report("expired rows/sec in bulk", rows, time.perf_counter() - start)
+    print(f"database file: {sizeBefore / 1e6:.1f} MB before, {os.path.getsize(file) / 1e6:.1f} MB after")
+
+    connection.close()
+    removeDatabase(file)
+
+
+def percentile(samples: list, fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+# Latency of the per-vote query sequence (isVoteable, hasVoted, castVote, fetchVotes) on a connection with SQLite's
+# defaults and a commit after every statement like the helpers used to do, against sql.threadConnection
+def benchmarkConnection(votes: int = 2000):
+    option = main.VOTING_OPTIONS[0]
+
+    def run(name: str, connection, commitEveryStatement: bool):
+        postIDList = seedPosts(connection, BENCHMARK_POSTS)
+        latencies = []
+        for i in range(votes):
+            postID = postIDList[i % BENCHMARK_POSTS]
+            start = time.perf_counter()
+            for call in [lambda: sql.isVoteable(connection, postID),
+                         lambda: sql.hasVoted(connection, postID, f"voter{i}"),
+                         lambda: sql.castVote(connection, postID, f"voter{i}", option),
+                         lambda: sql.fetchVotes(connection, postID)]:
+                call()
+                if commitEveryStatement:
+                    connection.commit()
+            latencies.append(time.perf_counter() - start)
+        print(f"{name:<40} mean {sum(latencies) / votes * 1e6:8.0f} us  p50 {percentile(latencies, 0.5) * 1e6:8.0f} us"
+              f"  p99 {percentile(latencies, 0.99) * 1e6:8.0f} us")
+
+    file = temporaryDatabase()
+    defaultConnection = sqlite3.connect(file)
+    defaultConnection.execute("PRAGMA journal_mode = DELETE;").fetchall()
+    run("per-vote sequence, default connection", defaultConnection, True)
+    defaultConnection.close()
+    removeDatabase(file)
+
+    file = temporaryDatabase()
+    run("per-vote sequence, threadConnection", sql.threadConnection(), False)
+    sql.closeThreadConnections()
+    removeDatabase(file)
+
+
+# Vote writes from several threads at once, each thread writing through its own connection against every thread
+# submitting to one DBWriter
+def benchmarkWriter(threads: int = 8, votesPerThread: int = 500):
+    option = main.VOTING_OPTIONS[0]
+
+    def run(name: str, castVote):
+        postIDList = seedPosts(sql.threadConnection(), BENCHMARK_POSTS)
+
+        def voter(thread: int):
+            for i in range(votesPerThread):
+                castVote(postIDList[i % BENCHMARK_POSTS], f"{name}-{thread}-{i}")
+            sql.closeThreadConnections()
+
+        workers = [threading.Thread(target=voter, args=[thread]) for thread in range(threads)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        report(f"concurrent vote writes/sec, {name}", threads * votesPerThread, time.perf_counter() - start)
+
+    file = temporaryDatabase()
+    run("direct", lambda postID, voter: sql.castVote(sql.threadConnection(), postID, voter, option))
+    sql.closeThreadConnections()
+    removeDatabase(file)
+
+    file = temporaryDatabase()
+    writer = DBWriter(main.mainLogger)
+    writer.start()
+    run("DBWriter", lambda postID, voter: writer.write(sql.castVote, postID, voter, option))
+    print(f"DBWriter committed {writer.operations} operations in {writer.batches} transactions")
+    sql.closeThreadConnections()
+    removeDatabase(file)
+
+
+# Threads of every priority class hammering a FakeReddit with a small rate limit window, first calling it directly and
+# then through one APIBudget shared by two clients. Reports calls over the limit (429s on Reddit) and the mean wait of
+# each priority class.
+def benchmarkRateLimit(threadsPerPriority: int = 2, callsPerThread: int = 30, windowRequests: int = 40,
+                       window: float = 2):
+    names = {PRIORITY_REMOVAL: "removal", PRIORITY_REPLY: "reply", PRIORITY_EDIT: "edit", PRIORITY_MODMAIL: "modmail"}
+
+    def run(label: str, budget):
+        botReddit = FakeReddit(main.BOT_USERNAME, windowRequests, window)
+        notifierBotReddit = FakeReddit("notifier", windowRequests, window)
+        clients = [botReddit, notifierBotReddit]
+        if budget is not None:
+            for client in clients:
+                budget.register(client)
+        waits = {priority: [] for priority in names}
+
+        def caller(priority: int, client):
+            for i in range(callsPerThread):
+                start = time.perf_counter()
+                if budget is None:
+                    client.countCall("benchmark")
+                else:
+                    budget.call(priority, client.countCall, "benchmark")
+                waits[priority].append(time.perf_counter() - start)
+
+        # Both clients count against the same allowance on Reddit, so both fakes see every call
+        def sharedCall(endpoint: str):
+            for client in clients:
+                FakeReddit.countCall(client, endpoint)
+
+        for client in clients:
+            client.countCall = sharedCall
+        workers = [threading.Thread(target=caller, args=[priority, clients[priority % 2]])
+                   for priority in names for thread in range(threadsPerPriority)]
+        start = time.perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        seconds = time.perf_counter() - start
+
+        print(f"{label}: {len(workers) * callsPerThread} calls in {seconds:.1f}s, "
+              f"{botReddit.overLimit} over the limit of {windowRequests} per {window}s")
+        print("    mean wait " + ", ".join(f"{names[priority]} {sum(samples) / len(samples) * 1000:.0f}ms"
+                                           for priority, samples in waits.items()))
+
+    run("direct", None)
+    run("APIBudget", APIBudget(main.mainLogger, {PRIORITY_REMOVAL: 0, PRIORITY_REPLY: 2, PRIORITY_EDIT: 5,
+                                                 PRIORITY_MODMAIL: 10}))
+
+
+# Requests needed to load a backlog of posts after downtime. Each post used to be fetched on its own (a lazy fetch the
+# first time an attribute was read) with a 5s sleep after it, now they are fetched INFO_BATCH_SIZE at a time.
+def benchmarkHydration(posts: int = 1000):
+    fake = FakeReddit(main.BOT_USERNAME)
+    main.reddit = fake
+    main.apiBudget = APIBudget(main.mainLogger)
+    postIDList = [fake.postSubmission(main.SUBREDDIT, f"poster{i}", f"Build {i}").id for i in range(posts)]
+
+    fake.calls.clear()
+    start = time.perf_counter()
+    submissions = main.hydrateSubmissions(postIDList, PRIORITY_REPLY)
+    seconds = time.perf_counter() - start
+    report("posts/sec hydrated", len(submissions), seconds)
+    print(f"requests to load {posts} posts: before {posts} (plus {posts * 5 / 60:.0f} minutes of sleeps), "
+          f"after {fake.calls['info']}")
+
+
+# Fills a seen filter to its capacity, then checks as many IDs it was never given and as many it was: every repeat has
+# to be caught and no new ID taken for a seen one. Then saves and restores it through the DB like a restart.
+def benchmarkSeenFilter(items: int = SEEN_FILTER_CAPACITY):
+    file = temporaryDatabase()
+    connection = sql.createDBConnection(file)
+    seenFilter = SeenFilter(main.SEEN_FILTER_WINDOW, capacity=2 * items)
+    start = time.perf_counter()
+    for i in range(items):
+        seenFilter.seenBefore(f"t1_{i:x}")
+    report("IDs/sec added", items, time.perf_counter() - start)
+
+    falsePositives = sum(seenFilter.seenBefore(f"t3_{i:x}") for i in range(items))
+    repeats = sum(seenFilter.seenBefore(f"t1_{i:x}") for i in range(items))
+    print(f"{repeats} of {items} repeats caught, {falsePositives} of {items} new IDs taken for seen ones")
+
+    start = time.perf_counter()
+    sql.saveSeenItems(connection, seenFilter.snapshot(), time.time() - main.SEEN_FILTER_WINDOW)
+    report("IDs/sec saved", 2 * items, time.perf_counter() - start)
+    start = time.perf_counter()
+    restored = SeenFilter(main.SEEN_FILTER_WINDOW, capacity=2 * items)
+    restored.load(sql.fetchSeenItems(connection, time.time() - main.SEEN_FILTER_WINDOW, restored.capacity))
+    report("IDs/sec restored", len(restored), time.perf_counter() - start)
+
+    connection.close()
+    removeDatabase(file)
+
+
+# The statement profile of the per-vote sequence and a bulk expiry on a large DB, with statements over 10ms written to
+# the slow query log
+def benchmarkQueryProfile(rows: int = 100000, votes: int = 2000):
+    sql.SLOW_QUERY_SECONDS = 0.01
+    sql.startQueryProfiling()
+    file = temporaryDatabase()
+    connection = sql.createDBConnection(file)
+    postIDList = seedPostsBulk(connection, rows, time.time() - 2 * sql.REMOVE_AGE)
+    postIDList = postIDList[:BENCHMARK_POSTS] + seedPosts(connection, BENCHMARK_POSTS)
+
+    for i in range(votes):
+        postID = postIDList[i % len(postIDList)]
+        sql.isVoteable(connection, postID)
+        if not sql.hasVoted(connection, postID, f"voter{i}"):
+            sql.castVote(connection, postID, f"voter{i}", main.VOTING_OPTIONS[0])
+            sql.fetchVotes(connection, postID)
+    sql.removeExpiredPostsFromDB(connection)
+
+    print(sql.queryProfiler.stats(10))
+    print(f"slow statements were written to {sql.SLOW_QUERY_LOG}")
+    connection.close()
+    removeDatabase(file)
+
+
+# sql.py functions that read a whole table on purpose. The jobs and checkpoints tables only ever hold a few rows
+QUERY_PLAN_ALLOWED_SCANS = ["fetchAllMessagesFromDB", "fetchVotingDeadlinesFromDB", "countJobs",
+                            "fetchCheckpointsFromDB"]
+
+
+# Runs every sql.py query function (migrations aside) against a large DB, captures the statements it executes and
+# checks with EXPLAIN QUERY PLAN that none of them scans a table. Exits with status 1 if one does.
+def checkQueryPlans(rows: int = 100000):
+    file = temporaryDatabase()
+    connection = sql.createDBConnection(file)
+    postIDList = seedPostsBulk(connection, rows)
+    postID = postIDList[rows // 2]
+    submission = fakeSubmission("new", time.time())
+    message = types.SimpleNamespace(id="newMessage", subject="Subject", body="Body",
+                                    author=types.SimpleNamespace(name="user"))
+    now = time.time()
+
+    calls = [
+        ("insertSubmissionIntoDB", lambda: sql.insertSubmissionIntoDB(connection, submission,
+                                                                      types.SimpleNamespace(id="reply"),
+                                                                      main.VOTING_OPTIONS, True)),
+        ("isPostInDB", lambda: sql.isPostInDB(connection, postID)),
+        ("isVoteable", lambda: sql.isVoteable(connection, postID)),
+        ("updateVotingEligibility", lambda: sql.updateVotingEligibility(connection, postID, True)),
+        ("castVote", lambda: sql.castVote(connection, postID, "newVoter", main.VOTING_OPTIONS[0])),
+        ("hasVoted", lambda: sql.hasVoted(connection, postID, "newVoter")),
+        ("fetchVotes", lambda: sql.fetchVotes(connection, postID)),
+        ("fetchVoters", lambda: sql.fetchVoters(connection, postID)),
+        ("fetchPostRecord", lambda: sql.fetchPostRecord(connection, postID)),
+        ("fetchPostIDsOpenForVotingFromDB", lambda: sql.fetchPostIDsOpenForVotingFromDB(connection)),
+        ("fetchCommentIDFromDB", lambda: sql.fetchCommentIDFromDB(connection, fakeSubmission(postID, 0))),
+        ("incrementReviewState", lambda: sql.incrementReviewState(connection, postID)),
+        ("fetchVotingDeadlinesFromDB", lambda: sql.fetchVotingDeadlinesFromDB(connection)),
+        ("insertUserMessageIntoDB", lambda: sql.insertUserMessageIntoDB(connection, message)),
+        ("insertBotMessageIntoDB", lambda: sql.insertBotMessageIntoDB(connection, "Subject", "Body")),
+        ("fetchAllMessagesFromDB", lambda: sql.fetchAllMessagesFromDB(connection)),
+        ("removeMessageByIDFromDB", lambda: sql.removeMessageByIDFromDB(connection, "newMessage")),
+        ("removeMessageFromDB", lambda: sql.removeMessageFromDB(connection, message)),
+        ("fetchReviewState", lambda: sql.fetchReviewState(connection, postID)),
+        ("fetchVotingEligibilityFromDB", lambda: sql.fetchVotingEligibilityFromDB(connection)),
+        ("insertJobIntoDB", lambda: sql.insertJobIntoDB(connection, main.SECOND_REVIEW_JOB, postID, now, 1)),
+        ("claimJobs", lambda: sql.claimJobs(connection, "owner", now, now + 300, 1)),
+        ("renewJobLeases", lambda: sql.renewJobLeases(connection, "owner", now + 300)),
+        ("fetchNextJobDueTime", lambda: sql.fetchNextJobDueTime(connection)),
+        ("countJobs", lambda: sql.countJobs(connection)),
+        ("releaseJob", lambda: sql.releaseJob(connection, main.SECOND_REVIEW_JOB, postID, "owner", now)),
+        ("completeJob", lambda: sql.completeJob(connection, main.SECOND_REVIEW_JOB, postID, "owner")),
+        ("saveCheckpoint", lambda: sql.saveCheckpoint(connection, "comments/t1", "t1_new", now, now)),
+        ("fetchCheckpointsFromDB", lambda: sql.fetchCheckpointsFromDB(connection)),
+        ("saveSeenItems", lambda: sql.saveSeenItems(connection, [("t1_new", now)], now - main.SEEN_FILTER_WINDOW)),
+        ("fetchSeenItems", lambda: sql.fetchSeenItems(connection, now - main.SEEN_FILTER_WINDOW, 1000)),
+        ("removePostFromDB", lambda: sql.removePostFromDB(connection, submission)),
+        ("removePostByIDFromDB", lambda: sql.removePostByIDFromDB(connection, postID)),
+        ("removeExpiredPostsFromDB", lambda: sql.removeExpiredPostsFromDB(connection)),
+    ]
+
+    failures = 0
+    for name, call in calls:
+        statements = []
+        connection.set_trace_callback(statements.append)
+        call()
+        connection.set_trace_callback(None)
+
+        for statement in statements:
+            if not statement.lstrip().upper().startswith(("SELECT", "INSERT", "UPDATE", "DELETE")):
+                continue
+            plan = [row[3] for row in connection.execute("EXPLAIN QUERY PLAN " + statement).fetchall()]
+            # A scan of a subquery's result only reads the rows the subquery found
+            scans = [step for step in plan if step.startswith("SCAN") and not step.startswith("SCAN (subquery")]
+            if (len(scans) > 0) and (name not in QUERY_PLAN_ALLOWED_SCANS):
+                failures = failures + 1
+                status = "SCAN"
+            else:
+                status = "ok"
+            print(f"{status:<5} {name:<30} {statement[:70]:<70} {'; '.join(plan)}")
+
+    connection.close()
+    removeDatabase(file)
+
+    print(f"{failures} statements scan a table with {rows} rows")
+    if failures > 0:
+        sys.exit(1)
+
+
+# Removes a post on a second connection, like a review worker in another process would, and checks that PostCache.sync
+# drops it from the cache and the reply index while the other posts stay. Exits with status 1 if it doesn't.
+def checkCacheSync(posts: int = 10):
+    file = temporaryDatabase()
+    connection = sql.createDBConnection(file)
+    postIDList = seedPostsBulk(connection, posts)
+    postCache = PostCache()
+    postCache.load(connection)
+    removedID = postIDList[0]
+
+    otherConnection = sql.createDBConnection(file)
+    otherConnection.execute(f"DELETE FROM {sql.TABLE_NAME} WHERE PostID = ?;", (removedID,))
+    otherConnection.commit()
+    otherConnection.close()
+    postCache.sync(connection)
+
+    failures = []
+    if removedID in postCache.records:
+        failures.append("the removed post is still cached")
+    if postCache.findByReply("t1_r" + removedID) is not None:
+        failures.append("the removed post's reply is still indexed")
+    if postCache.castVote(connection, removedID, "lateVoter", main.VOTING_OPTIONS[0]) != {}:
+        failures.append("a vote on the removed post was counted")
+    if sorted(postCache.records) != sorted(postIDList[1:]):
+        failures.append(f"{len(postCache.records)} of {posts - 1} other posts are cached")
+
+    connection.close()
+    removeDatabase(file)
+
+    print("ok" if len(failures) == 0 else "FAILED: " + ", ".join(failures))
+    if len(failures) > 0:
+        sys.exit(1)
+
+
+# Table sizes (posts, with 3 votes each) the suite runs at, timed operations per run and runs per measurement. The
+# fastest run is kept since slower ones only add scheduler and disk noise.
+SUITE_SIZES = [1000, 10000, 100000]
+SUITE_OPERATIONS = 1000
+SUITE_REPEATS = 5
+
+# Share of the table that is expired when timing removeExpiredPostsFromDB
+SUITE_EXPIRED_SHARE = 0.1
+
+# A measurement more than this much slower than in the baseline run is flagged by compareSuite
+REGRESSION_THRESHOLD = 0.2
+
+
+# Times operation(i) for i in range(operations) SUITE_REPEATS times, calling setup(repeat) before each run. Returns the
+# seconds per operation of the fastest and median run.
+def measure(operation, operations: int = SUITE_OPERATIONS, setup=None) -> dict:
+    runs = []
+    for repeat in range(SUITE_REPEATS):
+        if setup is not None:
+            setup(repeat)
+        start = time.perf_counter()
+        for i in range(operations):
+            operation(i)
+        runs.append((time.perf_counter() - start) / operations)
+    return {"best": min(runs), "median": percentile(runs, 0.5), "operations": operations}
+
+
+# Times the sql.py hot functions and the voting table rendering at every SUITE_SIZES table size. Returns
+# {"function@rows": measurement}.
+def runSuite() -> dict:
+    results = {}
+    generator = random.Random(1)
+    for rows in SUITE_SIZES:
+        file = temporaryDatabase()
+        connection = sql.createDBConnection(file)
+        postIDList = seedPostsBulk(connection, rows)
+        sample = [generator.choice(postIDList) for i in range(SUITE_OPERATIONS)]
+        option = main.VOTING_OPTIONS[0]
+        reply = types.SimpleNamespace(id="suiteReply")
+        main.postCache = PostCache()
+        body = main.STANDARD_REPLY + main.VOTING_TEXT
+        renderedBody = main.createBodyWithNewVotingTable(connection, fakeSubmission(sample[0], 0), body)
+        counter = itertools.count()
+
+        def seedExpired(repeat: int):
+            seedPostsBulk(connection, int(rows * SUITE_EXPIRED_SHARE), time.time() - 2 * sql.REMOVE_AGE, f"x{repeat}")
+
+        suite = {
+            "insertSubmissionIntoDB": lambda: measure(lambda i: sql.insertSubmissionIntoDB(
+                connection, fakeSubmission(f"new{next(counter)}", time.time()), reply, main.VOTING_OPTIONS, True)),
+            "fetchVotes": lambda: measure(lambda i: sql.fetchVotes(connection, sample[i])),
+            # updateVotes became castVote when votes moved to their own table
+            "castVote": lambda: measure(lambda i: sql.castVote(connection, sample[i], f"suite{next(counter)}", option)),
+            "fetchVoters": lambda: measure(lambda i: sql.fetchVoters(connection, sample[i])),
+            "incrementReviewState": lambda: measure(lambda i: sql.incrementReviewState(connection, sample[i])),
+            "removeExpiredPostsFromDB": lambda: measure(lambda i: sql.removeExpiredPostsFromDB(connection), 1,
+                                                        seedExpired),
+            "createBodyWithNewVotingTable": lambda: measure(lambda i: main.createBodyWithNewVotingTable(
+                connection, fakeSubmission(sample[i], 0), renderedBody)),
+            "stripVotingTableFromBody": lambda: measure(lambda i: main.stripVotingTableFromBody(renderedBody)),
+        }
+        for name, run in suite.items():
+            key = f"{name}@{rows}"
+            results[key] = run()
+            print(f"{key:<40} {results[key]['best'] * 1e6:>10.1f} us/op  (median {results[key]['median'] * 1e6:.1f})")
+
+        connection.close()
+        removeDatabase(file)
+    return results
+
+
+def saveSuite(file: str, results: dict):
+    with open(file, "w") as resultsFile:
+        json.dump({"created": time.time(), "python": platform.python_version(), "sqlite": sqlite3.sqlite_version,
+                   "results": results}, resultsFile, indent=2)
+
+
+# Prints every measurement of the new run against the baseline run and returns the keys that got slower by more than
+# REGRESSION_THRESHOLD
+def compareSuite(baselineFile: str, newFile: str) -> list:
+    with open(baselineFile) as resultsFile:
+        baseline = json.load(resultsFile)["results"]
+    with open(newFile) as resultsFile:
+        new = json.load(resultsFile)["results"]
+
+    regressions = []
+    for key in [key for key in new if key in baseline]:
+        ratio = new[key]["best"] / baseline[key]["best"]
+        status = "ok"
+        if ratio > 1 + REGRESSION_THRESHOLD:
+            status = "SLOWER"
+            regressions.append(key)
+        elif ratio < 1 - REGRESSION_THRESHOLD:
+            status = "faster"
+        print(f"{status:<7} {key:<40} {baseline[key]['best'] * 1e6:>10.1f} us -> {new[key]['best'] * 1e6:>10.1f} us"
+              f"  ({(ratio - 1) * 100:+.0f}%)")
+    for key in [key for key in baseline if key not in new]:
+        print(f"missing {key}")
+    return regressions
+
+
+BENCHMARKS = {
+    "votecache": benchmarkVoteCache,
+    "replyindex": benchmarkReplyIndex,
+    "expiry": benchmarkExpiry,
+    "connection": benchmarkConnection,
+    "writer": benchmarkWriter,
+    "ratelimit": benchmarkRateLimit,
+    "hydration": benchmarkHydration,
+    "commentshards": benchmarkCommentShards,
+    "seenfilter": benchmarkSeenFilter,
+    "queryprofile": benchmarkQueryProfile,
+    "queryplans": checkQueryPlans,
+    "cachesync": checkCacheSync,
+}
+
+if __name__ == "__main__":
+    # The data layer logs every decode at DEBUG which would dominate the timings
+    sql.logger.setLevel(logging.WARNING)
+
+    if (len(sys.argv) > 1) and (sys.argv[1] == "suite"):
+        suiteFile = sys.argv[2] if len(sys.argv) > 2 else "benchmark.json"
+        saveSuite(suiteFile, runSuite())
+        print(f"Results saved to {suiteFile}")
+        sys.exit(0)
+    if (len(sys.argv) > 1) and (sys.argv[1] == "compare"):
+        regressionList = compareSuite(sys.argv[2], sys.argv[3])
+        print(f"{len(regressionList)} regressions over {REGRESSION_THRESHOLD * 100:.0f}%")
+        sys.exit(1 if len(regressionList) > 0 else 0)
+
+    names = sys.argv[1:] if len(sys.argv) > 1 else list(BENCHMARKS.keys())
+    for name in names:
+        print(f"=== {name} ===")
+        BENCHMARKS[name]()
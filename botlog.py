@@ -0,0 +1,96 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+import metrics
+
+# Records waiting for the writer thread. Once it is full new records are dropped (and counted) rather than blocking
+# the loop that logged them.
+LOG_QUEUE_SIZE = 10000
+
+# Attributes every LogRecord has. Anything else on a record came in through extra= and is written as its own field.
+STANDARD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+# One JSON object per line: time, level, logger, thread, function, line, message, any extra= fields and the exception
+class JSONFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "function": record.funcName,
+            "line": record.lineno,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in STANDARD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+# Lets through at most limit records at or below level from each call site (file and line) per window seconds. The
+# next record let through from a site carries the number that were dropped in its "suppressed" field.
+class SamplingFilter(logging.Filter):
+    def __init__(self, limit: int, window: float, level: int = logging.DEBUG):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self.level = level
+        self.lock = threading.Lock()
+        self.sites = {}  # (pathname, lineno) -> [window start, records let through, records dropped]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > self.level:
+            return True
+
+        now = time.monotonic()
+        key = (record.pathname, record.lineno)
+        with self.lock:
+            site = self.sites.get(key)
+            if (site is None) or (now - site[0] >= self.window):
+                if (site is not None) and (site[2] > 0):
+                    record.suppressed = site[2]
+                self.sites[key] = [now, 1, 0]
+                return True
+            if site[1] < self.limit:
+                site[1] += 1
+                return True
+            site[2] += 1
+        metrics.registry.count("bot_log_sampled_out_total")
+        return False
+
+
+# Puts records on a bounded queue for the writer thread without ever waiting on it
+class BackgroundHandler(logging.handlers.QueueHandler):
+    # The message is merged with its arguments here since they could change before the writer gets to them. Turning
+    # the record into JSON or text happens on the writer thread.
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.registry.count("bot_log_dropped_total")
+
+
+# Moves handlers off logger onto a writer thread fed by a queue. Each handler keeps its own level and formatter. The
+# queue is drained when the process exits.
+def startBackgroundLogging(logger: logging.Logger, handlers: list) -> logging.handlers.QueueListener:
+    recordQueue = queue.Queue(LOG_QUEUE_SIZE)
+    listener = logging.handlers.QueueListener(recordQueue, *handlers, respect_handler_level=True)
+    logger.addHandler(BackgroundHandler(recordQueue))
+    listener.start()
+    atexit.register(listener.stop)
+    metrics.registry.gauge(f"bot_log_queue{{logger=\"{logger.name}\"}}", recordQueue.qsize)
+    return listener
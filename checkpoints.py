@@ -0,0 +1,53 @@
+import sqlite3
+import threading
+
+import clock
+import sql
+
+
+def idNumber(fullname: str) -> int:
+    return int(fullname.split("_")[-1], 36)
+
+
+# The newest item each stream (submissions, comments, inbox) has handled, kept in the DB so the next run can pick up
+# where this one stopped. Reddit IDs are base 36 counters, one per kind of item, so an item is new to a stream if its
+# ID is above the stream's checkpoint for that kind ("inbox/t4" for messages, "inbox/t1" for comment replies).
+# Checkpoints are written through writer (a dbwriter.DBWriter) without waiting for the commit.
+class Checkpoints:
+    def __init__(self, writer):
+        self.writer = writer
+        self.lock = threading.Lock()
+        self.positions = {}  # "stream/kind" -> (ID as a number, fullname, created_utc)
+
+    def load(self, connection: sqlite3.Connection):
+        with self.lock:
+            for key, fullname, createdUTC in sql.fetchCheckpointsFromDB(connection):
+                self.positions[key] = (idNumber(fullname), fullname, createdUTC)
+
+    def key(self, stream: str, item) -> str:
+        return f"{stream}/{item.name.split('_')[0]}"
+
+    def has(self, stream: str) -> bool:
+        with self.lock:
+            return any(key.startswith(stream + "/") for key in self.positions)
+
+    def isNew(self, stream: str, item) -> bool:
+        with self.lock:
+            position = self.positions.get(self.key(stream, item))
+        return (position is None) or (idNumber(item.name) > position[0])
+
+    def advance(self, stream: str, item):
+        key = self.key(stream, item)
+        number = idNumber(item.name)
+        with self.lock:
+            position = self.positions.get(key)
+            if (position is not None) and (position[0] >= number):
+                return
+            self.positions[key] = (number, item.name, item.created_utc)
+        self.writer.submit(sql.saveCheckpoint, key, item.name, item.created_utc, clock.time())
+
+    # Seconds since the newest item stream has handled was posted, None without a checkpoint
+    def age(self, stream: str):
+        with self.lock:
+            createdList = [position[2] for key, position in self.positions.items() if key.startswith(stream + "/")]
+        return None if len(createdList) == 0 else clock.time() - max(createdList)
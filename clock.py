@@ -0,0 +1,36 @@
+import time as systemTime
+
+# Time as the bot sees it. Every bot module reads the time and sleeps through here instead of the time module so a
+# replay can run the bot's clock faster than real time (see replay.py). Until accelerate is called this is the system
+# clock.
+
+# Virtual seconds that pass per real second
+speedup = 1.0
+
+# System time and monotonic time when the clock was accelerated
+startTime = None
+startMonotonic = None
+
+
+# Runs the clock factor times faster than real time from now on
+def accelerate(factor: float):
+    global speedup, startTime, startMonotonic
+    startTime = time()
+    startMonotonic = systemTime.monotonic()
+    speedup = factor
+
+
+# UNIX time, the same as time.time() when the clock isn't accelerated
+def time() -> float:
+    if startTime is None:
+        return systemTime.time()
+    return startTime + (systemTime.monotonic() - startMonotonic) * speedup
+
+
+def sleep(seconds: float):
+    systemTime.sleep(timeout(seconds))
+
+
+# Real seconds to wait for seconds to pass on the clock, for Condition.wait, asyncio.sleep and the like
+def timeout(seconds: float) -> float:
+    return seconds / speedup
@@ -0,0 +1,102 @@
+import collections
+import logging
+import threading
+
+from praw.models import MoreComments
+
+from ratelimit import PRIORITY_REPLY
+
+# Most top level "load more comments" links expanded while looking for the poster's comment. The whole tree is loaded
+# when the answer is still unknown after that many
+TOP_LEVEL_MORE_LIMIT = 3
+
+
+# Reading submission.comments is what loads the first page of the comment listing
+def loadCommentForest(submission):
+    return submission.comments
+
+
+# Fetches a comment on its own, with its replies
+def loadReplies(comment) -> list:
+    comment.refresh()
+    return comment.replies
+
+
+# Answers the two questions secondReviewPass has about a post's comments (does the bot's reply have replies and does
+# the poster have a top level comment) without loading the whole tree. The first page of the comment listing usually
+# answers both. The reply is refreshed on its own if it isn't on that page and top level "load more comments" links
+# are expanded one at a time up to moreLimit before falling back to replace_more(limit=None). The requests made for
+# each post are counted. Requests are made through budget (a ratelimit.APIBudget) when one is given.
+class CommentTreeInspector:
+    def __init__(self, logger: logging.Logger, moreLimit: int = TOP_LEVEL_MORE_LIMIT, budget=None):
+        self.logger = logger
+        self.moreLimit = moreLimit
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.requestCounts = collections.Counter()  # requests per post -> posts
+        self.fullTreeLoads = 0
+
+    # Returns (replyHasChildren, posterHasTopLevelComment). The poster's comments are only looked for when the reply
+    # has no children since the reply is kept either way otherwise.
+    def inspect(self, submission, reply) -> tuple:
+        requests = 1  # First page of the comment listing
+        replyHasChildren = None
+        posterHasTopLevelComment = False
+        moreList = []
+        for item in self.call(loadCommentForest, submission):
+            if isinstance(item, MoreComments):
+                moreList.append(item)
+                continue
+            if item.is_submitter:
+                posterHasTopLevelComment = True
+            if item.id == reply.id:
+                replyHasChildren = len(item.replies) > 0
+
+        if replyHasChildren is None:
+            requests = requests + 1
+            replyHasChildren = len(self.call(loadReplies, reply)) > 0
+
+        fullTree = False
+        if (not replyHasChildren) and (not posterHasTopLevelComment) and (len(moreList) > 0):
+            expanded = 0
+            while (len(moreList) > 0) and (expanded < self.moreLimit) and (not posterHasTopLevelComment):
+                more = moreList.pop(0)
+                expanded = expanded + 1
+                for item in self.call(more.comments):
+                    if item.parent_id != submission.name:
+                        continue
+                    if isinstance(item, MoreComments):
+                        moreList.append(item)
+                    elif item.is_submitter:
+                        posterHasTopLevelComment = True
+            requests = requests + expanded
+
+            if (len(moreList) > 0) and (not posterHasTopLevelComment):
+                fullTree = True
+                while True:
+                    requests = requests + 1
+                    if len(self.call(submission.comments.replace_more, limit=1)) == 0:
+                        break
+                posterHasTopLevelComment = any(comment.is_submitter for comment in submission.comments)
+
+        with self.lock:
+            self.requestCounts[requests] += 1
+            if fullTree:
+                self.fullTreeLoads += 1
+        self.logger.debug("Inspected the comments on %s with %s requests%s", submission.id, requests,
+                          " (full tree)" if fullTree else "")
+        return replyHasChildren, posterHasTopLevelComment
+
+    def call(self, function, *args, **kwargs):
+        if self.budget is not None:
+            return self.budget.call(PRIORITY_REPLY, function, *args, **kwargs)
+        return function(*args, **kwargs)
+
+    def stats(self) -> str:
+        with self.lock:
+            posts = sum(self.requestCounts.values())
+            if posts == 0:
+                return "no posts inspected"
+            requests = sum(count * postCount for count, postCount in self.requestCounts.items())
+            return f"{posts} posts, {requests / posts:.1f} requests per post, " \
+                   f"most {max(self.requestCounts)}, {self.fullTreeLoads} full tree loads"
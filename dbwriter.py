@@ -0,0 +1,84 @@
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+
+import sql
+
+# Most write operations applied in one transaction
+WRITER_BATCH_SIZE = 256
+
+
+# Owns all writes to the database. Callers submit sql.py write functions and get a Future back. The writer thread takes
+# whatever operations are queued, applies them in one transaction (each in its own savepoint so a failing operation
+# doesn't undo the others) and resolves the futures once that transaction has committed. One thread writing means no
+# lock contention between writers and one commit (fsync) per batch instead of per statement.
+class DBWriter:
+    def __init__(self, logger: logging.Logger, batchSize: int = WRITER_BATCH_SIZE):
+        self.logger = logger
+        self.batchSize = batchSize
+        self.queue = queue.Queue()
+        self.batches = 0
+        self.operations = 0
+        self.thread = threading.Thread(target=self.run, name="db-writer", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    # function is called as function(connection, *args) on the writer thread
+    def submit(self, function, *args) -> Future:
+        future = Future()
+        self.queue.put((future, function, args))
+        return future
+
+    # Submits and waits for the result
+    def write(self, function, *args):
+        return self.submit(function, *args).result()
+
+    def pending(self) -> int:
+        return self.queue.qsize()
+
+    def nextBatch(self) -> list:
+        batch = [self.queue.get()]
+        while len(batch) < self.batchSize:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        connection = sql.threadConnection()
+        sql.threadState.batching = True  # Helpers leave committing to the writer
+
+        while True:
+            batch = self.nextBatch()
+            results = []
+            try:
+                connection.execute("BEGIN IMMEDIATE;")
+                for future, function, args in batch:
+                    connection.execute("SAVEPOINT operation;")
+                    try:
+                        results.append((future, function(connection, *args), None))
+                        connection.execute("RELEASE operation;")
+                    except Exception as e:
+                        connection.execute("ROLLBACK TO operation;")
+                        connection.execute("RELEASE operation;")
+                        results.append((future, None, e))
+                connection.commit()
+            except Exception as e:
+                self.logger.error(f"The database writer was unable to commit a batch of {len(batch)} operations")
+                self.logger.error(e)
+                if connection.in_transaction:
+                    connection.rollback()
+                for future, function, args in batch:
+                    future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.operations += len(batch)
+            for future, result, exception in results:
+                if exception is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(exception)
@@ -0,0 +1,99 @@
+import collections
+import logging
+import threading
+
+import clock
+import metrics
+import sql
+
+# Closures kept for the lateness percentiles
+LATENESS_SAMPLES = 1000
+
+
+# Closes voting on each post at its VotingTime. Deadlines are loaded from the DB and kept up to date through sql's
+# insertion and removal listeners, and each one is a job in a Scheduler so nothing polls for due posts. action is
+# called with a list of PostIDs whose voting should close. How late each closure ran is recorded, for stats and in the
+# bot_voting_closure_lateness_seconds histogram.
+class DeadlineQueue:
+    def __init__(self, scheduler, action, logger: logging.Logger):
+        self.scheduler = scheduler
+        self.action = action
+        self.logger = logger
+        self.deadlines = {}  # PostID -> VotingTime of the job that will close it
+        self.lock = threading.Lock()
+        self.closures = 0
+        self.lateness = collections.deque(maxlen=LATENESS_SAMPLES)
+        sql.insertionListeners.append(self.add)
+        sql.removalListeners.append(self.forget)
+
+    # Schedules a closure for postID unless one is already scheduled for the same deadline
+    def add(self, postID: str, deadline: float):
+        with self.lock:
+            if self.deadlines.get(postID) == deadline:
+                return
+            self.deadlines[postID] = deadline
+        self.scheduler.scheduleAt(deadline, self.fire, postID, deadline)
+
+    def forget(self, postIDList: list):
+        with self.lock:
+            for postID in postIDList:
+                self.deadlines.pop(postID, None)
+
+    # Schedules every post in the DB. Posts that are already overdue are closed together on the calling thread so they
+    # can share API requests.
+    def load(self, connection):
+        now = clock.time()
+        overdue = []
+        for postID, deadline in sql.fetchVotingDeadlinesFromDB(connection):
+            if deadline > now:
+                self.add(postID, deadline)
+                continue
+            with self.lock:
+                if postID in self.deadlines:
+                    continue
+                self.deadlines[postID] = deadline
+            overdue.append((postID, deadline))
+
+        if len(overdue) > 0:
+            self.logger.info("Closing voting on %s overdue posts", len(overdue))
+            self.close(overdue)
+
+    def fire(self, postID: str, deadline: float):
+        with self.lock:
+            # The post was removed or rescheduled after this job was queued
+            if self.deadlines.get(postID) != deadline:
+                return
+        self.close([(postID, deadline)])
+
+    def close(self, deadlineList: list):
+        now = clock.time()
+        with self.lock:
+            for postID, deadline in deadlineList:
+                self.closures += 1
+                self.lateness.append(now - deadline)
+        for postID, deadline in deadlineList:
+            metrics.registry.observe("bot_voting_closure_lateness_seconds", now - deadline)
+            self.logger.debug("Closing voting on %s %.1fs after its deadline", postID, now - deadline)
+        try:
+            self.action([postID for postID, deadline in deadlineList])
+        finally:
+            self.forget([postID for postID, deadline in deadlineList])
+
+    def pending(self) -> int:
+        with self.lock:
+            return len(self.deadlines)
+
+    # Posts past their deadline whose voting hasn't closed yet
+    def overdue(self) -> int:
+        now = clock.time()
+        with self.lock:
+            return len([deadline for deadline in self.deadlines.values() if deadline <= now])
+
+    def stats(self) -> str:
+        with self.lock:
+            if len(self.lateness) == 0:
+                return f"{self.closures} closures, {len(self.deadlines)} pending"
+            samples = sorted(self.lateness)
+            return f"{self.closures} closures, {len(self.deadlines)} pending, lateness " \
+                   f"median {samples[len(samples) // 2]:.2f}s / p95 {samples[int(len(samples) * 0.95)]:.2f}s / " \
+                   f"max {samples[-1]:.2f}s"
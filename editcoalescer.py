@@ -0,0 +1,144 @@
+import logging
+import threading
+
+import clock
+import sql
+from ratelimit import PRIORITY_EDIT
+
+# Seconds between checks for vote tables that are due an edit
+FLUSH_TICK = 1
+
+# Seconds a submission is remembered as closed after its voting closes, so a vote still queued at that time can't put
+# the voting table back
+CLOSED_RETENTION = 3600
+
+
+# Reading a lazy comment's body is what fetches it. Named so the API budget counts it by name
+def loadBody(comment) -> str:
+    return comment.body
+
+
+# Coalesces edits of the bot's voting table comments. Votes only mark a submission as dirty and a single flusher thread
+# makes at most one edit per submission every interval seconds with the tally at that time. An edit is skipped when
+# the rendered body is the same as the body the comment already has.
+class EditCoalescer:
+    # render(submissionID, body) returns body with the current voting table. Edits are made through budget (a
+    # ratelimit.APIBudget) when one is given.
+    def __init__(self, reddit, render, interval: float, logger: logging.Logger, budget=None):
+        self.reddit = reddit
+        self.budget = budget
+        self.render = render
+        self.interval = interval
+        self.logger = logger
+        self.pending = {}  # submissionID -> replyID
+        self.bodies = {}  # submissionID -> last known body of the reply
+        self.lastEditTimes = {}  # submissionID -> time of the last edit
+        self.closed = {}  # submissionID -> time its voting closed. Never edited again
+        self.editing = set()  # submissionIDs with an edit in flight
+        self.lock = threading.Lock()  # Guards the dicts and editing. Never held during an API call
+        self.editDone = threading.Condition(self.lock)  # Notified when an edit in flight finishes
+        self.edits = 0
+        self.skippedEdits = 0
+        self.flusher = threading.Thread(target=self.run, name="vote-table-flusher", daemon=True)
+        sql.removalListeners.append(self.forget)
+
+    def start(self):
+        self.flusher.start()
+
+    def markDirty(self, submissionID: str, replyID: str):
+        with self.lock:
+            if submissionID not in self.closed:
+                self.pending[submissionID] = replyID
+
+    # Records a body written by something other than the coalescer so the next render starts from it
+    def noteBody(self, submissionID: str, body: str):
+        with self.lock:
+            self.bodies[submissionID] = body
+
+    # Makes any pending edit for submissionID now
+    def flush(self, submissionID: str):
+        with self.lock:
+            replyID = self.pending.pop(submissionID, None)
+        if replyID is not None:
+            self.edit(submissionID, replyID)
+
+    # Flushes then stops tracking submissionID, used when voting closes. It waits for an edit of the same submission
+    # the flusher already has in flight, and once closed the submission is never edited again, so no edit can land
+    # after the caller's closing edit. Edits of other submissions carry on meanwhile.
+    def close(self, submissionID: str):
+        self.flush(submissionID)
+        with self.lock:
+            while submissionID in self.editing:
+                self.editDone.wait()
+            self.closed[submissionID] = clock.time()
+        self.forget([submissionID])
+
+    def forget(self, submissionIDList: list):
+        with self.lock:
+            for submissionID in submissionIDList:
+                self.pending.pop(submissionID, None)
+                self.bodies.pop(submissionID, None)
+                self.lastEditTimes.pop(submissionID, None)
+
+    # Edits of one submission run one at a time so they can't overwrite each other's table. Only that submission waits
+    # on a slow edit, the lock is never held during the API calls.
+    def edit(self, submissionID: str, replyID: str):
+        with self.lock:
+            while submissionID in self.editing:
+                self.editDone.wait()
+            if submissionID in self.closed:
+                return
+            self.editing.add(submissionID)
+        try:
+            self.editNow(submissionID, replyID)
+        finally:
+            with self.lock:
+                self.editing.discard(submissionID)
+                self.editDone.notify_all()
+
+    def editNow(self, submissionID: str, replyID: str):
+        reply = self.reddit.comment(id=replyID)
+        with self.lock:
+            body = self.bodies.get(submissionID)
+        if body is None:
+            body = self.call(loadBody, reply)
+
+        newBody = self.render(submissionID, body)
+        with self.lock:
+            self.lastEditTimes[submissionID] = clock.time()
+            self.bodies[submissionID] = newBody
+            if newBody == body:
+                self.skippedEdits += 1
+                return
+
+        self.call(reply.edit, newBody)
+        with self.lock:
+            self.edits += 1
+
+    def call(self, function, *args):
+        if self.budget is not None:
+            return self.budget.call(PRIORITY_EDIT, function, *args)
+        return function(*args)
+
+    def due(self) -> list:
+        now = clock.time()
+        with self.lock:
+            dueList = [(submissionID, replyID) for submissionID, replyID in self.pending.items()
+                       if self.lastEditTimes.get(submissionID, 0) + self.interval <= now]
+            for submissionID, replyID in dueList:
+                del self.pending[submissionID]
+            for submissionID in [submissionID for submissionID, closedTime in self.closed.items()
+                                 if closedTime + CLOSED_RETENTION <= now]:
+                del self.closed[submissionID]
+        return dueList
+
+    def run(self):
+        while True:
+            clock.sleep(FLUSH_TICK)
+            for submissionID, replyID in self.due():
+                try:
+                    self.edit(submissionID, replyID)
+                except Exception as e:
+                    self.logger.warning(f"Unable to edit the voting table for submission {submissionID}")
+                    self.logger.warning("Printing stack trace...")
+                    self.logger.warning(e)
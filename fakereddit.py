@@ -0,0 +1,385 @@
+import collections
+import itertools
+import threading
+
+import clock
+
+# Local stand-in for the subset of PRAW the bot uses. Submissions, comments and messages are added with the post*/send*
+# methods and come out of the streams like they would from Reddit. Every call that would hit the Reddit API is counted
+# in FakeReddit.calls. replay.py runs the bot against it.
+
+# Seconds a stream waits for new items before checking again (or yielding None when pause_after is set)
+STREAM_POLL = 0.1
+
+# How many existing items a stream yields first when skip_existing is False (Reddit returns up to 100)
+STREAM_HISTORY = 100
+
+# Requests allowed per rate limit window and the window length in seconds, as reported by Reddit's X-Ratelimit headers
+RATE_LIMIT_REQUESTS = 1000
+RATE_LIMIT_WINDOW = 600
+
+ids = itertools.count(1)
+
+
+def newID() -> str:
+    number = next(ids)
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    text = ""
+    while number > 0:
+        number, remainder = divmod(number, 36)
+        text = digits[remainder] + text
+    return text
+
+
+class FakeRedditor:
+    def __init__(self, name: str):
+        self.name = name
+
+    def __eq__(self, other):
+        if isinstance(other, FakeRedditor):
+            other = other.name
+        return isinstance(other, str) and other.lower() == self.name.lower()
+
+    def __hash__(self):
+        return hash(self.name.lower())
+
+    def __str__(self):
+        return self.name
+
+
+class FakeSubredditRef:
+    def __init__(self, name: str):
+        self.display_name = name
+        self.id = name.lower()
+
+
+class FakeModeration:
+    def __init__(self, reddit, thing):
+        self.reddit = reddit
+        self.thing = thing
+
+    def remove(self):
+        self.reddit.countCall("mod.remove")
+        self.thing.removed = True
+
+    def lock(self):
+        self.reddit.countCall("mod.lock")
+        self.thing.locked = True
+
+    def distinguish(self, how: str = "yes", sticky: bool = False):
+        self.reddit.countCall("mod.distinguish")
+        self.thing.distinguished = how
+        self.thing.stickied = sticky
+
+    def undistinguish(self):
+        self.reddit.countCall("mod.undistinguish")
+        self.thing.distinguished = None
+        self.thing.stickied = False
+
+
+class FakeComment:
+    def __init__(self, reddit, submission, parentFullname: str, author: str, body: str):
+        self.reddit = reddit
+        self.id = newID()
+        self.name = "t1_" + self.id
+        self.submission = submission
+        self.subreddit = submission.subreddit
+        self.link_id = submission.name
+        self.parent_id = parentFullname
+        self.author = FakeRedditor(author)
+        self.body = body
+        self.created_utc = clock.time()
+        self.is_submitter = submission.author == author
+        self.replies = []
+        self.removed = False
+        self.locked = False
+        self.distinguished = None
+        self.stickied = False
+        self.mod = FakeModeration(reddit, self)
+
+    def edit(self, body: str):
+        self.reddit.countCall("comment.edit")
+        self.body = body
+        return self
+
+    def reply(self, body: str):
+        self.reddit.countCall("comment.reply")
+        return self.reddit.postComment(self.submission, self.name, self.reddit.username, body)
+
+    def downvote(self):
+        self.reddit.countCall("comment.vote")
+
+    def refresh(self):
+        self.reddit.countCall("comment.refresh")
+        return self
+
+
+class FakeCommentForest:
+    def __init__(self, submission):
+        self.submission = submission
+        self.loaded = False
+
+    # Like PRAW the first page of comments is fetched the first time the forest is read
+    def __iter__(self):
+        if not self.loaded:
+            self.loaded = True
+            self.submission.reddit.countCall("submission.comments")
+        return iter([comment for comment in self.submission.allComments if comment.parent_id == self.submission.name])
+
+    def replace_more(self, limit=32):
+        self.submission.reddit.countCall("submission.comments")
+        return []
+
+    def list(self) -> list:
+        return list(self.submission.allComments)
+
+
+# What reddit.submission(id=...) and reddit.comment(id=...) return. Like PRAW's lazy objects nothing is requested until
+# an attribute that needs the thing's data is read. The ID, methods and the objects that count their own requests
+# (mod, comments) don't need it.
+class FakeLazyThing:
+    freeAttributes = {"id", "name", "reddit", "mod", "comments"}
+
+    def __init__(self, reddit, thing, endpoint: str):
+        object.__setattr__(self, "lazy", (reddit, thing, endpoint))
+        object.__setattr__(self, "fetched", False)
+
+    def __getattr__(self, attribute: str):
+        reddit, thing, endpoint = self.lazy
+        value = getattr(thing, attribute)
+        if attribute == "refresh":
+            object.__setattr__(self, "fetched", True)  # Counts its own request, which loads the thing
+        elif (not self.fetched) and (attribute not in self.freeAttributes) and (not callable(value)):
+            object.__setattr__(self, "fetched", True)
+            reddit.countCall(endpoint)
+        return value
+
+    def __setattr__(self, attribute: str, value):
+        setattr(self.lazy[1], attribute, value)
+
+
+class FakeSubmission:
+    def __init__(self, reddit, subreddit: str, author: str, title: str, isSelf: bool = False, flair: str = None,
+                 url: str = None):
+        self.reddit = reddit
+        self.id = newID()
+        self.name = "t3_" + self.id
+        self.subreddit = FakeSubredditRef(subreddit)
+        self.author = FakeRedditor(author)
+        self.title = title
+        self.is_self = isSelf
+        self.link_flair_text = flair
+        self.url = url if url is not None else f"https://i.example.com/{self.id}.jpg"
+        self.permalink = f"/r/{subreddit}/comments/{self.id}/"
+        self.created_utc = clock.time()
+        self.score = 1
+        self.allComments = []
+        self.comments = FakeCommentForest(self)
+        self.removed = False
+        self.mod = FakeModeration(reddit, self)
+
+    def reply(self, body: str):
+        self.reddit.countCall("submission.reply")
+        return self.reddit.postComment(self, self.name, self.reddit.username, body)
+
+    def duplicates(self) -> list:
+        self.reddit.countCall("submission.duplicates")
+        return [submission for submission in self.reddit.submissions
+                if (submission.url == self.url) and (submission is not self)]
+
+
+class FakeMessage:
+    def __init__(self, author: str, subject: str, body: str, wasComment: bool = False):
+        self.id = newID()
+        self.name = "t4_" + self.id
+        self.author = FakeRedditor(author)
+        self.subject = subject
+        self.body = body
+        self.was_comment = wasComment
+        self.created_utc = clock.time()
+
+
+class FakeStream:
+    def __init__(self, reddit, items: list, subredditNames: set = None):
+        self.reddit = reddit
+        self.items = items
+        self.subredditNames = subredditNames
+
+    def belongs(self, item) -> bool:
+        if self.subredditNames is None:
+            return True
+        return item.subreddit.display_name.lower() in self.subredditNames
+
+    def stream(self, skip_existing: bool = False, pause_after: int = None):
+        with self.reddit.condition:
+            index = len(self.items) if skip_existing else max(0, len(self.items) - STREAM_HISTORY)
+
+        while True:
+            item = None
+            with self.reddit.condition:
+                if index >= len(self.items):
+                    self.reddit.condition.wait(STREAM_POLL)
+                if index < len(self.items):
+                    item = self.items[index]
+                    index = index + 1
+
+            if item is not None:
+                if self.belongs(item):
+                    yield item
+            elif pause_after is not None:
+                yield None
+
+    # One listing page, newest first, starting after the fullname in params["after"] like subreddit.new(limit=100,
+    # params={"after": ...}). Counted as one request to endpoint
+    def page(self, endpoint: str, limit: int = 100, params: dict = None):
+        self.reddit.countCall(endpoint)
+        after = (params or {}).get("after")
+        with self.reddit.condition:
+            items = [item for item in reversed(self.items) if self.belongs(item)]
+        if after is not None:
+            names = [item.name for item in items]
+            items = items[names.index(after) + 1:] if after in names else []
+        return iter(items[:limit])
+
+
+class FakeSubredditStream:
+    def __init__(self, reddit, names: set):
+        self.reddit = reddit
+        self.names = names
+
+    def submissions(self, skip_existing: bool = False, pause_after: int = None):
+        return FakeStream(self.reddit, self.reddit.submissions, self.names).stream(skip_existing, pause_after)
+
+    def comments(self, skip_existing: bool = False, pause_after: int = None):
+        return FakeStream(self.reddit, self.reddit.comments, self.names).stream(skip_existing, pause_after)
+
+
+class FakeSubreddit:
+    def __init__(self, reddit, name: str):
+        self.reddit = reddit
+        self.display_name = name
+        self.id = name.lower()
+        self.stream = FakeSubredditStream(reddit, set(name.lower().split("+")))
+
+    def new(self, limit: int = 100, params: dict = None):
+        return FakeStream(self.reddit, self.reddit.submissions, self.stream.names).page("subreddit.new", limit, params)
+
+    def comments(self, limit: int = 100, params: dict = None):
+        return FakeStream(self.reddit, self.reddit.comments, self.stream.names).page("subreddit.comments", limit,
+                                                                                     params)
+
+    def message(self, subject: str, message: str):
+        self.reddit.countCall("subreddit.message")
+        self.reddit.modmail.append((self.display_name, subject, message))
+
+
+class FakeInbox:
+    def __init__(self, reddit):
+        self.reddit = reddit
+
+    def stream(self, skip_existing: bool = False, pause_after: int = None):
+        return FakeStream(self.reddit, self.reddit.messages).stream(skip_existing, pause_after)
+
+    def messages(self, limit: int = 100, params: dict = None):
+        return FakeStream(self.reddit, self.reddit.messages).page("inbox.messages", limit, params)
+
+
+# reddit.auth: serves the rate limit values PRAW reads from the X-Ratelimit-Remaining/-Reset/-Used headers
+class FakeAuth:
+    def __init__(self, reddit):
+        self.reddit = reddit
+
+    @property
+    def limits(self) -> dict:
+        with self.reddit.condition:
+            if self.reddit.windowStart is None:
+                return {"remaining": None, "reset_timestamp": None, "used": None}
+            self.reddit.rollWindow()
+            return {"remaining": max(0, self.reddit.rateLimitRequests - self.reddit.used),
+                    "reset_timestamp": self.reddit.windowStart + self.reddit.rateLimitWindow,
+                    "used": self.reddit.used}
+
+
+class FakeReddit:
+    def __init__(self, username: str = "BeginnerWoodworkBot", rateLimitRequests: int = RATE_LIMIT_REQUESTS,
+                 rateLimitWindow: float = RATE_LIMIT_WINDOW):
+        self.username = username
+        self.validate_on_submit = True
+        self.condition = threading.Condition()
+        self.submissions = []
+        self.comments = []
+        self.messages = []
+        self.modmail = []
+        self.things = {}
+        self.calls = collections.Counter()
+        self.inbox = FakeInbox(self)
+        self.auth = FakeAuth(self)
+        self.rateLimitRequests = rateLimitRequests
+        self.rateLimitWindow = rateLimitWindow
+        self.windowStart = None
+        self.used = 0
+        self.overLimit = 0  # Calls Reddit would have answered with 429 Too Many Requests
+
+    def rollWindow(self):
+        if clock.time() >= self.windowStart + self.rateLimitWindow:
+            self.windowStart = clock.time()
+            self.used = 0
+
+    def countCall(self, endpoint: str):
+        with self.condition:
+            self.calls[endpoint] += 1
+            if self.windowStart is None:
+                self.windowStart = clock.time()
+            self.rollWindow()
+            self.used = self.used + 1
+            if self.used > self.rateLimitRequests:
+                self.overLimit = self.overLimit + 1
+
+    def subreddit(self, name: str) -> FakeSubreddit:
+        return FakeSubreddit(self, name)
+
+    def submission(self, id: str = None) -> FakeLazyThing:
+        return FakeLazyThing(self, self.things[id], "submission")
+
+    def comment(self, id: str = None) -> FakeLazyThing:
+        return FakeLazyThing(self, self.things[id], "comment")
+
+    # One request per 100 fullnames like PRAW's reddit.info. Unknown fullnames are left out
+    def info(self, fullnames: list = None):
+        for start in range(0, len(fullnames), 100):
+            self.countCall("info")
+            for fullname in fullnames[start:start + 100]:
+                thing = self.things.get(fullname.split("_")[-1])
+                if thing is not None:
+                    yield thing
+
+    # === Traffic ===
+
+    def postSubmission(self, subreddit: str, author: str, title: str, isSelf: bool = False, flair: str = None,
+                       url: str = None) -> FakeSubmission:
+        submission = FakeSubmission(self, subreddit, author, title, isSelf, flair, url)
+        with self.condition:
+            self.things[submission.id] = submission
+            self.submissions.append(submission)
+            self.condition.notify_all()
+        return submission
+
+    def postComment(self, submission: FakeSubmission, parentFullname: str, author: str, body: str) -> FakeComment:
+        comment = FakeComment(self, submission, parentFullname, author, body)
+        with self.condition:
+            self.things[comment.id] = comment
+            submission.allComments.append(comment)
+            parent = self.things.get(parentFullname.split("_")[-1])
+            if isinstance(parent, FakeComment):
+                parent.replies.append(comment)
+            self.comments.append(comment)
+            self.condition.notify_all()
+        return comment
+
+    def sendMessage(self, author: str, subject: str, body: str) -> FakeMessage:
+        message = FakeMessage(author, subject, body)
+        with self.condition:
+            self.messages.append(message)
+            self.condition.notify_all()
+        return message
+
@@ -0,0 +1,155 @@
+import logging
+import os
+import socket
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import clock
+import metrics
+import sql
+
+# Seconds a claimed job stays leased to its worker. Leases of running jobs are renewed on every poll so only the jobs
+# of a worker that died or hung become claimable again once this runs out.
+JOB_LEASE_SECONDS = 300
+
+# Longest the poller waits before looking for due jobs again. Jobs queued by this process wake it straight away, this
+# bounds how long jobs queued by other processes and expired leases wait.
+JOB_POLL_INTERVAL = 10
+
+# Claims after which a job is dropped. A job that keeps failing, or keeps taking its worker down with it, is logged and
+# given up on.
+JOB_MAX_ATTEMPTS = 5
+
+# Seconds a failed job waits before it can be claimed again, multiplied by the number of attempts so far
+JOB_RETRY_DELAY = 60
+
+
+# Runs the jobs in sql.py's jobs table on a pool of worker threads. Any number of processes can share the database: a
+# job is leased in the same write transaction that finds it, so one worker holds it at a time, and only the holder of
+# the lease can delete it once it is done. If a worker dies its jobs are claimed by another once their leases run out.
+# handlers maps each job type to a function called as handler(postID, item, reviewState) with item what fetch returned
+# for the job's PostID. fetch is called with the PostIDs of every batch of claimed jobs and returns {PostID: item}.
+# A job that dies partway is run again, so handlers check the post's ReviewState against reviewState (its value when
+# the job was queued) to skip stages that already finished.
+class JobQueue:
+    def __init__(self, dbWriter, handlers: dict, fetch, workers: int, logger: logging.Logger, name: str = "jobs"):
+        self.dbWriter = dbWriter
+        self.handlers = handlers
+        self.fetch = fetch
+        self.workers = workers
+        self.logger = logger
+        self.name = name
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.running = set()  # (JobType, PostID) of the jobs this process holds
+        self.condition = threading.Condition()
+        self.woken = False
+        self.pollListeners = []  # Functions called on the poller thread at most once per JOB_POLL_INTERVAL
+        self.lastListened = 0.0
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self.poller = threading.Thread(target=self.poll, name=f"{name}-poller", daemon=True)
+
+    def start(self):
+        self.poller.start()
+
+    # Queues jobType for postID to run from the UNIX time dueTime. Nothing happens if the same job is already queued
+    def add(self, jobType: str, postID: str, dueTime: float, reviewState=None):
+        self.dbWriter.write(sql.insertJobIntoDB, jobType, postID, dueTime, reviewState)
+        self.wake()
+
+    def wake(self):
+        with self.condition:
+            self.woken = True
+            self.condition.notify()
+
+    def pending(self) -> int:
+        return sql.countJobs(sql.threadConnection(readOnly=True))
+
+    def poll(self):
+        connection = sql.threadConnection(readOnly=True)
+        while True:
+            wait = JOB_POLL_INTERVAL
+            try:
+                if self.claimDueJobs():
+                    nextDueTime = sql.fetchNextJobDueTime(connection)
+                    if nextDueTime is not None:
+                        wait = min(wait, max(0.0, nextDueTime - clock.time()))
+                if clock.time() - self.lastListened >= JOB_POLL_INTERVAL:
+                    self.lastListened = clock.time()
+                    for listener in self.pollListeners:
+                        listener()
+            except Exception as e:
+                self.logger.error(f"The {self.name} poller was unable to claim jobs. It will try again.")
+                self.logger.error(e)
+
+            with self.condition:
+                if not self.woken:
+                    self.condition.wait(clock.timeout(wait))
+                self.woken = False
+
+    # Renews this process's leases and claims as many due jobs as there are idle workers. Returns False if every worker
+    # is busy, a finishing job wakes the poller.
+    def claimDueJobs(self) -> bool:
+        with self.condition:
+            holding = len(self.running)
+        now = clock.time()
+        if holding > 0:
+            self.dbWriter.write(sql.renewJobLeases, self.owner, now + JOB_LEASE_SECONDS)
+        if holding >= self.workers:
+            return False
+
+        jobs = self.dbWriter.write(sql.claimJobs, self.owner, now, now + JOB_LEASE_SECONDS, self.workers - holding)
+        if len(jobs) == 0:
+            return True
+
+        with self.condition:
+            self.running.update((jobType, postID) for jobType, postID, reviewState, attempts in jobs)
+        try:
+            items = self.fetch(list({postID for jobType, postID, reviewState, attempts in jobs}))
+        except Exception as e:
+            self.logger.warning(f"Unable to fetch the posts of {len(jobs)} claimed jobs")
+            self.logger.warning(e)
+            for job in jobs:
+                self.finish(job, e)
+            return True
+
+        for job in jobs:
+            self.executor.submit(self.runJob, job, items.get(job[1]))
+        return True
+
+    def runJob(self, job: tuple, item):
+        jobType, postID, reviewState, attempts = job
+        if attempts > JOB_MAX_ATTEMPTS:
+            self.finish(job, RuntimeError(f"claimed {attempts} times"))
+            return
+        try:
+            with metrics.registry.timer("bot_job_seconds", type=jobType):
+                self.handlers[jobType](postID, item, reviewState)
+        except Exception as e:
+            self.finish(job, e)
+            return
+        self.finish(job)
+
+    # Deletes a job that is done, or that failed too often, and gives other failed jobs back to be retried
+    def finish(self, job: tuple, exception: Exception = None):
+        jobType, postID, reviewState, attempts = job
+        try:
+            if exception is None:
+                if not self.dbWriter.write(sql.completeJob, jobType, postID, self.owner):
+                    self.logger.warning("Lost the lease on the %s job of %s before it finished", jobType, postID)
+                metrics.registry.count("bot_jobs_total", type=jobType, result="done")
+            elif attempts >= JOB_MAX_ATTEMPTS:
+                self.logger.error(f"Giving up on the {jobType} job of {postID} after {attempts} attempts")
+                self.logger.error(exception)
+                self.dbWriter.write(sql.completeJob, jobType, postID, self.owner)
+                metrics.registry.count("bot_jobs_total", type=jobType, result="abandoned")
+            else:
+                self.logger.warning(f"The {jobType} job of {postID} failed. It will be retried.")
+                self.logger.warning(exception)
+                self.dbWriter.write(sql.releaseJob, jobType, postID, self.owner,
+                                    clock.time() + JOB_RETRY_DELAY * attempts)
+                metrics.registry.count("bot_jobs_total", type=jobType, result="retried")
+        finally:
+            with self.condition:
+                self.running.discard((jobType, postID))
+            self.wake()
@@ -1,11 +1,28 @@
 import math
 import sqlite3
 import threading
-import time
 import logging
+import logging.handlers
 
+import botlog
+import clock
+import metrics
 import sql
 import notifier
+import asyncengine
+from checkpoints import Checkpoints
+from dbwriter import DBWriter
+from deadlines import DeadlineQueue
+from editcoalescer import EditCoalescer, loadBody
+from jobqueue import JobQueue
+from commenttree import CommentTreeInspector
+from postcache import PostCache
+from ratelimit import APIBudget, PRIORITY_REMOVAL, PRIORITY_REPLY, PRIORITY_EDIT
+from scheduler import Scheduler
+from seenfilter import SeenFilter
+from shardpool import ShardPool
+from submissioncache import SubmissionCache
+from tenants import Tenant, Tenants
 
 import praw
 from prawcore import ServerError
@@ -68,12 +85,75 @@ NO_VOTE_FLAIR_TEXTS = ["Discussion/Question !?", "Funny Friday", "SAFETY - NSFW
 # If the title contains any of the following it will not be voted on
 NO_VOTE_TITLE_TEXTS = ["?"]
 
+# Number of worker threads that carry out review passes. Pending reviews wait in the jobs table, not in threads
+REVIEW_WORKERS = 4
+
+# Job types of the two review passes in the jobs table (see jobqueue.py)
+FIRST_REVIEW_JOB = "firstReview"
+SECOND_REVIEW_JOB = "secondReview"
+
+# Seconds between persistence passes (300s = 5m)
+PERSISTENCE_INTERVAL = 300
+
+# Seconds between resyncs of the voting deadlines with the DB (3600s = 1h). Voting closes at each post's deadline
+# regardless, the resync only picks up posts the deadline queue was never told about
+VOTING_INTERVAL = 3600
+
+# Number of worker threads that close voting when a deadline comes
+VOTING_WORKERS = 2
+
+# Seconds the voting loop waits on startup so voting actions and persistence actions are staggered
+VOTING_STAGGER = 30
+
+# How the bot loops are run: "threaded" gives each loop its own thread, "asyncio" runs them all as coroutines on one
+# event loop with blocking Reddit and database calls moved to worker threads. "worker" runs no loops and only takes
+# review jobs from the shared database, so extra processes can be started next to one threaded or asyncio process.
+RUNTIME = "threaded"
+
+# Minimum seconds between edits of a post's voting table. Votes cast in between are shown together in the next edit
+VOTE_TABLE_EDIT_INTERVAL = 30
+
+# Threads that count votes. The comment stream hands each vote to one of them by submission ID, so votes on a post are
+# counted in order and a slow API call only holds up the posts on its thread. 0 counts votes on the stream's thread.
+COMMENT_SHARDS = 4
+
+# Votes each of those threads may have waiting before the comment stream waits for it
+COMMENT_SHARD_QUEUE_SIZE = 100
+
+# Seconds that fetched submission metadata stays valid for. Review passes invalidate it when they start anyway
+SUBMISSION_CACHE_TTLS = {"flair": 60, "duplicates": 60, "score": 60}
+
+# Most submissions looked up per request to Reddit's info endpoint (Reddit's own limit is 100)
+INFO_BATCH_SIZE = 100
+
+# Items per listing request when catching up after downtime (Reddit's own limit is 100)
+BACKFILL_PAGE_SIZE = 100
+
+# Seconds the seen filter remembers a handled item for
+SEEN_FILTER_WINDOW = 86400
+
+# Local port the metrics are served on (Prometheus text format). None to disable
+METRICS_PORT = 9465
+
+# File the metrics are written to every METRICS_INTERVAL seconds. None to disable
+METRICS_FILE = "metrics.prom"
+METRICS_INTERVAL = 60
+
 # Location of the log file
 LOG_FILE = "bot.log"
 
+# Size in bytes the log file is rotated at and rotated files kept
+LOG_MAX_BYTES = 10_000_000
+LOG_BACKUPS = 5
+
 # Level of detail for the logger: logging.DEBUG, logger.INFO, or logger.WARNING
 LOGGING_LEVEL = logging.DEBUG
 
+# Debug records let through per call site every LOG_SAMPLE_WINDOW seconds. Keeps per comment and per vote lines from
+# flooding the log
+LOG_SAMPLE_LIMIT = 20
+LOG_SAMPLE_WINDOW = 60
+
 # Command prefix for flair voting. Do not use uppercase letters.
 COMMAND_PREFIX = "!"
 
@@ -88,9 +168,17 @@ VOTING_DICTIONARY = {"yes": "Beginner", "no": "Not Beginner"}
 VOTING_COMMANDS = list(VOTING_DICTIONARY.keys())
 VOTING_OPTIONS = list(VOTING_DICTIONARY.values())
 
+# Subreddits served by this process, each mapped to the settings it changes from the ones above (named like the
+# arguments of tenants.Tenant), e.g.
+# SUBREDDITS = {"BeginnerWoodWorking": {}, "turning": {"standardReply": "...", "noVoteFlairTexts": []}}
+# Their submissions and comments come through one combined stream and they share the DB, threads and API budget. The
+# first one gets the messages sent to the bot.
+SUBREDDITS = {SUBREDDIT: {}}
+
 
 def stripVotingTableFromBody(body: str) -> str:
-    return body[:body.find("|")]
+    tableStart = body.find("|")
+    return body if tableStart == -1 else body[:tableStart]
 
 
 def createBodyWithNewVotingTable(connection: sqlite3.Connection, submission: praw.models.Submission, body: str) -> str:
@@ -100,7 +188,7 @@ def createBodyWithNewVotingTable(connection: sqlite3.Connection, submission: pra
     # Trim existing table
     body = stripVotingTableFromBody(body)
 
-    votes = sql.fetchVotes(connection, submission.id)
+    votes = postCache.fetchVotes(connection, submission.id)
 
     keys = votes.keys()
     values = votes.values()
@@ -114,30 +202,80 @@ def createBodyWithNewVotingTable(connection: sqlite3.Connection, submission: pra
     return body + table
 
 
+# Makes a Reddit API call once the shared budget allows one of this priority
+def api(priority: int, function, *args, **kwargs):
+    return apiBudget.call(priority, function, *args, **kwargs)
+
+
+# Fetches the submissions in postIDList with one info request per INFO_BATCH_SIZE posts instead of a lazy fetch per post.
+# Returns {postID: submission}. Posts Reddit no longer returns (deleted by the site) are left out.
+def hydrateSubmissions(postIDList: list, priority: int) -> dict:
+    submissions = {}
+    for start in range(0, len(postIDList), INFO_BATCH_SIZE):
+        fullnames = ["t3_" + postID for postID in postIDList[start:start + INFO_BATCH_SIZE]]
+
+        def info():
+            return list(reddit.info(fullnames=fullnames))
+
+        for submission in api(priority, info):
+            submissions[submission.id] = submission
+    return submissions
+
+
+def renderVotingTable(submissionID: str, body: str) -> str:
+    return createBodyWithNewVotingTable(sql.threadConnection(), reddit.submission(id=submissionID), body)
+
+
+# PRAW objects are lazy so these reads are what make the requests. They are named so api counts them by name
+def loadFlairText(submissionID: str) -> str:
+    # Uses a new submission object which ensures it gets the most recent flair
+    return reddit.submission(id=submissionID).link_flair_text
+
+
+def loadDuplicates(submission: praw.models.Submission) -> list:
+    return list(submission.duplicates())
+
+
+# One page of a listing such as subreddit.new, newest first
+def loadListingPage(listing, params: dict) -> list:
+    return list(listing(limit=BACKFILL_PAGE_SIZE, params=dict(params)))
+
+
+def fetchFlairText(submission: praw.models.Submission) -> str:
+    return submissionCache.get(submission.id, "flair", lambda: api(PRIORITY_REPLY, loadFlairText, submission.id))
+
+
+def fetchScore(submission: praw.models.Submission) -> int:
+    return submissionCache.get(submission.id, "score", lambda: submission.score)
+
+
 def isDoubleDipping(submission: praw.models.Submission) -> bool:
     if not submission.is_self:
-        duplicates = submission.duplicates()
+        duplicates = submissionCache.get(submission.id, "duplicates",
+                                         lambda: api(PRIORITY_REMOVAL, loadDuplicates, submission))
         for duplicate in duplicates:
             # This is pretty loose criteria. It intentionally does not check for reposts of other users links.
-            # It also excludes posts made in SUBREDDIT
-            if (duplicate.author == submission.author) and (duplicate.subreddit.id != subreddit.id):
+            # It also excludes posts made in the submission's own subreddit
+            if (duplicate.author == submission.author) and \
+                    (duplicate.subreddit.display_name.lower() != submission.subreddit.display_name.lower()):
                 return True
 
     return False
 
 
 def isAQuestion(submission: praw.models.Submission) -> bool:
-    flairText = reddit.submission(id=submission.id).link_flair_text  # Ensures is gets the most recent flair
+    tenant = tenants.forThing(submission)
+    flairText = fetchFlairText(submission)
     if flairText is None:
         flairText = ""
 
-    mainLogger.debug(f"{submission.title} -> flair = {flairText}")
+    mainLogger.debug("%s -> flair = %s", submission.title, flairText)
 
-    for text in NO_REPLY_TITLE_TEXTS:
+    for text in tenant.noReplyTitleTexts:
         if text in submission.title:
             return True
 
-    if flairText in NO_REPLY_FLAIR_TEXTS:
+    if flairText in tenant.noReplyFlairTexts:
         return True
 
     return False
@@ -145,37 +283,38 @@ def isAQuestion(submission: praw.models.Submission) -> bool:
 
 def removeDoubleDippers(connection: sqlite3.Connection, submission: praw.models.Submission, logger: logging.Logger):
     try:
-        reply = submission.reply(DOUBLE_DIPPING_REPLY)
-        reply.mod.distinguish(how="yes", sticky=True)
+        reply = api(PRIORITY_REMOVAL, submission.reply, tenants.forThing(submission).doubleDippingReply)
+        api(PRIORITY_REMOVAL, reply.mod.distinguish, how="yes", sticky=True)
 
         if (submission.author is not None) and (submission.title is not None) and CREATE_MOD_MAIL:
             subject = "Removed double dipping post (Rule #4)"
             body = f"Automatically removed post \"[{submission.title}]({submission.permalink})\" " \
                    f"by u/{submission.author.name} for rule #4 violation. "
-            sql.insertBotMessageIntoDB(connection, subject, body)
-            logger.debug(f"Inserted mod mail into the db for submission: {submission.title}")
+            dbWriter.write(sql.insertBotMessageIntoDB, subject, body, submission.subreddit.display_name)
+            logger.debug("Inserted mod mail into the db for submission: %s", submission.title)
     except Exception as e:
         logger.warning("Unable to send modmail")
         logger.warning("Printing stack trace")
         logger.warning(e)
     finally:
-        submission.mod.remove()
-        logger.info(f"=== Removed post by u/{submission.author}: \"{submission.title}\" for double dipping. "
-                    f"ID = {submission.id}")
+        api(PRIORITY_REMOVAL, submission.mod.remove)
+        logger.info("=== Removed post by u/%s: \"%s\" for double dipping. ID = %s", submission.author,
+                    submission.title, submission.id)
 
 
 def findVotingEligibility(submission: praw.models.Submission, logger: logging.Logger):
-    flairText = reddit.submission(id=submission.id).link_flair_text  # Ensures is gets the most recent flair
+    tenant = tenants.forThing(submission)
+    flairText = fetchFlairText(submission)
     if flairText is None:
         flairText = ""
 
-    mainLogger.debug(f"{submission.title} -> flair = {flairText}")
+    mainLogger.debug("%s -> flair = %s", submission.title, flairText)
 
-    for text in NO_VOTE_TITLE_TEXTS:
+    for text in tenant.noVoteTitleTexts:
         if text in submission.title:
             return False
 
-    if flairText in NO_VOTE_FLAIR_TEXTS:
+    if flairText in tenant.noVoteFlairTexts:
         False
 
     return True
@@ -186,13 +325,13 @@ def firstReviewPass(submission: praw.models.Submission, connection: sqlite3.Conn
         logger.debug("Submission is None. Ignoring.")
         return False
 
-    logger.info(f"Working on \"{submission.title}\" by u/{submission.author}. ID = {submission.id}")
+    logger.info("Working on \"%s\" by u/%s. ID = %s", submission.title, submission.author, submission.id)
 
     # TODO add shit for voting
 
     # Give standard reply for posts that aren't questions
     if isAQuestion(submission):
-        logger.info(f"Gave no reply to \"{submission.title}\" by u/{submission.author}.")
+        logger.info("Gave no reply to \"%s\" by u/%s.", submission.title, submission.author)
         return False
 
     # Check for double dipping (first pass)
@@ -201,22 +340,26 @@ def firstReviewPass(submission: praw.models.Submission, connection: sqlite3.Conn
         return False
 
     # Actions to perform if the post is not double dipping and is not a question
-    body = STANDARD_REPLY
+    tenant = tenants.forThing(submission)
+    body = tenant.standardReply
     votingEligibility = findVotingEligibility(submission, logger)
-    logger.info(f"Gave standard reply to \"{submission.title}\" by u/{submission.author}.")
-    reply = submission.reply(body)
-    reply.mod.distinguish(how="yes", sticky=True)
-    reply.downvote()
+    logger.info("Gave standard reply to \"%s\" by u/%s.", submission.title, submission.author)
+    reply = api(PRIORITY_REPLY, submission.reply, body)
+    api(PRIORITY_REPLY, reply.mod.distinguish, how="yes", sticky=True)
+    api(PRIORITY_REPLY, reply.downvote)
 
-    # Add to db
-    sql.insertSubmissionIntoDB(connection, submission, reply, VOTING_OPTIONS, votingEligibility)
-    sql.incrementReviewState(connection, submission.id)
+    # Add to db and index the reply so votes on it can be recognised
+    dbWriter.write(sql.insertSubmissionIntoDB, submission, reply, tenant.votingOptions, votingEligibility)
+    dbWriter.write(sql.incrementReviewState, submission.id)
+    postCache.record(connection, submission.id)
 
     # If the post is voteable then it adds the voting text and the voting table
     if votingEligibility:
-        logger.info(f"\"{submission.title}\" by u/{submission.author} is voteable. Adding voting text and vote table")
-        body = createBodyWithNewVotingTable(connection, submission, body + VOTING_TEXT)
-        reply.edit(body)
+        logger.info("\"%s\" by u/%s is voteable. Adding voting text and vote table", submission.title,
+                    submission.author)
+        body = createBodyWithNewVotingTable(connection, submission, body + tenant.votingText)
+        api(PRIORITY_REPLY, reply.edit, body)
+        voteTableEditor.noteBody(submission.id, body)
 
     return True
 
@@ -226,11 +369,14 @@ def secondReviewPass(submission: praw.models.Submission, connection: sqlite3.Con
         logger.debug("Submission is None. Ignoring.")
         return False
 
+    # Anything fetched before this pass is out of date
+    submissionCache.invalidate(submission.id)
+
     # Check for double dipping and remove submission if needed
     if isDoubleDipping(submission):
         removeDoubleDippers(connection, submission, logger)
         # Remove post from SQL DB
-        sql.removePostFromDB(connection, submission)
+        dbWriter.write(sql.removePostFromDB, submission)
         return False
 
     # Fetch the replyID from database
@@ -241,70 +387,64 @@ def secondReviewPass(submission: praw.models.Submission, connection: sqlite3.Con
         return False
 
     # Un-sticky standard reply if it is not voteable. Keep the standard reply and update if it is voteable
+    tenant = tenants.forThing(submission)
     votingEligibility = findVotingEligibility(submission, logger)
     reply = reddit.comment(replyID)
-    logger.debug(f"Voting eligibility -> {votingEligibility}")
+    logger.debug("Voting eligibility -> %s", votingEligibility)
 
     if votingEligibility:
-        logger.info(f"Did not un-sticky standard reply on \"{submission.title}\" by u/{submission.author} (voteable)")
-        body = reply.body
+        logger.info("Did not un-sticky standard reply on \"%s\" by u/%s (voteable)", submission.title,
+                    submission.author)
+        body = api(PRIORITY_REPLY, loadBody, reply)
 
         # Add the voting text if it's not there already
-        if VOTING_TEXT not in body:
-            body = body + VOTING_TEXT
+        if tenant.votingText not in body:
+            body = body + tenant.votingText
 
         # Add the voting table
         body = createBodyWithNewVotingTable(connection, submission, body)
 
-        logger.info(f"Edited standard reply on \"{submission.title}\" by u/{submission.author} to include voting")
-        reply.edit(body)
+        logger.info("Edited standard reply on \"%s\" by u/%s to include voting", submission.title, submission.author)
+        api(PRIORITY_REPLY, reply.edit, body)
+        voteTableEditor.noteBody(submission.id, body)
 
         # Grant voting eligibility
-        sql.updateVotingEligibility(connection, submission.id, True)
+        postCache.updateVotingEligibility(connection, submission.id, True)
 
     else:
+        # Drop any vote table edit still waiting so it can't put the table back
+        voteTableEditor.forget([submission.id])
+
         # Un-sticky reply
-        logger.info(f"Un-stickied standard reply on \"{submission.title}\" by u/{submission.author}")
-        reply.mod.undistinguish()
-        reply.mod.distinguish(how="yes", sticky=False)
+        logger.info("Un-stickied standard reply on \"%s\" by u/%s", submission.title, submission.author)
+        api(PRIORITY_REPLY, reply.mod.undistinguish)
+        api(PRIORITY_REPLY, reply.mod.distinguish, how="yes", sticky=False)
 
         # Remove voting table and voting text
-        logger.info(f"Edited standard reply on \"{submission.title}\" by u/{submission.author} to remove voting")
-        reply.edit(STANDARD_REPLY)
+        logger.info("Edited standard reply on \"%s\" by u/%s to remove voting", submission.title, submission.author)
+        api(PRIORITY_REPLY, reply.edit, tenant.standardReply)
 
     # Update the voting eligibility
-    sql.updateVotingEligibility(connection, submission.id, votingEligibility)
+    postCache.updateVotingEligibility(connection, submission.id, votingEligibility)
 
-    # Assumes the oldest top level comment by the poster is the writeup
+    # A top level comment by the poster is assumed to be the writeup
     # If the writeup exists, the standard reply should be deleted (assuming it has no children)
-    oldestOPComment = None
-    submission.comments.replace_more(limit=None)
-    topComments = submission.comments
-    # iterates through top level comments and finds the oldest one by the poster
-    for comment in topComments:
-        if comment.is_submitter:
-            if oldestOPComment is None:
-                oldestOPComment = comment
-            elif oldestOPComment.created_utc > comment.created_utc:
-                oldestOPComment = comment
-
-    # Remove standard reply if it has no children
-    deleteFlag = True
-    comments = submission.comments.list()
-    for comment in comments:
-        if comment.parent_id == ("t1_" + reply.id):
-            deleteFlag = False
-            break
+    # The reply of a voteable post is kept either way so its comments don't need to be looked at
+    replyHasChildren = True
+    posterHasTopLevelComment = False
+    if not votingEligibility:
+        replyHasChildren, posterHasTopLevelComment = commentInspector.inspect(submission, reply)
 
-    if (deleteFlag) and (oldestOPComment is not None) and (not votingEligibility):
-        reply.mod.remove()
-        logger.info(f"Deleted standard reply on \"{submission.title}\" by u/{submission.author}. ID = {submission.id}")
+    if (not replyHasChildren) and posterHasTopLevelComment and (not votingEligibility):
+        api(PRIORITY_REPLY, reply.mod.remove)
+        logger.info("Deleted standard reply on \"%s\" by u/%s. ID = %s", submission.title, submission.author,
+                    submission.id)
 
     # Message
-    logger.info(f"Finished second review on \"{submission.title}\" by u/{submission.author}. ID = {submission.id}")
+    logger.info("Finished second review on \"%s\" by u/%s. ID = %s", submission.title, submission.author, submission.id)
 
     # Increment review state
-    sql.incrementReviewState(connection, submission.id)
+    dbWriter.write(sql.incrementReviewState, submission.id)
     return True
 
 
@@ -313,42 +453,47 @@ def votingAction(submission: praw.models.Submission, connection: sqlite3.Connect
         logger.debug("Submission is None. Ignoring.")
         return False
 
-    if not sql.isVoteable(connection, submission.id):
+    if not postCache.isVoteable(connection, submission.id):
         logger.error(f"Tried to do a voting action on a submission that was not voteable: {submission.title}")
         return False
 
-    logger.debug(f"Doing voting action on: {submission.title}")
+    logger.debug("Doing voting action on: %s", submission.title)
+    submissionCache.invalidate(submission.id)
+
+    # Make any vote table edit that is still waiting now so it can't land after the closing edit
+    voteTableEditor.close(submission.id)
 
     # Lock the comment and strip table (voting is already disabled but it makes it obvious for users)
     commentID = sql.fetchCommentIDFromDB(connection, submission)
     comment = reddit.comment(id=commentID)
 
-    commentBody = STANDARD_REPLY + VOTING_CLOSED_TEXT
-    comment.edit(commentBody)
+    tenant = tenants.forThing(submission)
+    commentBody = tenant.standardReply + tenant.votingClosedText
+    api(PRIORITY_EDIT, comment.edit, commentBody)
     try:
-        comment.mod.lock()
-        comment.mod.undistinguish()
-        comment.mod.distinguish(how="yes", sticky=False)
+        api(PRIORITY_EDIT, comment.mod.lock)
+        api(PRIORITY_EDIT, comment.mod.undistinguish)
+        api(PRIORITY_EDIT, comment.mod.distinguish, how="yes", sticky=False)
     except Exception as e:
         logger.debug("Unable to unsticky reply")
         logger.debug(e)
 
 
     # Get the votes
-    votes = sql.fetchVotes(connection, submission.id)
+    votes = postCache.fetchVotes(connection, submission.id)
 
     # Determine the result of the vote
-    upvotes = submission.score
+    upvotes = fetchScore(submission)
     threshold = math.floor((-1/90)*upvotes) - 2
     # If the score is below threshold the post will be removed
-    score = votes["Beginner"] - votes["Not Beginner"]
+    score = votes[tenant.keepOption] - votes[tenant.removeOption]
     removePost = score <= threshold
 
-    logger.debug(f"Remove {submission.title} due to voting?: removePost = {removePost}")
+    logger.debug("Remove %s due to voting?: removePost = %s", submission.title, removePost)
 
     # Actions to take
     if removePost:
-        submission.mod.remove()
+        api(PRIORITY_REMOVAL, submission.mod.remove)
 
         # Send mod mail
         try:
@@ -358,8 +503,8 @@ def votingAction(submission: praw.models.Submission, connection: sqlite3.Connect
                        f"has been removed due to community voting. \n\n" \
                        f"Results: {str(votes)} \n\n" \
                        f"Score required for removal: {threshold}"
-                sql.insertBotMessageIntoDB(connection, subject, body)
-                logger.debug(f"Inserted mod mail into the db for submission: {submission.title}")
+                dbWriter.write(sql.insertBotMessageIntoDB, subject, body, submission.subreddit.display_name)
+                logger.debug("Inserted mod mail into the db for submission: %s", submission.title)
         except Exception as e:
             logger.warning("Unable to send mod mail")
             logger.warning("Printing stack trace")
@@ -368,43 +513,70 @@ def votingAction(submission: praw.models.Submission, connection: sqlite3.Connect
         # Actions if the post is not to be removed
         pass
 
-    logger.info(f"VOTING: Did voting action on {submission.title} by u/{submission.author}")
+    logger.info("VOTING: Did voting action on %s by u/%s", submission.title, submission.author)
 
-    sql.incrementReviewState(connection, submission.id)
+    dbWriter.write(sql.incrementReviewState, submission.id)
 
     return True
 
 
-def review(submission: praw.models.Submission, logger: logging.Logger):
-    connection = sql.createDBConnection(sql.DB_FILE)
+# Runs the first pass of a FIRST_REVIEW_JOB. A post already in the DB had its first pass before the job was interrupted
+# (or the job was delivered again). Either way the second pass is only queued while it is still to come (ReviewState 1)
+def firstReview(postID: str, submission: praw.models.Submission, reviewState, logger: logging.Logger):
+    connection = sql.threadConnection()
+    if sql.isPostInDB(connection, postID):
+        logger.info("First review of %s already done", postID)
+    else:
+        metrics.registry.mark("bot_submissions_reviewed")
+        if not firstReviewPass(submission, connection, logger):
+            return
+
+    reviewState = sql.fetchReviewState(connection, postID)
+    if reviewState != 1:
+        logger.info("Second review of %s already done or no longer needed", postID)
+        return
+
+    # Waiting for PASS_DELAY seconds allows the bot to pick up on double dippers if they post in other subreddits
+    # after posting in beginner wood working. Also allows the standard reply to be removed to cut down on spam.
+    jobQueue.add(SECOND_REVIEW_JOB, postID, clock.time() + PASS_DELAY, reviewState)
+
 
-    if firstReviewPass(submission, connection, logger):
-        # Waiting for PASS_DELAY seconds allows the bot to pick up on double dippers if they post in other subreddits
-        # after posting in beginner wood working. Also allows the standard reply to be removed to cut down on spam.
-        time.sleep(PASS_DELAY)
+# Runs the second pass of a SECOND_REVIEW_JOB unless the post has moved on (or gone) since the job was queued. The
+# submission was fetched when the job was claimed so the second pass sees its current state
+def secondReview(postID: str, submission: praw.models.Submission, reviewState, logger: logging.Logger):
+    connection = sql.threadConnection()
+    if sql.fetchReviewState(connection, postID) != reviewState:
+        logger.info("Second review of %s already done or no longer needed", postID)
+        return
+    secondReviewPass(submission, connection, logger)
 
-        secondReviewPass(submission, connection, logger)
+
+def handleSubmission(submission: praw.models.Submission, logger: logging.Logger):
+    if submission is None:
+        logger.debug("Submission is None. Ignoring.")
+        return
+    metrics.registry.heartbeat("main", clock.time() - submission.created_utc)
+
+    if tenants.forThing(submission) is None:
+        logger.debug("Skipping submission %s: not in a served subreddit.", submission.id)
+        return
+
+    # skip self posts
+    if submission.is_self:
+        logger.info("Skipping submission %s: submission is self.", submission.title)
+        return
+
+    # Queue a review of the post. The second pass is queued by the first one.
+    jobQueue.add(FIRST_REVIEW_JOB, submission.id, clock.time())
+    logger.debug("Queued review for %s", submission.title)
 
 
 def main(logger: logging.Logger):
     while True:
         logger.debug("Starting submission stream.")
         try:
-            for submission in subreddit.stream.submissions(skip_existing=True):
-                if submission is None:
-                    logger.debug("Submission is None. Ignoring.")
-                    continue
-
-                # skip self posts
-                if submission.is_self:
-                    logger.info(f"Skipping submission {submission.title}: submission is self.")
-                    continue
-
-                # Start a review of the post in it's own thread.
-                logger.debug(f"Making thread for {submission.title}")
-                thread = threading.Thread(target=review, args=[submission, logger])
-                thread.start()
-                logger.debug(f"made thread for {submission.title}")
+            for submission in liveStream("submissions", subreddit.stream.submissions):
+                handleSubmission(submission, logger)
 
         except ServerError as e:
             logger.error("Reddit server error. Restarting submission stream.")
@@ -421,92 +593,201 @@ def main(logger: logging.Logger):
             logger.error("Restarting submission stream")
 
 
-def persistence(logger: logging.Logger):
-    # Persistence does not handle messages sent during downtime
-    connection = sql.createDBConnection(sql.DB_FILE)
-
-    # Add posts that were created during downtime (up to PASS_DELAY seconds ago) to the SQL DB
-    # Submissions that were made during the downtime will only get the second review pass.
-    postIDList = sql.fetchAllPostIDsFromDB(connection)
-    filterTime = time.time() - PASS_DELAY
-    for submission in subreddit.stream.submissions(pause_after=0):
-        # Exit when complete
-        if submission is None:
+# Passes on the items of a live stream that come after the stream's checkpoint and moves the checkpoint past each one
+# once the loop body is done with it (or raised). Reddit streams begin with up to 100 recent items so whatever was
+# posted while a stream restarted, or between the backfill and the stream starting, is picked up without repeats.
+def checkpointed(name: str, stream):
+    for item in stream:
+        if (item is not None) and alreadyHandled(name, item):
+            continue
+        try:
+            yield item
+        finally:
+            if item is not None:
+                checkpoints.advance(name, item)
+
+
+# True if item is at or behind its stream's checkpoint, or the seen filter has had it before (delivered twice, or out of
+# ID order). Otherwise the seen filter remembers it. The filter keeps exact IDs so a new item is never taken for a seen
+# one.
+def alreadyHandled(name: str, item) -> bool:
+    if not checkpoints.isNew(name, item):
+        return True
+    if seenFilter.seenBefore(item.name):
+        metrics.registry.count("bot_duplicate_items_total", stream=name)
+        mainLogger.debug("Skipping %s from the %s stream: already handled", item.name, name)
+        return True
+    return False
+
+
+# The live stream of name. Without a checkpoint (the first run) the recent items are skipped as they always were
+def liveStream(name: str, streamFunction):
+    return checkpointed(name, streamFunction(skip_existing=not checkpoints.has(name)))
+
+
+# Pages back through listing (newest first) to the checkpoint of name, stopping early at items posted before oldest,
+# then hands the items to handler oldest first. Reddit listings only reach back about 1000 items.
+def backfillStream(name: str, listing, handler, logger: logging.Logger, oldest: float = None):
+    if (not checkpoints.has(name)) and (oldest is None):
+        logger.info("No checkpoint for %s, nothing to backfill", name)
+        return
+
+    start = clock.time()
+    items = []
+    newest = None
+    params = {}
+    try:
+        while True:
+            page = api(PRIORITY_REPLY, loadListingPage, listing, params)
+            if newest is None and len(page) > 0:
+                newest = page[0]
+            for item in page:
+                if (not checkpoints.isNew(name, item)) or ((oldest is not None) and (item.created_utc < oldest)):
+                    break
+                items.append(item)
+            else:
+                if len(page) == BACKFILL_PAGE_SIZE:
+                    params = {"after": page[-1].name}
+                    continue
             break
+    except Exception as e:
+        logger.warning(f"Unable to page through {name} for the backfill. The live stream will pick up what it can.")
+        logger.warning(e)
+        return
 
-        # skip self posts
-        if submission.is_self:
+    for item in reversed(items):
+        if alreadyHandled(name, item):
             continue
+        try:
+            handler(item)
+        except Exception as e:
+            logger.warning(f"Unable to handle {item.name} from the {name} backfill. It will be skipped.")
+            logger.warning(e)
+        checkpoints.advance(name, item)
+
+    # Items too old to handle are passed over so the live stream doesn't pick them up either
+    if newest is not None:
+        checkpoints.advance(name, newest)
+
+    seconds = clock.time() - start
+    metrics.registry.observe("bot_backfill_seconds", seconds, stream=name)
+    metrics.registry.count("bot_backfill_items_total", len(items), stream=name)
+    logger.info("Backfilled %s %s in %.1fs", len(items), name, seconds)
+
+
+# Catches up on everything posted since the checkpoints before the live streams start. The three streams are paged in
+# parallel. Only submissions from the last PASS_DELAY seconds are reviewed, replying to older ones is a bad idea. On the
+# first run there are no checkpoints and only those recent submissions are looked at.
+def backfill(logger: logging.Logger):
+    start = clock.time()
+    threads = [
+        threading.Thread(target=backfillStream, args=["submissions", subreddit.new,
+                                                      lambda submission: handleSubmission(submission, logger), logger,
+                                                      clock.time() - PASS_DELAY]),
+        threading.Thread(target=backfillStream, args=["comments", subreddit.comments,
+                                                      lambda comment: handleComment(comment, sql.threadConnection(),
+                                                                                    logger), logger]),
+        threading.Thread(target=backfillStream, args=["inbox", reddit.inbox.messages,
+                                                      lambda message: handleMessage(message, sql.threadConnection(),
+                                                                                    logger), logger]),
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    logger.info("Backfill finished in %.1fs", clock.time() - start)
+
+
+def persistencePass(connection: sqlite3.Connection, logger: logging.Logger):
+    metrics.registry.heartbeat("persistence", interval=PERSISTENCE_INTERVAL)
+    logger.info("Submission cache: %s", submissionCache.stats())
+    logger.info("API budget: %s", apiBudget.stats())
+    logger.info("Comment inspection: %s", commentInspector.stats())
+    if commentShards is not None:
+        logger.info("Comment shards: %s", commentShards.stats())
+    if sql.queryProfiler is not None:
+        logger.info("Query profile: %s", sql.queryProfiler.stats())
+    logger.info("Review jobs: %s queued, %s running here", jobQueue.pending(), len(jobQueue.running))
+    logger.info("Seen filter: %s", seenFilter.stats())
+    dbWriter.write(sql.saveSeenItems, seenFilter.snapshot(), clock.time() - SEEN_FILTER_WINDOW)
+    dbWriter.write(sql.removeExpiredPostsFromDB)
 
-        # Add all posts made in the last PASS_DELAY seconds and not already in the database into the database
-        # Changing the algorithm to add posts made before PASS_DELAY seconds is a bad idea
-        if (submission.id not in postIDList) and (submission.created_utc > filterTime):
-            logger.info(f"Missed during downtime: {submission.title} {submission.id}. Adding...")
-            sql.insertSubmissionIntoDB(connection, submission, "", VOTING_OPTIONS,
-                                       findVotingEligibility(submission, logger))
+
+def persistence(logger: logging.Logger):
+    connection = sql.threadConnection()
 
     while True:
         try:
-            sql.removeExpiredPostsFromDB(connection)
-            postIDList = sql.fetchUnreviewedPostsFromDB(connection)
-            for postID in postIDList:
-                submission = reddit.submission(postID)
-                if submission is not None:
-                    secondReviewPass(submission, connection, logger)
-                time.sleep(5)  # Throttles the bot some to avoid hitting the rate limit
-
-            time.sleep(300)  # No need to query the DB constantly doing persistence checks. 300s = 5m
+            persistencePass(connection, logger)
+            clock.sleep(PERSISTENCE_INTERVAL)  # No need to query the DB constantly doing persistence checks
         except Exception as e:
             logger.warning("The persistence thread raised an exception. It will try to continue.")
             logger.warning("Printing stack strace...")
             logger.warning(e)
 
 
+# Closes voting on the posts in postIDList. votingDeadlines calls this when their VotingTime comes
+def closeVoting(postIDList: list, logger: logging.Logger):
+    connection = sql.threadConnection()
+    submissions = hydrateSubmissions(postIDList, PRIORITY_EDIT)
+    for postID in postIDList:
+        try:
+            logger.debug(postID)
+            submission = submissions.get(postID)
+            if submission is not None:
+                if postCache.isVoteable(connection, submission.id):
+                    votingAction(submission, connection, logger)
+            logger.debug("Processed voting on %s", submission)
+        except Exception as innerException:
+            logger.warning(f"There was an issue processing voting for post {postID}")
+            logger.warning("The post was removed from the database and will not be processed")
+            logger.warning("Printing stack strace...")
+            logger.warning(innerException)
+        dbWriter.write(sql.removePostByIDFromDB, postID)
+
+
+# Closures run from votingDeadlines at each post's deadline. A pass only resyncs the deadlines with the DB and closes
+# anything that is overdue
+def votingPass(connection: sqlite3.Connection, logger: logging.Logger):
+    metrics.registry.heartbeat("voting", interval=VOTING_INTERVAL)
+    votingDeadlines.load(sql.threadConnection(readOnly=True))
+    logger.info("Voting deadlines: %s", votingDeadlines.stats())
+
+
 # This does the actions after a vote finishes.
 def voting(logger: logging.Logger):
-    connection = sql.createDBConnection(sql.DB_FILE)
+    connection = sql.threadConnection()
 
-    time.sleep(30)  # staggers voting actions and persistence actions
+    clock.sleep(VOTING_STAGGER)  # staggers voting actions and persistence actions
 
     while True:
         try:
-            postIDList = sql.fetchPostsNeedingVotingFromDB(connection)
-            for postID in postIDList:
-                try:
-                    logger.debug(postID)
-                    submission = reddit.submission(id=postID)
-                    if submission is not None:
-                        if sql.isVoteable(connection, submission.id):
-                            votingAction(submission, connection, logger)
-                        sql.removePostFromDB(connection, submission)
-                    logger.debug(f"Processed voting on {submission}")
-                    time.sleep(5)  # Throttles the bot some to avoid hitting the rate limit
-                except Exception as innerException:
-                    logger.warning(f"There was an issue processing voting for post {postID}")
-                    logger.warning("The post was removed from the database and will not be processed")
-                    logger.warning("Printing stack strace...")
-                    logger.warning(innerException)
-                    sql.removePostFromDB(connection, submission)
-
-            time.sleep(300)  # No need to query the DB constantly doing voting. 300s = 5m
+            votingPass(connection, logger)
+            clock.sleep(VOTING_INTERVAL)
         except Exception as outerException:
             logger.warning("The voting thread raised an exception. It will try to continue.")
             logger.warning("Printing stack strace...")
             logger.warning(outerException)
 
 
+def handleMessage(message: praw.models.Message, connection: sqlite3.Connection, logger: logging.Logger):
+    metrics.registry.heartbeat("messagePasser", clock.time() - message.created_utc)
+
+    # Skip replies of comments
+    if message.was_comment:
+        return
+    logger.info("Got message \"%s\" from u/%s", message.subject, message.author.name)
+    dbWriter.write(sql.insertUserMessageIntoDB, message)
+
+
 def messagePasser(logger: logging.Logger):
-    connection = sql.createDBConnection(sql.DB_FILE)
+    connection = sql.threadConnection()
 
     while True:
         logger.debug("Starting inbox stream")
         try:
-            for message in reddit.inbox.stream(skip_existing=True):
-                # Skip replies of comments
-                if message.was_comment:
-                    continue
-                logger.info(f"Got message \"{message.subject}\" from u/{message.author.name}")
-                sql.insertUserMessageIntoDB(connection, message)
+            for message in liveStream("inbox", reddit.inbox.stream):
+                handleMessage(message, connection, logger)
 
         except ServerError as e:
             logger.error("Reddit server error. Restarting message stream.")
@@ -523,85 +804,98 @@ def messagePasser(logger: logging.Logger):
             logger.error("Restarting message stream")
 
 
+def handleComment(comment: praw.models.Comment, connection: sqlite3.Connection, logger: logging.Logger):
+    if comment is None:
+        logger.debug("Comment is None - ignoring")
+        return
+    metrics.registry.heartbeat("commentStream", clock.time() - comment.created_utc)
+
+    # Check if the comment is a reply to a live bot reply, that voting has not ended, and that the submission is
+    # voteable. Bot replies are indexed locally by fullname so none of this needs an API call.
+    record = postCache.findByReply(comment.parent_id)
+
+    # TODO find a better way to accommodate mobile users and autocorrect
+    # and (comment.body.lower().startswith(COMMAND_PREFIX)) \
+    if (record is not None) \
+        and (record.postTime + VOTE_ACTION_DELAY > clock.time()) \
+        and (record.isVoteable):
+
+        if commentShards is not None:
+            commentShards.submit(record.postID, comment, record)
+        else:
+            handleVote(comment, record, connection, logger)
+    else:
+        logger.debug("Did not vote on comment: %s", comment.body)
+
+
+# Counts (or rejects) a vote comment on the post of record and removes the comment. Runs on a commentShards thread
+# when there are any
+def handleVote(comment: praw.models.Comment, record, connection: sqlite3.Connection, logger: logging.Logger):
+    submissionID = record.postID
+
+    # A vote waiting on a shard can run after closeVoting has removed the post. It is removed without being counted
+    if not postCache.isVoteable(connection, submissionID):
+        logger.debug("Voting on %s closed before the vote was counted: %s", submissionID, comment.body)
+        api(PRIORITY_REMOVAL, comment.mod.remove)
+        return
+
+    # Ensure the person is not voting twice
+    if postCache.hasVoted(connection, submissionID, comment.author.name):
+        api(PRIORITY_REMOVAL, comment.mod.remove)
+        return
+
+    # Stop OP from self voting
+    if comment.is_submitter:
+        api(PRIORITY_REMOVAL, comment.mod.remove)
+        return
+
+    # Strip command prefix and whitespace then convert to lower case
+    tenant = tenants.forThing(comment)
+    command = comment.body.replace(COMMAND_PREFIX, "").strip().lower()
+
+    logger.debug("An attempt to vote: \"%s\" is being made", command)
+    # Only count the vote if it was actually for one of the votingOptions (ignore junk)
+    if command in tenant.votingCommands:
+        # Make sure the flair we're voting for exists
+        try:
+            # Cast vote. This records the voter too so they can't vote twice
+            votedOption = tenant.votingDictionary[command]
+            votes = postCache.castVote(connection, submissionID, comment.author.name, votedOption)
+            if len(votes) == 0:
+                # The post was removed since the check above, so there is no voting table left to update
+                logger.debug("Voting on %s closed before the vote was counted: %s", submissionID, comment.body)
+                api(PRIORITY_REMOVAL, comment.mod.remove)
+                return
+            metrics.registry.mark("bot_votes")
+            logger.debug("Votes after voting: %s", votes)
+            logger.info("%s voted for %s in %s by typing %s", comment.author.name, votedOption, comment.link_id,
+                        comment.body, extra={"voter": comment.author.name, "option": votedOption,
+                                             "post": submissionID})
+
+            # Queue an update of the voting table in the bot comment. Edits are coalesced per submission
+            voteTableEditor.markDirty(submissionID, record.replyID)
+
+        except KeyError as e:
+            logger.warning(f"Attempted to cast a vote for an unrecognized options.")
+            logger.warning(f"Command was = {command}")
+            logger.warning(f"Available flairs were: {postCache.fetchVotes(connection, submissionID).keys()}")
+            logger.warning(f"Printing stack stace")
+            logger.warning(e)
+            return
+
+    # Everything's done so delete the comment to avoid clutter
+    api(PRIORITY_REMOVAL, comment.mod.remove)
+    logger.debug("Removed vote comment: %s", comment.body)
+
+
 def commentStream(logger: logging.Logger):
-    connection = sql.createDBConnection(sql.DB_FILE)
+    connection = sql.threadConnection()
 
     while True:
         logger.debug("Starting comment stream.")
         try:
-            for comment in subreddit.stream.comments(skip_existing=True):
-                if (comment is None) or (comment.submission is None):
-                    logger.debug("Comment or comment's submission is None - ignoring")
-                    continue
-
-                submissionID = comment.submission.id
-
-                # Check if the comment is a reply to the bot, the comment is a command, that voting has not ended, and
-                # that the submission is voteable
-                parentID: str = comment.parent_id
-
-                # TODO find a better way to accommodate mobile users and autocorrect
-                # and (comment.body.lower().startswith(COMMAND_PREFIX)) \
-                if (not parentID.startswith("t3_")) \
-                    and (reddit.comment(id=parentID.split("_")[-1]).author == BOT_USERNAME) \
-                    and (comment.submission.created_utc + VOTE_ACTION_DELAY > time.time()) \
-                    and (sql.isVoteable(connection, comment.submission.id)):
-
-                    # Ensure the person is not voting twice
-                    if comment.author.name in sql.fetchVoters(connection, submissionID):
-                        comment.mod.remove()
-                        continue
-
-                    # Stop OP from self voting
-                    if comment.is_submitter:
-                        comment.mod.remove()
-                        continue
-
-                    # Strip command prefix and whitespace then convert to lower case
-                    command = comment.body.replace(COMMAND_PREFIX, "").strip().lower()
-
-                    logger.debug(f"An attempt to vote: \"{command}\" is being made")
-                    # Only count the vote if it was actually for one of the votingOptions (ignore junk)
-                    if command in VOTING_COMMANDS:
-                        # Get the votes from the database: dict[str, int]
-                        votes = sql.fetchVotes(connection, submissionID)
-                        logger.debug(f"Votes: {votes}")
-
-                        # Make sure the flair we're voting for exists
-                        try:
-                            votedOption = VOTING_DICTIONARY[command]
-                            votes[votedOption] = votes[votedOption] + 1
-
-                            # Cast vote
-                            logger.debug(f"Votes about to be written to db after voting: {votes}")
-                            sql.updateVotes(connection, submissionID, list(votes.values()))
-
-                            # Update voters
-                            voters = sql.fetchVoters(connection, submissionID)
-                            voters.append(comment.author.name)
-                            logger.info(f"{comment.author.name} voted for {votedOption} in {comment.submission.name}"
-                                        f"by typing {comment.body}")
-                            sql.updateVoters(connection, submissionID, voters)
-
-                            # Update voting table in the bot comment
-                            botComment = reddit.comment(id=comment.parent_id.split("_")[-1])
-                            botCommentBody = createBodyWithNewVotingTable(connection, comment.submission,
-                                                                          botComment.body)
-                            botComment.edit(botCommentBody)
-
-                        except KeyError as e:
-                            logger.warning(f"Attempted to cast a vote for an unrecognized options.")
-                            logger.warning(f"Command was = {command}")
-                            logger.warning(f"Available flairs were: {votes.keys()}")
-                            logger.warning(f"Printing stack stace")
-                            logger.warning(e)
-                            continue
-
-                    # Everything's done so delete the comment to avoid clutter
-                    comment.mod.remove()
-                    logger.debug(f"Removed vote comment: {comment.body}")
-                else:
-                    logger.debug(f"Did not vote on comment: {comment.body }")
+            for comment in liveStream("comments", subreddit.stream.comments):
+                handleComment(comment, connection, logger)
 
         except ServerError as e:
             logger.error("Reddit server error. Restarting comment stream.")
@@ -618,46 +912,207 @@ def commentStream(logger: logging.Logger):
             logger.error("Restarting comment stream")
 
 
-# Setup logging
-mainLogger = logging.getLogger(__name__)
-mainLogger.setLevel(logging.DEBUG)
+def startThreads(logger: logging.Logger) -> list:
+    mainThread = threading.Thread(target=main, args=[logger])
+    persistenceThread = threading.Thread(target=persistence, args=[logger])
+    messagePasserThread = threading.Thread(target=messagePasser, args=[logger])
+    notifierThread = threading.Thread(target=notifier.notifier,
+                                      args=[logger, notifierReddit, apiBudget, tenants.home.subreddit, dbWriter])
+    commentThread = threading.Thread(target=commentStream, args=[logger])
+    votingThread = threading.Thread(target=voting, args=[logger])
+
+    mainThread.start()
+    persistenceThread.start()
+    messagePasserThread.start()
+    notifierThread.start()
+    commentThread.start()
+    votingThread.start()
+
+    return [mainThread, persistenceThread, messagePasserThread, notifierThread, commentThread, votingThread]
+
+
+def runAsync(logger: logging.Logger):
+    # Every loop body runs on asyncengine's executor threads, so each call takes its thread's connection
+    streams = [
+        ("submission", lambda: liveStream("submissions", subreddit.stream.submissions),
+         lambda submission: handleSubmission(submission, logger)),
+        ("comment", lambda: liveStream("comments", subreddit.stream.comments),
+         lambda comment: handleComment(comment, sql.threadConnection(), logger)),
+        ("message", lambda: liveStream("inbox", reddit.inbox.stream),
+         lambda message: handleMessage(message, sql.threadConnection(), logger)),
+    ]
+    periodic = [
+        ("persistence", lambda: persistencePass(sql.threadConnection(), logger), PERSISTENCE_INTERVAL, None),
+        ("voting", lambda: votingPass(sql.threadConnection(), logger), VOTING_INTERVAL,
+         lambda: clock.sleep(VOTING_STAGGER)),
+        ("notifier", lambda: notifier.notifierPass(sql.threadConnection(), notifierReddit, tenants.home.subreddit,
+                                                   logger, apiBudget, dbWriter),
+         notifier.NOTIFIER_INTERVAL, None),
+    ]
+    asyncengine.run(streams, periodic, logger)
+
+
+# Builds a Tenant for every subreddit in SUBREDDITS from the settings at the top of this file and its overrides
+def createTenants() -> Tenants:
+    tenantList = []
+    for subredditName, overrides in SUBREDDITS.items():
+        settings = {
+            "standardReply": STANDARD_REPLY,
+            "doubleDippingReply": DOUBLE_DIPPING_REPLY,
+            "votingText": VOTING_TEXT,
+            "votingClosedText": VOTING_CLOSED_TEXT,
+            "noReplyFlairTexts": NO_REPLY_FLAIR_TEXTS,
+            "noReplyTitleTexts": NO_REPLY_TITLE_TEXTS,
+            "noVoteFlairTexts": NO_VOTE_FLAIR_TEXTS,
+            "noVoteTitleTexts": NO_VOTE_TITLE_TEXTS,
+            "votingDictionary": VOTING_DICTIONARY,
+        }
+        settings.update(overrides)
+        tenantList.append(Tenant(subredditName, **settings))
+    return Tenants(tenantList)
+
+
+# Times every sql.py query function, registers the queue depths and starts exporting the metrics
+def startMetrics(logger: logging.Logger):
+    metrics.registry.instrument(sql, "bot_sqlite_seconds")
+    metrics.registry.gauge("bot_review_jobs_queued", jobQueue.pending)
+    metrics.registry.gauge("bot_review_jobs_running", lambda: len(jobQueue.running))
+    metrics.registry.gauge("bot_voting_open_posts", votingDeadlines.pending)
+    metrics.registry.gauge("bot_voting_closure_backlog", votingDeadlines.overdue)
+    metrics.registry.gauge("bot_vote_table_edits_pending", lambda: len(voteTableEditor.pending))
+    metrics.registry.gauge("bot_db_write_queue", dbWriter.pending)
+    if commentShards is not None:
+        metrics.registry.gauge("bot_vote_backlog", commentShards.pending)
+    metrics.registry.gauge("bot_seen_filter_items", lambda: len(seenFilter))
+    for stream in ["submissions", "comments", "inbox"]:
+        metrics.registry.gauge(f"bot_checkpoint_age_seconds{{stream=\"{stream}\"}}",
+                               lambda stream=stream: checkpoints.age(stream))
+    metrics.registry.gauge("bot_api_remaining", lambda: apiBudget.remaining)
+
+    if METRICS_PORT is not None:
+        metrics.registry.serve(METRICS_PORT)
+        logger.info("Serving metrics on http://127.0.0.1:%s", METRICS_PORT)
+    if METRICS_FILE is not None:
+        metrics.registry.writePeriodically(METRICS_FILE, METRICS_INTERVAL, logger)
+
+
+# Sets up the module level Reddit objects then runs the bot in the chosen runtime. The Reddit instances can be swapped
+# for a local stand-in such as fakereddit.FakeReddit to drive the bot offline.
+def startBot(botReddit, notifierBotReddit, runtime: str, logger: logging.Logger):
+    global tenants, reddit, subreddit, notifierReddit, jobQueue, postCache, voteTableEditor, submissionCache, \
+        dbWriter, apiBudget, commentInspector, votingScheduler, votingDeadlines, commentShards, checkpoints, seenFilter
+
+    # One combined listing streams the submissions and comments of every subreddit served
+    tenants = createTenants()
+    reddit = botReddit
+    subreddit = reddit.subreddit(tenants.combinedName())
+    logger.info("Serving %s subreddits: %s", len(tenants), tenants.combinedName())
+    notifierReddit = notifierBotReddit
+
+    # Both clients draw on one request budget, read from the rate limit values Reddit returns
+    apiBudget = APIBudget(logger)
+    apiBudget.register(reddit)
+    apiBudget.register(notifierReddit)
+    if sql.PROFILE_QUERIES:
+        sql.startQueryProfiling()
+    sql.createTables()
+
+    # Every write to the DB goes through this one thread which commits queued writes together
+    dbWriter = DBWriter(logger)
+    dbWriter.start()
+
+    # Live vote state for active posts. Reads are served from memory, writes go through to the DB
+    postCache = PostCache(dbWriter)
+    postCache.load(sql.threadConnection())
+
+    # Voting closes at each post's VotingTime. Posts are added as they are inserted, the rest are loaded by votingPass.
+    # Only the process running the loops closes voting.
+    if runtime != "worker":
+        votingScheduler = Scheduler(VOTING_WORKERS, logger, "voting")
+        votingScheduler.start()
+        votingDeadlines = DeadlineQueue(votingScheduler, lambda postIDList: closeVoting(postIDList, logger), logger)
+
+    # Flair, duplicates and score of submissions, so a review pass fetches each at most once
+    submissionCache = SubmissionCache(SUBMISSION_CACHE_TTLS)
+    commentInspector = CommentTreeInspector(logger, budget=apiBudget)
+
+    voteTableEditor = EditCoalescer(reddit, renderVotingTable, VOTE_TABLE_EDIT_INTERVAL, logger, apiBudget)
+    voteTableEditor.start()
+
+    # Reviews are jobs in the DB so they survive restarts and can be shared with "worker" processes
+    jobQueue = JobQueue(dbWriter, {
+        FIRST_REVIEW_JOB: lambda postID, submission, reviewState: firstReview(postID, submission, reviewState, logger),
+        SECOND_REVIEW_JOB: lambda postID, submission, reviewState: secondReview(postID, submission, reviewState,
+                                                                                logger),
+    }, lambda postIDList: hydrateSubmissions(postIDList, PRIORITY_REPLY), REVIEW_WORKERS, logger, "review")
+    jobQueue.start()
+
+    if runtime == "worker":
+        # Metrics are left to the main process, a second exporter would clash over its port and file
+        logger.info("Started review worker %s", jobQueue.owner)
+        jobQueue.poller.join()
+        return
+
+    # Posts reviewed by workers are picked up by this process's vote cache
+    jobQueue.pollListeners.append(lambda: postCache.sync(sql.threadConnection(readOnly=True)))
+
+    commentShards = None
+    if COMMENT_SHARDS > 0:
+        commentShards = ShardPool(COMMENT_SHARDS, COMMENT_SHARD_QUEUE_SIZE,
+                                  lambda comment, record: handleVote(comment, record, sql.threadConnection(), logger),
+                                  logger, "votes")
+        commentShards.start()
+
+    # Everything posted while the bot was down is handled before the live streams take over from the checkpoints
+    checkpoints = Checkpoints(dbWriter)
+    checkpoints.load(sql.threadConnection())
+
+    # Items every ingest loop has handled, restored from the snapshot the persistence loop saves
+    seenFilter = SeenFilter(SEEN_FILTER_WINDOW)
+    seenFilter.load(sql.fetchSeenItems(sql.threadConnection(), clock.time() - SEEN_FILTER_WINDOW,
+                                       seenFilter.capacity))
+    backfill(logger)
+
+    startMetrics(logger)
+
+    if runtime == "asyncio":
+        logger.info("Started bot (asyncio runtime)")
+        runAsync(logger)
+    else:
+        threads = startThreads(logger)
+        logger.info("Started bot")
 
-formatter = logging.Formatter("%(created)f : %(asctime)s : %(name)s : %(funcName)s : %(levelname)s :: %(message)s")
+        # The main thread has to stay alive, the review scheduler's worker pool stops accepting jobs once it exits
+        for thread in threads:
+            thread.join()
 
-fileHandler = logging.FileHandler(LOG_FILE)
-fileHandler.setLevel(LOGGING_LEVEL)
-fileHandler.setFormatter(formatter)
 
-streamHandler = logging.StreamHandler()
-streamHandler.setFormatter(formatter)
+# Setup logging. Records below LOGGING_LEVEL are discarded before their message is formatted. The file gets JSON lines
+# and stderr gets text, both written from a background thread.
+# sql.py imports this module as main so `python main.py` runs this file twice, as __main__ and as main. Both copies use
+# the "main" logger and only the first sets it up: two RotatingFileHandlers would each rotate bot.log on their own.
+mainLogger = logging.getLogger("main")
+if len(mainLogger.handlers) == 0:
+    mainLogger.setLevel(LOGGING_LEVEL)
+    mainLogger.addFilter(botlog.SamplingFilter(LOG_SAMPLE_LIMIT, LOG_SAMPLE_WINDOW))
 
-mainLogger.addHandler(fileHandler)
-mainLogger.addHandler(streamHandler)
+    formatter = logging.Formatter("%(created)f : %(asctime)s : %(name)s : %(funcName)s : %(levelname)s :: %(message)s")
 
-if __name__ == "__main__":
+    fileHandler = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS)
+    fileHandler.setLevel(LOGGING_LEVEL)
+    fileHandler.setFormatter(botlog.JSONFormatter())
 
-    # Setup reddit
-    reddit = praw.Reddit(PRAW_INI_SITE, user_agent=USER_AGENT)
-    reddit.validate_on_submit = True
-    subreddit = reddit.subreddit(SUBREDDIT)
-    sql.createTables()
+    streamHandler = logging.StreamHandler()
+    streamHandler.setFormatter(formatter)
 
-    time.sleep(2)  # Hacky way of making sure the tables have had time to be created
+    logListener = botlog.startBackgroundLogging(mainLogger, [fileHandler, streamHandler])
 
-    # Start threads
-    mainThread = threading.Thread(target=main, args=[mainLogger])
-    persistenceThread = threading.Thread(target=persistence, args=[mainLogger])
-    messagePasserThread = threading.Thread(target=messagePasser, args=[mainLogger])
-    notifierThread = threading.Thread(target=notifier.notifier, args=[mainLogger])
-    commentThread = threading.Thread(target=commentStream, args=[mainLogger])
-    votingThread = threading.Thread(target=voting, args=[mainLogger])
 
+if __name__ == "__main__":
 
-    mainThread.start()
-    persistenceThread.start()
-    messagePasserThread.start()
-    notifierThread.start()
-    commentThread.start()
-    votingThread.start()
+    # Setup reddit
+    botReddit = praw.Reddit(PRAW_INI_SITE, user_agent=USER_AGENT)
+    botReddit.validate_on_submit = True
+    notifierBotReddit = praw.Reddit(notifier.NOTIFIER_PRAW_INI_SITE, user_agent=notifier.NOTIFIER_USER_AGENT)
 
-    mainLogger.info("Started bot")
+    startBot(botReddit, notifierBotReddit, RUNTIME, mainLogger)
@@ -0,0 +1,205 @@
+import collections
+import functools
+import http.server
+import inspect
+import logging
+import os
+import threading
+import time
+
+import clock
+
+# Upper bounds in seconds of the histogram buckets. They go up to hours because loop lag is measured with them too.
+BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600, 18000]
+
+# Seconds over which marked events are turned into a per second rate
+RATE_WINDOW = 60
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # The last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        index = 0
+        while (index < len(BUCKETS)) and (value > BUCKETS[index]):
+            index = index + 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+
+def formatLabels(labels: tuple, extra: tuple = ()) -> str:
+    labels = labels + extra
+    if len(labels) == 0:
+        return ""
+    return "{" + ",".join(f"{name}=\"{value}\"" for name, value in labels) + "}"
+
+
+# Name of the Reddit endpoint a PRAW call goes to, such as "CommentModeration.remove" for comment.mod.remove
+def endpointName(function) -> str:
+    owner = getattr(function, "__self__", None)
+    if owner is not None:
+        return f"{type(owner).__name__}.{function.__name__}"
+    return getattr(function, "__name__", "unknown")
+
+
+# Counters, latency histograms and gauges for the whole bot, rendered in the Prometheus text format. Counters and
+# histograms are keyed by name and labels (keyword arguments). Gauges are functions read when the metrics are
+# rendered, so queue depths are always current and cost nothing until someone looks.
+# Every loop reports a heartbeat with how far behind it is. bot_loop_seconds_since_iteration is the one to alert on.
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.histograms = {}
+        self.gauges = {}
+        self.heartbeats = {}  # loop -> clock time of its last iteration
+        self.events = collections.defaultdict(collections.deque)  # name -> clock times within RATE_WINDOW
+
+    def count(self, name: str, amount: float = 1, **labels):
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += amount
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    # Times the with block in real seconds into the histogram name
+    def timer(self, name: str, **labels):
+        return Timer(self, name, labels)
+
+    def gauge(self, name: str, function):
+        with self.lock:
+            self.gauges[name] = function
+
+    # Counts an event for name_total and the name_per_second rate
+    def mark(self, name: str):
+        now = clock.time()
+        with self.lock:
+            self.counters[(name + "_total", ())] += 1
+            events = self.events[name]
+            events.append(now)
+            while events[0] < now - RATE_WINDOW:
+                events.popleft()
+
+    # Records an iteration of loop. Streams pass lag, the age of the item they are handling. Periodic loops pass their
+    # interval instead and the lag is how much later than that after the previous iteration this one started.
+    def heartbeat(self, loop: str, lag: float = None, interval: float = None):
+        now = clock.time()
+        with self.lock:
+            if interval is not None:
+                previous = self.heartbeats.get(loop)
+                lag = 0 if previous is None else max(0.0, now - previous - interval)
+            self.heartbeats[loop] = now
+        self.observe("bot_loop_lag_seconds", max(0.0, lag), loop=loop)
+
+    # Wraps every function of module that takes a connection as its first argument so its run time is recorded in
+    # histogram name with the function name as a label. Callers look the functions up on the module so they all get
+    # the timed version.
+    def instrument(self, module, name: str):
+        for functionName, function in inspect.getmembers(module, inspect.isfunction):
+            if (function.__module__ != module.__name__) or hasattr(function, "__wrapped__"):
+                continue
+            parameters = list(inspect.signature(function).parameters)
+            if (len(parameters) == 0) or (parameters[0] != "connection"):
+                continue
+            setattr(module, functionName, self.timed(name, function, function=functionName))
+
+    def timed(self, name: str, target, **labels):
+        @functools.wraps(target)
+        def wrapper(*args, **kwargs):
+            with self.timer(name, **labels):
+                return target(*args, **kwargs)
+        return wrapper
+
+    def render(self) -> str:
+        now = clock.time()
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{name}{formatLabels(labels)} {value}")
+            for name, events in sorted(self.events.items()):
+                recent = len([eventTime for eventTime in events if eventTime >= now - RATE_WINDOW])
+                lines.append(f"{name}_per_second {recent / RATE_WINDOW:.3f}")
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ["+Inf"], histogram.counts):
+                    cumulative = cumulative + count
+                    lines.append(f"{name}_bucket{formatLabels(labels, (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{formatLabels(labels)} {histogram.sum:.6f}")
+                lines.append(f"{name}_count{formatLabels(labels)} {histogram.count}")
+            for loop, lastTime in sorted(self.heartbeats.items()):
+                lines.append(f"bot_loop_seconds_since_iteration{formatLabels((('loop', loop),))} {now - lastTime:.1f}")
+            gauges = sorted(self.gauges.items())
+
+        # Gauges take their own locks so they are read outside this one
+        for name, function in gauges:
+            try:
+                value = function()
+            except Exception:
+                value = None
+            lines.append(f"{name} {'NaN' if value is None else value}")
+        return "\n".join(lines) + "\n"
+
+    # Serves the metrics on http://host:port (any path) from a daemon thread
+    def serve(self, port: int, host: str = "127.0.0.1"):
+        registry = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            # Scrapes would otherwise be printed to stderr
+            def log_message(self, format, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+        return server
+
+    # Rewrites file with the metrics every interval seconds from a daemon thread. The file is replaced in one step so
+    # readers never see half of it.
+    def writePeriodically(self, file: str, interval: float, logger: logging.Logger):
+        def run():
+            while True:
+                try:
+                    with open(file + ".tmp", "w") as metricsFile:
+                        metricsFile.write(self.render())
+                    os.replace(file + ".tmp", file)
+                except OSError as e:
+                    logger.warning(f"Unable to write metrics to {file}")
+                    logger.warning(e)
+                clock.sleep(interval)
+
+        threading.Thread(target=run, name="metrics-file", daemon=True).start()
+
+
+class Timer:
+    def __init__(self, metrics: Metrics, name: str, labels: dict):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+# The bot's metrics. Modules record into this one registry so nothing has to pass it around.
+registry = Metrics()
@@ -1,9 +1,12 @@
-import time
 import logging
+import sqlite3
 import traceback
 
+import clock
+import metrics
 import sql
 import main
+from ratelimit import PRIORITY_MODMAIL
 
 import praw
 
@@ -13,26 +16,52 @@ NOTIFIER_PRAW_INI_SITE = "notifierBot"
 # User agent for notifier bot
 NOTIFIER_USER_AGENT = "B-W-Notifier-Bot by u/-CrashDive-"
 
+# Seconds between checks for new messages
+NOTIFIER_INTERVAL = 60
 
-def notifier(logger: logging.Logger):
 
-    connection = sql.createDBConnection(sql.DB_FILE)
-    reddit = praw.Reddit(NOTIFIER_PRAW_INI_SITE, user_agent=NOTIFIER_USER_AGENT)
-    subreddit = reddit.subreddit(main.SUBREDDIT)
+# Modmail is sent through budget (a ratelimit.APIBudget) when one is given so it only uses requests nothing more
+# important needs
+def sendModmail(subreddit: praw.models.Subreddit, subject: str, body: str, budget):
+    if budget is not None:
+        budget.call(PRIORITY_MODMAIL, subreddit.message, subject, body)
+    else:
+        subreddit.message(subject, body)
 
-    while True:
-        # Tuple structure: [0] MessageID , [1] Subject, [2] Body, [3] Sender, [4] IsUserMessage, [5] MessageTime
-        messageTupleList = sql.fetchAllMessagesFromDB(connection)
-        for messageTuple in messageTupleList:
-            if messageTuple[4] == 0:  # IsUserMessage == False
-                subreddit.message(messageTuple[1], messageTuple[2])
-                logger.info(f"Sent modmail \"{messageTuple[1]}\" from notifier bot")
-            else:
-                subject = f"{messageTuple[1]} from u/{messageTuple[3]}"
-                body = f"{messageTuple[2]} \n\nThe above message was sent to BeginnerWoodworkBot by u/{messageTuple[3]}"
-                subreddit.message(subject, body)
-                logger.info(f"sent modmail \"{messageTuple[1]}\" from u/{messageTuple[3]}")
+
+# Each message goes to the modmail of the subreddit stored with it. Messages without one (sent to the bot by users)
+# go to homeSubreddit. Sent messages are deleted through writer (a dbwriter.DBWriter) when one is given
+def notifierPass(connection: sqlite3.Connection, reddit: praw.Reddit, homeSubreddit: str, logger: logging.Logger,
+                 budget=None, writer=None):
+    metrics.registry.heartbeat("notifier", interval=NOTIFIER_INTERVAL)
+    # Tuple structure: [0] MessageID , [1] Subject, [2] Body, [3] Sender, [4] IsUserMessage, [5] MessageTime,
+    # [6] Subreddit
+    messageTupleList = sql.fetchAllMessagesFromDB(connection)
+    for messageTuple in messageTupleList:
+        subreddit = reddit.subreddit(messageTuple[6] if messageTuple[6] else homeSubreddit)
+        if messageTuple[4] == 0:  # IsUserMessage == False
+            sendModmail(subreddit, messageTuple[1], messageTuple[2], budget)
+            logger.info("Sent modmail \"%s\" from notifier bot", messageTuple[1])
+        else:
+            subject = f"{messageTuple[1]} from u/{messageTuple[3]}"
+            body = f"{messageTuple[2]} \n\nThe above message was sent to BeginnerWoodworkBot by u/{messageTuple[3]}"
+            sendModmail(subreddit, subject, body, budget)
+            logger.info("sent modmail \"%s\" from u/%s", messageTuple[1], messageTuple[3])
+        if writer is not None:
+            writer.write(sql.removeMessageByIDFromDB, messageTuple[0])
+        else:
             sql.removeMessageByIDFromDB(connection, messageTuple[0])
 
-            time.sleep(60)
+
+def notifier(logger: logging.Logger, reddit: praw.Reddit = None, budget=None, homeSubreddit: str = None, writer=None):
+
+    connection = sql.threadConnection()
+    if homeSubreddit is None:
+        homeSubreddit = main.SUBREDDIT
+    if reddit is None:
+        reddit = praw.Reddit(NOTIFIER_PRAW_INI_SITE, user_agent=NOTIFIER_USER_AGENT)
+
+    while True:
+        notifierPass(connection, reddit, homeSubreddit, logger, budget, writer)
+        clock.sleep(NOTIFIER_INTERVAL)
     logger.warning("Notfier exited")
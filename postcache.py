@@ -0,0 +1,143 @@
+import sqlite3
+import threading
+
+import sql
+
+
+class PostRecord:
+    __slots__ = ("postID", "replyID", "postTime", "votingTime", "votes", "voters", "isVoteable")
+
+    def __init__(self, postID: str, replyID: str, postTime: float, votingTime: float, votes: dict, voters: set,
+                 isVoteable: bool):
+        self.postID = postID
+        self.replyID = replyID
+        self.postTime = postTime
+        self.votingTime = votingTime
+        self.votes = votes
+        self.voters = voters
+        self.isVoteable = isVoteable
+
+
+# Write-through cache in front of sql.py for the comment vote path. Records for active posts are loaded from the DB on
+# first use and reads are then served from memory. Writes go to the DB first and only update memory once the DB write
+# has succeeded (through writer, a dbwriter.DBWriter, when one is given). Records are evicted whenever sql.py removes the
+# post from the DB.
+# Records are also indexed by the fullname of the bot's reply so comments can be matched to a post without any API call.
+class PostCache:
+    def __init__(self, writer=None):
+        self.writer = writer
+        self.records = {}
+        self.replies = {}  # "t1_" + ReplyID -> PostRecord
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.commentsChecked = 0
+        self.commentsMatched = 0
+        sql.removalListeners.append(self.evict)
+
+    # Loads every post that is open for voting so findByReply knows all live bot replies from startup
+    def load(self, connection: sqlite3.Connection):
+        for postID in sql.fetchPostIDsOpenForVotingFromDB(connection):
+            self.record(connection, postID)
+
+    # Picks up posts inserted, removed and voting eligibility changed by other processes, such as review workers (see
+    # jobqueue.py), which this cache would otherwise never hear about. Records are evicted when their post is no longer
+    # open for voting. Only records cached before the query are, so one added meanwhile isn't dropped by mistake.
+    def sync(self, connection: sqlite3.Connection):
+        with self.lock:
+            cachedIDs = set(self.records)
+        rows = sql.fetchVotingEligibilityFromDB(connection)
+        self.evict(list(cachedIDs - {postID for postID, isVoteable in rows}))
+
+        for postID, isVoteable in rows:
+            with self.lock:
+                record = self.records.get(postID)
+                if record is not None:
+                    record.isVoteable = bool(isVoteable)
+                    continue
+            self.record(connection, postID)
+
+    # Returns the record of the post whose bot reply has the given fullname. Only uses memory
+    def findByReply(self, replyFullname: str):
+        with self.lock:
+            self.commentsChecked += 1
+            record = self.replies.get(replyFullname)
+            if record is not None:
+                self.commentsMatched += 1
+            return record
+
+    def record(self, connection: sqlite3.Connection, submissionID: str):
+        with self.lock:
+            record = self.records.get(submissionID)
+            if record is not None:
+                self.hits += 1
+                return record
+
+            self.misses += 1
+            row = sql.fetchPostRecord(connection, submissionID)
+            if row is None:
+                return None
+
+            replyID, postTime, votingTime, votes, voters, isVoteable = row
+            record = PostRecord(submissionID, replyID, postTime, votingTime, votes, set(voters), isVoteable)
+            self.records[submissionID] = record
+            if (replyID is not None) and (replyID != ""):
+                self.replies["t1_" + replyID] = record
+            return record
+
+    def isVoteable(self, connection: sqlite3.Connection, submissionID: str) -> bool:
+        record = self.record(connection, submissionID)
+        return (record is not None) and record.isVoteable
+
+    def fetchVotes(self, connection: sqlite3.Connection, submissionID: str) -> dict:
+        record = self.record(connection, submissionID)
+        if record is None:
+            return {}
+        with self.lock:
+            return dict(record.votes)
+
+    def hasVoted(self, connection: sqlite3.Connection, submissionID: str, voter: str) -> bool:
+        record = self.record(connection, submissionID)
+        return (record is not None) and (voter in record.voters)
+
+    # Counts a vote for option by voter and returns the new tallies. Raises KeyError if option is not one of the post's
+    # voting options. The tallies are unchanged if the DB already had a vote from voter.
+    def castVote(self, connection: sqlite3.Connection, submissionID: str, voter: str, option: str) -> dict:
+        record = self.record(connection, submissionID)
+        if record is None:
+            return {}
+
+        if option not in record.votes:
+            raise KeyError(option)
+
+        # The lock isn't held while the write is waiting for its batch to commit. The DB rejects a second vote by the
+        # same voter so memory is only changed by the write that was recorded.
+        if self.writer is not None:
+            recorded = self.writer.write(sql.castVote, submissionID, voter, option)
+        else:
+            recorded = sql.castVote(connection, submissionID, voter, option)
+
+        with self.lock:
+            if recorded:
+                record.votes[option] = record.votes[option] + 1
+            record.voters.add(voter)
+            return dict(record.votes)
+
+    # Like castVote the lock isn't held during the write: the writer thread takes it through evict when a batch removes
+    # posts, so waiting on the writer while holding it would deadlock both
+    def updateVotingEligibility(self, connection: sqlite3.Connection, submissionID: str, votingEligibility: bool):
+        if self.writer is not None:
+            self.writer.write(sql.updateVotingEligibility, submissionID, votingEligibility)
+        else:
+            sql.updateVotingEligibility(connection, submissionID, votingEligibility)
+        with self.lock:
+            record = self.records.get(submissionID)
+            if record is not None:
+                record.isVoteable = bool(votingEligibility)
+
+    def evict(self, postIDList: list):
+        with self.lock:
+            for postID in postIDList:
+                record = self.records.pop(postID, None)
+                if (record is not None) and (record.replyID is not None):
+                    self.replies.pop("t1_" + record.replyID, None)
@@ -0,0 +1,174 @@
+import collections
+import logging
+import logging.handlers
+import sqlite3
+import sys
+import threading
+import time
+
+import botlog
+
+# Most recent timings kept per statement for the percentiles
+PROFILE_SAMPLES = 1000
+
+# Longest bound parameter list written to the slow query log, longer ones are cut
+MAX_PARAMETER_TEXT = 300
+
+# Files whose frames are skipped when looking for the function that ran a statement
+WRAPPER_FILES = ("queryprofile.py", "metrics.py")
+
+
+def percentile(samples: list, fraction: float) -> float:
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+# The sql.py function that ran the statement and the function that called it, skipping this module and the metrics
+# wrappers
+def callingFunctions() -> tuple:
+    names = []
+    frame = sys._getframe(2)
+    while (frame is not None) and (len(names) < 2):
+        if not frame.f_code.co_filename.endswith(WRAPPER_FILES):
+            names.append(frame.f_code.co_name)
+        frame = frame.f_back
+    return tuple(names + [None] * (2 - len(names)))
+
+
+def parameterText(parameters, many: bool) -> str:
+    if parameters is None:
+        return ""
+    if many:
+        parameters = list(parameters)
+        text = f"{len(parameters)} rows, first {parameters[0] if len(parameters) > 0 else None}"
+    else:
+        text = repr(parameters)
+    return text if len(text) <= MAX_PARAMETER_TEXT else text[:MAX_PARAMETER_TEXT] + "..."
+
+
+# Times every statement run through a ProfiledConnection. A statement's time runs from execute until its rows have
+# been fetched (or the cursor moves on), so lazily stepped SELECTs are counted in full. Timings are kept per statement
+# text, which is the same for every call since sql.py binds its values as parameters. Statements slower than threshold
+# seconds are written to slowLogger with their parameters and the functions that ran them.
+class QueryProfiler:
+    def __init__(self, threshold: float, slowLogger: logging.Logger):
+        self.threshold = threshold
+        self.slowLogger = slowLogger
+        self.lock = threading.Lock()
+        self.samples = collections.defaultdict(lambda: collections.deque(maxlen=PROFILE_SAMPLES))
+        self.counts = collections.Counter()
+        self.totals = collections.Counter()
+        self.slowQueries = 0
+
+    def record(self, statement: str, seconds: float, parameters: str, function: str, caller: str):
+        with self.lock:
+            self.samples[statement].append(seconds)
+            self.counts[statement] += 1
+            self.totals[statement] += seconds
+            slow = seconds >= self.threshold
+            if slow:
+                self.slowQueries += 1
+        if slow:
+            self.slowLogger.warning("%.3fs in %s: %s", seconds, function, statement,
+                                    extra={"seconds": seconds, "statement": statement, "parameters": parameters,
+                                           "function": function, "caller": caller})
+
+    # The statements that took the most time in total, with their call counts and percentiles in milliseconds
+    def stats(self, top: int = 5) -> str:
+        with self.lock:
+            lines = [f"{self.slowQueries} slow statements"]
+            for statement, total in self.totals.most_common(top):
+                samples = sorted(self.samples[statement])
+                lines.append(f"{total:.2f}s over {self.counts[statement]} calls, "
+                             f"p50 {percentile(samples, 0.5) * 1000:.2f}ms / "
+                             f"p95 {percentile(samples, 0.95) * 1000:.2f}ms / "
+                             f"p99 {percentile(samples, 0.99) * 1000:.2f}ms / max {samples[-1] * 1000:.2f}ms: "
+                             f"{' '.join(statement.split())[:100]}")
+            return "\n    ".join(lines)
+
+
+class ProfiledCursor(sqlite3.Cursor):
+    pending = None  # [statement, seconds so far, parameters, function, caller] of the statement being fetched
+
+    def finish(self):
+        if self.pending is not None:
+            self.connection.profiler.record(*self.pending)
+            self.pending = None
+
+    def timed(self, method, statement: str, parameters, many: bool):
+        self.finish()
+        function, caller = callingFunctions()
+        start = time.perf_counter()
+        try:
+            return method(self, statement, parameters) if parameters is not None else method(self, statement)
+        finally:
+            self.pending = [statement, time.perf_counter() - start, parameterText(parameters, many), function, caller]
+
+    def execute(self, statement: str, parameters=None):
+        return self.timed(sqlite3.Cursor.execute, statement, parameters, False)
+
+    def executemany(self, statement: str, parameters):
+        parameters = list(parameters)
+        return self.timed(sqlite3.Cursor.executemany, statement, parameters, True)
+
+    def executescript(self, script: str):
+        return self.timed(sqlite3.Cursor.executescript, script, None, False)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        if self.pending is not None:
+            self.pending[1] += time.perf_counter() - start
+            if row is None:
+                self.finish()
+        return row
+
+    def fetchmany(self, size: int = None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        if self.pending is not None:
+            self.pending[1] += time.perf_counter() - start
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        if self.pending is not None:
+            self.pending[1] += time.perf_counter() - start
+            self.finish()
+        return rows
+
+    def close(self):
+        self.finish()
+        super().close()
+
+    def __del__(self):
+        self.finish()
+
+
+# Connection whose cursors time their statements into profiler. sqlite3's own connection.execute shortcuts don't go
+# through cursor.execute so they are redone on a ProfiledCursor.
+class ProfiledConnection(sqlite3.Connection):
+    profiler = None
+
+    def cursor(self, factory=ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, statement: str, parameters=None):
+        return self.cursor().execute(statement, parameters)
+
+    def executemany(self, statement: str, parameters):
+        return self.cursor().executemany(statement, parameters)
+
+    def executescript(self, script: str):
+        return self.cursor().executescript(script)
+
+
+# Logger for the slow query log. Written as JSON lines from a background thread, separate from the bot's log
+def slowQueryLogger(file: str, maxBytes: int, backups: int) -> logging.Logger:
+    logger = logging.getLogger("slowqueries")
+    logger.setLevel(logging.WARNING)
+    logger.propagate = False
+    handler = logging.handlers.RotatingFileHandler(file, maxBytes=maxBytes, backupCount=backups)
+    handler.setFormatter(botlog.JSONFormatter())
+    botlog.startBackgroundLogging(logger, [handler])
+    return logger
@@ -0,0 +1,106 @@
+import collections
+import heapq
+import itertools
+import logging
+import threading
+
+import clock
+import metrics
+
+# Priority classes, lower goes first
+PRIORITY_REMOVAL = 0  # Removals and double dipping actions
+PRIORITY_REPLY = 1  # Standard replies and review pass edits
+PRIORITY_EDIT = 2  # Voting table edits
+PRIORITY_MODMAIL = 3  # Modmail sent by the notifier
+
+# Requests each priority class leaves unused for the classes above it. Once Reddit reports this few requests remaining
+# in the current window, calls of that class wait for the window to reset.
+PRIORITY_RESERVES = {
+    PRIORITY_REMOVAL: 0,
+    PRIORITY_REPLY: 10,
+    PRIORITY_EDIT: 30,
+    PRIORITY_MODMAIL: 50,
+}
+
+# Longest a blocked call sleeps before checking the budget again
+MAX_WAIT = 5
+
+
+# Shared request budget for every PRAW client the bot uses. After each call the remaining requests and reset time that
+# Reddit sends back (X-Ratelimit-Remaining / X-Ratelimit-Reset, exposed by PRAW as reddit.auth.limits) are read from
+# every registered client. Calls are let through in priority order while the budget lasts, with lower priorities
+# keeping a reserve free for higher ones, and held until the window resets once it runs out.
+class APIBudget:
+    def __init__(self, logger: logging.Logger, reserves: dict = None):
+        self.logger = logger
+        self.reserves = PRIORITY_RESERVES if reserves is None else reserves
+        self.clients = []
+        self.condition = threading.Condition()
+        self.waiting = []  # Heap of (priority, sequence) tickets
+        self.sequence = itertools.count()
+        self.remaining = None  # Unknown until Reddit has answered a request
+        self.resetTime = 0
+        self.calls = collections.Counter()
+        self.waits = collections.Counter()
+
+    def register(self, reddit):
+        with self.condition:
+            self.clients.append(reddit)
+            self.refresh()
+
+    # Runs function(*args, **kwargs) once the budget allows a call of this priority
+    def call(self, priority: int, function, *args, **kwargs):
+        with metrics.registry.timer("bot_api_wait_seconds", priority=priority):
+            self.acquire(priority)
+        endpoint = metrics.endpointName(function)
+        metrics.registry.count("bot_api_calls_total", endpoint=endpoint)
+        try:
+            with metrics.registry.timer("bot_api_request_seconds", endpoint=endpoint):
+                return function(*args, **kwargs)
+        finally:
+            with self.condition:
+                self.refresh()
+                self.condition.notify_all()
+
+    # Takes the lowest remaining count reported by any client since they draw on the same allowance
+    def refresh(self):
+        remaining = None
+        resetTime = 0
+        for client in self.clients:
+            limits = client.auth.limits
+            if limits.get("remaining") is None:
+                continue
+            if (remaining is None) or (limits["remaining"] < remaining):
+                remaining = limits["remaining"]
+                resetTime = limits["reset_timestamp"] or 0
+        if remaining is not None:
+            self.remaining = remaining
+            self.resetTime = resetTime
+
+    def available(self, priority: int) -> bool:
+        if (self.remaining is None) or (clock.time() >= self.resetTime):
+            return True
+        return self.remaining - self.reserves[priority] >= 1
+
+    def acquire(self, priority: int):
+        with self.condition:
+            ticket = (priority, next(self.sequence))
+            heapq.heappush(self.waiting, ticket)
+            waited = False
+            while (self.waiting[0] != ticket) or (not self.available(priority)):
+                waited = True
+                self.condition.wait(clock.timeout(min(MAX_WAIT, max(0.01, self.resetTime - clock.time()))))
+            heapq.heappop(self.waiting)
+
+            # Counted down locally until the next response brings the real value
+            if self.remaining is not None:
+                self.remaining = self.remaining - 1
+            self.calls[priority] += 1
+            if waited:
+                self.waits[priority] += 1
+            self.condition.notify_all()
+
+    def stats(self) -> str:
+        with self.condition:
+            return f"remaining {self.remaining}, resets in {max(0, self.resetTime - clock.time()):.0f}s, " \
+                   f"calls {dict(self.calls)}, waited {dict(self.waits)}"
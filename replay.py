@@ -0,0 +1,283 @@
+import argparse
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+
+import clock
+import sql  # sql has to be imported before main (sql imports main for its configuration)
+import main
+from fakereddit import FakeReddit
+
+# Replays synthetic or recorded traffic against the whole bot using fakereddit and an accelerated clock, then reports
+# throughput, per-stage latency and API call counts. With the default speedup the 15 minute second review and the
+# 5 hour voting window take 1.5s and 30s.
+# Usage: python replay.py [--runtime threaded|asyncio] [--speedup N] [--hours N] [--rate N] [--votes N]
+#                         [--comments N] [--subreddits N] [--trace file.jsonl] [--save file.jsonl]
+#
+# A trace is one JSON event per line, ordered by "t" (seconds after the start of the replay):
+#   {"t": 0, "type": "submission", "key": "s0", "author": "user0", "title": "My build", "flair": null, "isSelf": false}
+#   {"t": 40, "type": "comment", "submission": "s0", "author": "user0", "body": "Writeup..."}
+#   {"t": 95, "type": "vote", "submission": "s0", "author": "voter3", "body": "!yes"}
+#   {"t": 300, "type": "message", "author": "user9", "subject": "Question", "body": "Hello mods"}
+# Comments are top level comments. Votes reply to the bot's reply on the submission and are dropped if there isn't one.
+# Submissions can name a "subreddit", otherwise they go to main.SUBREDDIT. Every subreddit in the trace is served.
+
+# Virtual seconds of traffic replayed and virtual seconds the clock runs per real second
+REPLAY_HOURS = 1
+REPLAY_SPEEDUP = 600
+
+# Synthetic traffic: submissions per hour and votes and top level comments per submission
+REPLAY_RATE = 60
+REPLAY_VOTES = 10
+REPLAY_COMMENTS = 3
+
+# Shares of synthetic submissions that are questions (not voteable) and that get a writeup comment from the poster
+QUESTION_SHARE = 0.2
+WRITEUP_SHARE = 0.5
+
+# Real seconds given to the streams to start before traffic begins
+STREAM_START_DELAY = 1
+
+# Virtual seconds waited after the last voting deadline for the closures to finish
+DRAIN_TIME = 120
+
+
+# rate is submissions per hour to each of subreddits subreddits
+def syntheticTrace(hours: float, rate: float, votes: int, comments: int, subreddits: int = 1, seed: int = 1) -> list:
+    generator = random.Random(seed)
+    events = []
+    duration = hours * 3600
+    for i in range(int(hours * rate * subreddits)):
+        start = generator.uniform(0, duration)
+        key = f"s{i}"
+        question = generator.random() < QUESTION_SHARE
+        events.append({"t": start, "type": "submission", "key": key, "author": f"user{i}",
+                       "subreddit": main.SUBREDDIT if i % subreddits == 0 else f"{main.SUBREDDIT}{i % subreddits}",
+                       "title": f"Is this build number {i} ok?" if question else f"My build number {i}",
+                       "flair": None, "isSelf": False})
+        if generator.random() < WRITEUP_SHARE:
+            events.append({"t": start + generator.uniform(10, main.PASS_DELAY / 2), "type": "comment",
+                           "submission": key, "author": f"user{i}", "body": "Writeup: oak, glue and patience"})
+        for comment in range(comments):
+            events.append({"t": start + generator.uniform(10, main.VOTE_ACTION_DELAY), "type": "comment",
+                           "submission": key, "author": f"commenter{comment}", "body": "Nice build"})
+        for vote in range(votes):
+            command = generator.choice(main.VOTING_COMMANDS)
+            events.append({"t": start + generator.uniform(30, main.VOTE_ACTION_DELAY), "type": "vote",
+                           "submission": key, "author": f"voter{vote}", "body": main.COMMAND_PREFIX + command})
+        if i % 10 == 0:
+            events.append({"t": start, "type": "message", "author": f"user{i}", "subject": "Question",
+                           "body": "Hello mods"})
+    events.sort(key=lambda event: event["t"])
+    return events
+
+
+def loadTrace(file: str) -> list:
+    with open(file) as traceFile:
+        return [json.loads(line) for line in traceFile if line.strip() != ""]
+
+
+def saveTrace(file: str, events: list):
+    with open(file, "w") as traceFile:
+        for event in events:
+            traceFile.write(json.dumps(event) + "\n")
+
+
+def percentile(samples: list, fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+# Calls and timings of one bot function. Durations are real seconds spent in the call, latencies are virtual seconds
+# from when the work became due (a post was made, a deadline passed, ...) until the call finished.
+class Stage:
+    def __init__(self, name: str):
+        self.name = name
+        self.lock = threading.Lock()
+        self.durations = []
+        self.latencies = []
+
+    def add(self, duration: float, latency: float = None):
+        with self.lock:
+            self.durations.append(duration)
+            if latency is not None:
+                self.latencies.append(latency)
+
+    def line(self) -> str:
+        with self.lock:
+            if len(self.durations) == 0:
+                return f"{self.name:<14} {0:>6} calls"
+            text = f"{self.name:<14} {len(self.durations):>6} calls, " \
+                   f"run p50 {percentile(self.durations, 0.5) * 1000:.1f}ms / " \
+                   f"p95 {percentile(self.durations, 0.95) * 1000:.1f}ms"
+            if len(self.latencies) > 0:
+                text = text + f", latency p50 {percentile(self.latencies, 0.5):.1f}s / " \
+                              f"p95 {percentile(self.latencies, 0.95):.1f}s / max {max(self.latencies):.1f}s"
+            return text
+
+
+# Replaces main.<name> with a wrapper that times each call. stageFor(*args) returns the Stage the call counts towards
+# and dueTime(*args) when the work was due (or None). The bot looks its functions up when it calls them so the wrapper
+# is picked up everywhere.
+def instrument(name: str, stageFor, dueTime):
+    function = getattr(main, name)
+
+    def timed(*args):
+        start = time.perf_counter()
+        try:
+            return function(*args)
+        finally:
+            due = dueTime(*args)
+            stageFor(*args).add(time.perf_counter() - start, None if due is None else clock.time() - due)
+
+    setattr(main, name, timed)
+
+
+class Replay:
+    def __init__(self, events: list, runtime: str):
+        self.events = events
+        self.runtime = runtime
+        self.fake = FakeReddit(main.BOT_USERNAME)
+        self.submissions = {}  # trace key -> FakeSubmission
+        self.droppedVotes = 0
+        self.votesSent = 0
+        self.stages = {
+            "firstReview": Stage("first review"),
+            "secondReview": Stage("second review"),
+            "vote": Stage("vote"),
+            "comment": Stage("comment"),
+            "closeVoting": Stage("voting closure"),
+        }
+
+        instrument("firstReviewPass", lambda *args: self.stages["firstReview"],
+                   lambda submission, *rest: submission.created_utc)
+        instrument("secondReviewPass", lambda *args: self.stages["secondReview"],
+                   lambda submission, *rest: submission.created_utc + main.PASS_DELAY)
+        # Every comment passes handleComment, votes are then counted by handleVote (on a shard thread)
+        instrument("handleComment", lambda *args: self.stages["comment"], lambda comment, *rest: comment.created_utc)
+        instrument("handleVote", lambda *args: self.stages["vote"], lambda comment, *rest: comment.created_utc)
+        instrument("closeVoting", lambda *args: self.stages["closeVoting"], self.closureDueTime)
+
+    # Voting closes on a list of posts. The latency recorded is that of the latest one
+    def closureDueTime(self, postIDList: list, *rest):
+        deadlines = [self.fake.things[postID].created_utc + main.VOTE_ACTION_DELAY for postID in postIDList
+                     if postID in self.fake.things]
+        return max(deadlines) if len(deadlines) > 0 else None
+
+    def subredditNames(self) -> list:
+        names = [main.SUBREDDIT]
+        for event in self.events:
+            if (event["type"] == "submission") and (event.get("subreddit", main.SUBREDDIT) not in names):
+                names.append(event["subreddit"])
+        return names
+
+    def botReply(self, submission):
+        for comment in submission.allComments:
+            if (comment.author == self.fake.username) and (comment.parent_id == submission.name):
+                return comment
+        return None
+
+    def play(self):
+        start = clock.time()
+        for event in self.events:
+            wait = start + event["t"] - clock.time()
+            if wait > 0:
+                clock.sleep(wait)
+
+            if event["type"] == "submission":
+                self.submissions[event["key"]] = self.fake.postSubmission(
+                    event.get("subreddit", main.SUBREDDIT), event["author"], event["title"], event.get("isSelf", False),
+                    event.get("flair"))
+            elif event["type"] == "message":
+                self.fake.sendMessage(event["author"], event["subject"], event["body"])
+            else:
+                submission = self.submissions.get(event["submission"])
+                if submission is None:
+                    continue
+                if event["type"] == "comment":
+                    self.fake.postComment(submission, submission.name, event["author"], event["body"])
+                else:
+                    reply = self.botReply(submission)
+                    if reply is None:
+                        self.droppedVotes += 1
+                        continue
+                    self.votesSent += 1
+                    self.fake.postComment(submission, reply.name, event["author"], event["body"])
+
+    def run(self, speedup: float):
+        sql.DB_FILE = tempfile.mktemp(suffix=".dat")
+        main.SUBREDDITS = {name: {} for name in self.subredditNames()}
+        main.METRICS_PORT = None
+        main.METRICS_FILE = None
+        clock.accelerate(speedup)
+        threading.Thread(target=main.startBot, args=[self.fake, self.fake, self.runtime, main.mainLogger],
+                         daemon=True).start()
+        time.sleep(STREAM_START_DELAY)
+
+        realStart = time.perf_counter()
+        virtualStart = clock.time()
+        self.play()
+
+        # Wait for the last post's voting to close
+        lastSubmission = max([event["t"] for event in self.events if event["type"] == "submission"], default=0)
+        clock.sleep(max(0, virtualStart + lastSubmission + main.VOTE_ACTION_DELAY - clock.time()))
+        while main.votingDeadlines.pending() > 0:
+            clock.sleep(DRAIN_TIME / 10)
+        clock.sleep(DRAIN_TIME)
+
+        self.report(time.perf_counter() - realStart, clock.time() - virtualStart)
+        for suffix in ["", "-wal", "-shm"]:
+            if os.path.exists(sql.DB_FILE + suffix):
+                os.remove(sql.DB_FILE + suffix)
+
+    def report(self, realSeconds: float, virtualSeconds: float):
+        submissions = len(self.submissions)
+        reviewed = len(self.stages["firstReview"].durations)
+        votes = len(self.stages["vote"].latencies)
+        calls = sum(self.fake.calls.values())
+        print(f"=== replay ({self.runtime}, {clock.speedup:.0f}x, {len(main.tenants)} subreddits) ===")
+        print(f"{realSeconds:.1f}s real, {virtualSeconds / 3600:.2f}h virtual")
+        print(f"submissions: {submissions} posted, {reviewed} reviewed, {reviewed / (realSeconds / 60):.1f}/min real")
+        print(f"votes: {self.votesSent} sent ({self.droppedVotes} dropped before the bot replied), {votes} handled, "
+              f"{votes / realSeconds:.1f}/s real")
+        for stage in self.stages.values():
+            print("    " + stage.line())
+        print(f"voting deadlines: {main.votingDeadlines.stats()}")
+        print(f"API calls: {calls} total, {calls / (virtualSeconds / 60):.1f}/min virtual, "
+              f"{self.fake.overLimit} over the rate limit")
+        for endpoint, count in self.fake.calls.most_common():
+            print(f"    {endpoint:<24} {count:>7}")
+        print(f"API budget: {main.apiBudget.stats()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay traffic against the bot using fakereddit")
+    parser.add_argument("--runtime", default="threaded", choices=["threaded", "asyncio"])
+    parser.add_argument("--speedup", type=float, default=REPLAY_SPEEDUP)
+    parser.add_argument("--hours", type=float, default=REPLAY_HOURS)
+    parser.add_argument("--rate", type=float, default=REPLAY_RATE)
+    parser.add_argument("--votes", type=int, default=REPLAY_VOTES)
+    parser.add_argument("--comments", type=int, default=REPLAY_COMMENTS)
+    parser.add_argument("--subreddits", type=int, default=1, help="spread synthetic traffic over this many subreddits")
+    parser.add_argument("--trace", help="replay this trace instead of synthetic traffic")
+    parser.add_argument("--save", help="write the replayed trace to this file")
+    arguments = parser.parse_args()
+
+    # The bot logs every action, which would drown the report
+    main.streamHandler.setLevel(logging.WARNING)
+
+    if arguments.trace is not None:
+        traceEvents = loadTrace(arguments.trace)
+    else:
+        traceEvents = syntheticTrace(arguments.hours, arguments.rate, arguments.votes, arguments.comments,
+                                     arguments.subreddits)
+    if arguments.save is not None:
+        saveTrace(arguments.save, traceEvents)
+
+    Replay(traceEvents, arguments.runtime).run(arguments.speedup)
+    # The bot's loops never return
+    os._exit(0)
@@ -0,0 +1,62 @@
+import heapq
+import itertools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import clock
+
+
+# Holds delayed jobs in a heap ordered by due time and hands them to a bounded pool of worker threads once they are due.
+# A pending job is only a (dueTime, sequence, function, args) tuple so waiting jobs cost no threads or connections.
+class Scheduler:
+    def __init__(self, workers: int, logger: logging.Logger, name: str = "scheduler"):
+        self.name = name
+        self.logger = logger
+        self.heap = []
+        self.sequence = itertools.count()  # Tie breaker so jobs due at the same time never compare functions
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self.dispatcher = threading.Thread(target=self.dispatch, name=f"{name}-dispatcher", daemon=True)
+
+    def start(self):
+        self.dispatcher.start()
+
+    # Run function(*args) on a worker after delay seconds
+    def schedule(self, delay: float, function, *args):
+        self.scheduleAt(clock.time() + delay, function, *args)
+
+    # Run function(*args) on a worker at the UNIX time dueTime
+    def scheduleAt(self, dueTime: float, function, *args):
+        with self.condition:
+            heapq.heappush(self.heap, (dueTime, next(self.sequence), function, args))
+            # Only the earliest job decides how long the dispatcher sleeps so it only needs waking for a new earliest
+            if self.heap[0][0] == dueTime:
+                self.condition.notify()
+
+    def pending(self) -> int:
+        with self.condition:
+            return len(self.heap)
+
+    def dispatch(self):
+        while True:
+            with self.condition:
+                while len(self.heap) == 0:
+                    self.condition.wait()
+
+                wait = self.heap[0][0] - clock.time()
+                if wait > 0:
+                    self.condition.wait(clock.timeout(wait))
+                    continue
+
+                dueTime, sequence, function, args = heapq.heappop(self.heap)
+
+            self.executor.submit(self.runJob, function, args)
+
+    def runJob(self, function, args: tuple):
+        try:
+            function(*args)
+        except Exception as e:
+            self.logger.error(f"A job in the {self.name} raised an exception. The job will not be retried.")
+            self.logger.error("Printing stack trace...")
+            self.logger.error(e)
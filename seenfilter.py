@@ -0,0 +1,71 @@
+import collections
+import threading
+
+import clock
+
+# Most IDs remembered at once. Past it the oldest are forgotten early, which only costs the checkpoints' protection
+# against repeats for those items, never a new item
+SEEN_FILTER_CAPACITY = 100000
+
+
+# Remembers the fullnames every ingest loop has handled so an item delivered twice (a stream restarting with an overlap,
+# a backfill meeting the live stream) is only handled once. The IDs are kept exactly, in the order they were seen, and
+# forgotten once they are window seconds old (or the oldest once there are SEEN_FILTER_CAPACITY of them), so an item
+# is only ever skipped if it really was handled: there are no false positives. IDs seen since the last snapshot are
+# handed out by snapshot for the DB so the filter is warm again after a restart.
+class SeenFilter:
+    def __init__(self, window: float, capacity: int = SEEN_FILTER_CAPACITY):
+        self.window = window
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.seen = collections.OrderedDict()  # Fullname -> UNIX time it was seen, oldest first
+        self.unsaved = []  # (Fullname, SeenTime) not in a snapshot yet
+        self.checked = 0
+        self.duplicates = 0
+        self.evicted = 0  # IDs forgotten for capacity before their window ran out
+
+    def expire(self):
+        cutoff = clock.time() - self.window
+        while len(self.seen) > 0:
+            fullname, seenTime = next(iter(self.seen.items()))
+            if seenTime >= cutoff and len(self.seen) <= self.capacity:
+                break
+            if seenTime >= cutoff:
+                self.evicted += 1
+            self.seen.popitem(last=False)
+
+    # Returns True if fullname was seen before, otherwise remembers it and returns False
+    def seenBefore(self, fullname: str) -> bool:
+        with self.lock:
+            self.checked += 1
+            if fullname in self.seen:
+                self.duplicates += 1
+                return True
+            seenTime = clock.time()
+            self.seen[fullname] = seenTime
+            self.unsaved.append((fullname, seenTime))
+            self.expire()
+            return False
+
+    def __len__(self) -> int:
+        with self.lock:
+            return len(self.seen)
+
+    # Rows for sql.saveSeenItems: (Fullname, SeenTime) of the IDs seen since the last snapshot
+    def snapshot(self) -> list:
+        with self.lock:
+            rows, self.unsaved = self.unsaved, []
+            return rows
+
+    # Restores rows of (Fullname, SeenTime), oldest first, as returned by sql.fetchSeenItems
+    def load(self, rows: list):
+        with self.lock:
+            for fullname, seenTime in rows:
+                self.seen[fullname] = seenTime
+            self.expire()
+
+    def stats(self) -> str:
+        with self.lock:
+            oldest = clock.time() - next(iter(self.seen.values())) if len(self.seen) > 0 else 0.0
+            return f"{self.checked} checked, {self.duplicates} seen before, {len(self.seen)} remembered (oldest " \
+                   f"{oldest:.0f}s), {self.evicted} forgotten early for capacity, no false positives (exact IDs)"
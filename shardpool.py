@@ -0,0 +1,76 @@
+import logging
+import queue
+import threading
+import time
+import zlib
+
+import metrics
+
+
+# Hands work to a fixed set of worker threads by key. Everything submitted with the same key goes to the same shard (a
+# thread with its own FIFO queue) so it is handled one item at a time in submission order, while different keys are
+# handled in parallel. The queues are bounded: submit blocks while the shard's queue is full, which holds the loop
+# feeding the pool to the pace of the workers instead of letting the backlog grow without limit.
+class ShardPool:
+    def __init__(self, shards: int, queueSize: int, handler, logger: logging.Logger, name: str = "shard"):
+        self.handler = handler  # Called as handler(*args) on the shard's thread
+        self.logger = logger
+        self.name = name
+        self.queues = [queue.Queue(queueSize) for shard in range(shards)]
+        self.threads = [threading.Thread(target=self.run, args=[shardQueue], name=f"{name}-{shard}", daemon=True)
+                        for shard, shardQueue in enumerate(self.queues)]
+        self.lock = threading.Lock()
+        self.submitted = 0
+        self.waits = 0  # Submits that found their shard's queue full
+        self.waited = 0.0
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    # crc32 rather than hash() so a key lands on the same shard every run, which makes runs comparable
+    def shardOf(self, key: str) -> int:
+        return zlib.crc32(key.encode()) % len(self.queues)
+
+    def submit(self, key: str, *args):
+        shardQueue = self.queues[self.shardOf(key)]
+        with self.lock:
+            self.submitted += 1
+        try:
+            shardQueue.put_nowait(args)
+            return
+        except queue.Full:
+            pass
+
+        start = time.perf_counter()
+        shardQueue.put(args)
+        waited = time.perf_counter() - start
+        with self.lock:
+            self.waits += 1
+            self.waited += waited
+        metrics.registry.observe("bot_shard_backpressure_seconds", waited, pool=self.name)
+
+    def run(self, shardQueue: queue.Queue):
+        while True:
+            args = shardQueue.get()
+            try:
+                self.handler(*args)
+            except Exception as e:
+                self.logger.error(f"A {self.name} worker was unable to handle an item. It will carry on with the next.")
+                self.logger.error(e)
+            finally:
+                shardQueue.task_done()
+
+    # Waits until everything submitted so far has been handled
+    def join(self):
+        for shardQueue in self.queues:
+            shardQueue.join()
+
+    def pending(self) -> int:
+        return sum(shardQueue.qsize() for shardQueue in self.queues)
+
+    def stats(self) -> str:
+        with self.lock:
+            return f"{self.submitted} submitted, {self.pending()} queued " \
+                   f"(largest shard {max(shardQueue.qsize() for shardQueue in self.queues)}), " \
+                   f"{self.waits} submits waited {self.waited:.2f}s for a full shard"
@@ -1,8 +1,10 @@
 import sqlite3
 from sqlite3 import Error
-import time
+import threading
 
+import clock
 import main
+import queryprofile
 
 import praw
 
@@ -15,6 +17,34 @@ ADDITIONAL_PASS_DELAY = 30
 # Age of post (seconds) that should be removed from the database (1 day = 86400 seconds)
 REMOVE_AGE = 86400
 
+# Age of message (seconds) that should be removed from the database even if the notifier never sent it
+MESSAGE_REMOVE_AGE = 86400
+
+# Free pages the database file may hold before removeExpiredPostsFromDB gives them back to the file system
+INCREMENTAL_VACUUM_PAGES = 256
+
+# Seconds a connection waits for another connection's write lock before raising "database is locked"
+BUSY_TIMEOUT = 10
+
+# Prepared statements kept per connection. Queries are reused verbatim so every helper's statements stay prepared
+CACHED_STATEMENTS = 256
+
+# Time every statement, keep per statement percentiles and write statements slower than SLOW_QUERY_SECONDS to
+# SLOW_QUERY_LOG with their parameters and calling function (see queryprofile.py). Adds a few microseconds per statement
+PROFILE_QUERIES = False
+SLOW_QUERY_SECONDS = 0.05
+SLOW_QUERY_LOG = "slowqueries.log"
+
+# Applied to every connection. WAL lets readers carry on while one thread writes and with it synchronous=NORMAL only
+# syncs at checkpoints. cache_size is in KiB when negative.
+CONNECTION_PRAGMAS = [
+    "PRAGMA journal_mode = WAL;",
+    "PRAGMA synchronous = NORMAL;",
+    "PRAGMA cache_size = -16384;",
+    "PRAGMA mmap_size = 67108864;",
+    "PRAGMA temp_store = MEMORY;",
+]
+
 # Name of SQL table
 TABLE_NAME = "posts"
 
@@ -24,9 +54,24 @@ SEPARATOR = ","
 # Name of message SQL table
 MESSAGE_TABLE_NAME = "messages"
 
+# Name of the SQL table holding one row per vote
+VOTES_TABLE_NAME = "votes"
+
+# Name of the SQL table holding the review jobs waiting to run (see jobqueue.py)
+JOB_TABLE_NAME = "jobs"
+
+# Name of the SQL table holding where each stream got to (see checkpoints.py)
+CHECKPOINT_TABLE_NAME = "checkpoints"
+
+# Name of the SQL table holding the IDs the seen filter remembers (see seenfilter.py)
+SEEN_TABLE_NAME = "seen"
+
+# Version of the schema created by createTables. Older databases are brought up to date by migrateTables
+SCHEMA_VERSION = 9
+
 CREATE_TABLE_QUERY = f"CREATE TABLE IF NOT EXISTS {TABLE_NAME} ( PostID text PRIMARY KEY, ReviewTime integer, " \
                      f"VotingTime integer, PostTime integer, ReplyID text, VotingOptions text, Votes text, " \
-                     f"Voters text, IsVoteable integer, ReviewState integer );"
+                     f"Voters text, IsVoteable integer, ReviewState integer, Subreddit text );"
 # === Table entries: ===
 # PostID is the Reddit assigned ID for the post.
 # ReviewTime is the UNIX time (in seconds) + 120s that the post was due to be reviewed
@@ -34,17 +79,20 @@ CREATE_TABLE_QUERY = f"CREATE TABLE IF NOT EXISTS {TABLE_NAME} ( PostID text PRI
 # PostTime is the UNIX time (in seconds) that the post was made
 # ReplyID is the Reddit assigned ID for the standard reply made by the bot.
 # VotingOptions is a comma denoted list of voting options used for the removal voting process
-# Votes keeps track of votes for votingOptions in the same structure as VotingOptions. Used like a dict.
-# Voters is a comma denoted list of users who have made a vote on the post
+# Votes holds tallies in the same structure as VotingOptions that were carried over from before votes were stored in
+#     the votes table (schema version 0). It is "0" for every option on new posts. Used like a dict.
+# Voters is unused since schema version 1. Voters are rows in the votes table.
 # IsVoteable tracks if voting is enabled. 1=True, 0=False
 # ReviewState: 0=First pass done, 1=Second pass done, 3=Voting done (rows should be deleted before 3)
+# Subreddit is the name of the subreddit (tenant) the post was made in. NULL for posts stored before schema version 4
 # === Other things to do with the table: ===
 # Posts which are removed for double dipping on the first pass should not be added to the table.
 # Posts which have been reviewed should be removed form the table
 # Posts older than REMOVE_AGE should be removed from the table and an error should be logged with the PostID.
 
 CREATE_MESSAGE_TABLE_QUERY = f"CREATE TABLE IF NOT EXISTS {MESSAGE_TABLE_NAME} ( MessageID text PRIMARY KEY, " \
-                             f"Subject text, Body text, Sender text, IsUserMessage integer, MessageTime integer );"
+                             f"Subject text, Body text, Sender text, IsUserMessage integer, MessageTime integer, " \
+                             f"Subreddit text );"
 # === Table entries: ===
 # MessageID is ideally the ID of the message (only needed as a primary key). It
 # Subject is the subject line of the message
@@ -53,9 +101,90 @@ CREATE_MESSAGE_TABLE_QUERY = f"CREATE TABLE IF NOT EXISTS {MESSAGE_TABLE_NAME} (
 # Is user message is a boolean denoting if the user sent the message of of it is a notification made by the moderator /
 #     bot. 0 = moderator bot message/ 1 = message from the user
 # MessageTime is the time the message was added to the database
+# Subreddit is the subreddit whose modmail the message is forwarded to. NULL for the home subreddit (see tenants.py)
+
+# The primary key is the unique (PostID, Voter) index that stops anyone voting twice. WITHOUT ROWID stores the rows in
+# that index directly.
+CREATE_VOTES_TABLE_QUERY = f"CREATE TABLE IF NOT EXISTS {VOTES_TABLE_NAME} ( PostID text NOT NULL, " \
+                           f"Voter text NOT NULL, Option text, PRIMARY KEY (PostID, Voter) ) WITHOUT ROWID;"
+# === Table entries: ===
+# PostID is the Reddit assigned ID for the post that was voted on
+# Voter is the name of the user that voted
+# Option is the voting option that was voted for. NULL for voters carried over from the Voters column, their votes
+#     are already counted in posts.Votes
+
+# One row per review stage still to run on a post, so a stage can't be queued twice. Claiming a job sets its lease and
+# finishing it deletes the row.
+CREATE_JOB_TABLE_QUERY = f"CREATE TABLE IF NOT EXISTS {JOB_TABLE_NAME} ( JobType text NOT NULL, " \
+                         f"PostID text NOT NULL, DueTime real NOT NULL, ReviewState integer, LeaseOwner text, " \
+                         f"LeaseExpiry real, Attempts integer NOT NULL DEFAULT 0, PRIMARY KEY (JobType, PostID) ) " \
+                         f"WITHOUT ROWID;"
+# === Table entries: ===
+# JobType is the review stage to run, main.FIRST_REVIEW_JOB or main.SECOND_REVIEW_JOB
+# PostID is the Reddit assigned ID for the post to review
+# DueTime is the UNIX time the job may run from
+# ReviewState is the ReviewState the post had when the job was queued. NULL if the post wasn't in the posts table yet
+# LeaseOwner is the worker (jobqueue.JobQueue.owner) running the job. NULL while the job waits
+# LeaseExpiry is the UNIX time after which another worker may claim the job. Running jobs have their leases renewed
+# Attempts is the number of times the job has been claimed
+
+CREATE_CHECKPOINT_TABLE_QUERY = f"CREATE TABLE IF NOT EXISTS {CHECKPOINT_TABLE_NAME} ( Stream text PRIMARY KEY, " \
+                                f"Fullname text NOT NULL, CreatedUTC real, UpdatedTime real );"
+# === Table entries: ===
+# Stream is the stream and the kind of item: "submissions/t3", "comments/t1", "inbox/t4" or "inbox/t1"
+# Fullname is the fullname (such as t1_abc123) of the newest item the stream has handled
+# CreatedUTC is the UNIX time that item was posted
+# UpdatedTime is the UNIX time the checkpoint was last moved
+# Added in schema version 6. createTables creates it in older databases too so it needs no migration.
+
+CREATE_SEEN_TABLE_QUERY = f"CREATE TABLE IF NOT EXISTS {SEEN_TABLE_NAME} ( Fullname text PRIMARY KEY, " \
+                          f"SeenTime real NOT NULL ) WITHOUT ROWID;"
+CREATE_SEEN_INDEX_QUERY = f"CREATE INDEX IF NOT EXISTS SeenSeenTime ON {SEEN_TABLE_NAME} (SeenTime);"
+# === Table entries: ===
+# Fullname is the fullname of an item an ingest loop has handled
+# SeenTime is the UNIX time it was handled
+# Added in schema version 8 (replacing version 7's seenfilter table). createTables creates it in older databases too.
+
+# Indexes for the columns the background loops filter on (schema version 2)
+CREATE_INDEX_QUERIES = [
+    f"CREATE INDEX IF NOT EXISTS PostsVotingTime ON {TABLE_NAME} (VotingTime);",
+    f"CREATE INDEX IF NOT EXISTS PostsPostTime ON {TABLE_NAME} (PostTime);",
+    f"CREATE INDEX IF NOT EXISTS MessagesMessageTime ON {MESSAGE_TABLE_NAME} (MessageTime);",
+]
+
+# Claims look for waiting jobs by due time (schema version 5)
+CREATE_JOB_INDEX_QUERY = f"CREATE INDEX IF NOT EXISTS JobsDueTime ON {JOB_TABLE_NAME} (DueTime);"
+# Every job poll renews the leases of one owner. Only leased jobs are in the index so it stays as small as the number
+# of jobs running.
+CREATE_JOB_LEASE_INDEX_QUERY = f"CREATE INDEX IF NOT EXISTS JobsLeaseOwner ON {JOB_TABLE_NAME} (LeaseOwner) " \
+                               f"WHERE LeaseOwner IS NOT NULL;"
 
 logger = main.mainLogger
 
+# Holds each thread's connections, see threadConnection
+threadState = threading.local()
+
+# Statement timings when PROFILE_QUERIES is on, set by startQueryProfiling. Connections opened before then aren't timed
+queryProfiler = None
+
+# Functions called with a list of PostIDs whenever posts are removed from the database. Caches register here so they
+# can evict their copies.
+removalListeners = []
+
+
+def notifyRemoval(postIDList: list):
+    for listener in removalListeners:
+        listener(postIDList)
+
+
+# Functions called with (PostID, VotingTime) whenever a post is inserted into the database
+insertionListeners = []
+
+
+def notifyInsertion(postID: str, votingTime: float):
+    for listener in insertionListeners:
+        listener(postID, votingTime)
+
 
 def encodeVotingOptions(votingOptions: list) -> str:
     separator = SEPARATOR
@@ -67,17 +196,12 @@ def encodeVotes(votes: list) -> str:
     return separator.join(list(map(str, votes)))
 
 
-def encodeVoters(voters: list) -> str:
-    separator = SEPARATOR
-    return separator.join(voters)
-
-
 def decodeVotingOptions(votingOptions: str) -> list:
     return votingOptions.split(SEPARATOR)
 
 
 def decodeVotes(votes: str) -> list:
-    logger.debug(f"Decoded votes: {votes}")
+    logger.debug("Decoded votes: %s", votes)
     return list(map(int, votes.split(SEPARATOR)))
 
 
@@ -85,15 +209,55 @@ def decodeVoters(voters: str) -> list:
     return voters.split(SEPARATOR)
 
 
-def createDBConnection(file: str):
+def startQueryProfiling():
+    global queryProfiler
+    if queryProfiler is None:
+        queryProfiler = queryprofile.QueryProfiler(SLOW_QUERY_SECONDS, queryprofile.slowQueryLogger(
+            SLOW_QUERY_LOG, main.LOG_MAX_BYTES, main.LOG_BACKUPS))
+
+
+def createDBConnection(file: str, readOnly: bool = False):
     connection = None
+    factory = sqlite3.Connection if queryProfiler is None else queryprofile.ProfiledConnection
     try:
-        connection = sqlite3.connect(file)
+        if readOnly:
+            connection = sqlite3.connect(f"file:{file}?mode=ro", uri=True, timeout=BUSY_TIMEOUT,
+                                         cached_statements=CACHED_STATEMENTS, factory=factory)
+        else:
+            connection = sqlite3.connect(file, timeout=BUSY_TIMEOUT, cached_statements=CACHED_STATEMENTS,
+                                         factory=factory)
+        if queryProfiler is not None:
+            connection.profiler = queryProfiler
+        for pragma in CONNECTION_PRAGMAS:
+            connection.execute(pragma).fetchall()
     except Error as e:
         print(e)
     return connection
 
 
+# Returns this thread's connection to DB_FILE, opening it on first use. Connections live as long as their thread so
+# loops and workers never open more than one (or two with a read-only one) each.
+def threadConnection(readOnly: bool = False) -> sqlite3.Connection:
+    connections = threadState.__dict__.setdefault("connections", {})
+    key = (DB_FILE, readOnly)
+    if connections.get(key) is None:
+        connections[key] = createDBConnection(DB_FILE, readOnly)
+    return connections[key]
+
+
+def closeThreadConnections():
+    for connection in threadState.__dict__.pop("connections", {}).values():
+        if connection is not None:
+            connection.close()
+
+
+# Commits only if a statement since the last commit actually wrote something. Threads that group several operations
+# into one transaction (see dbwriter.DBWriter) set threadState.batching and commit themselves.
+def commit(connection: sqlite3.Connection):
+    if connection.in_transaction and not getattr(threadState, "batching", False):
+        connection.commit()
+
+
 def createTables():
     try:
         connection = createDBConnection(DB_FILE)
@@ -102,17 +266,130 @@ def createTables():
         connection.commit()
         cursor.execute(CREATE_MESSAGE_TABLE_QUERY)
         connection.commit()
+        cursor.execute(CREATE_VOTES_TABLE_QUERY)
+        connection.commit()
+        cursor.execute(CREATE_JOB_TABLE_QUERY)
+        cursor.execute(CREATE_JOB_INDEX_QUERY)
+        cursor.execute(CREATE_JOB_LEASE_INDEX_QUERY)
+        connection.commit()
+        cursor.execute(CREATE_CHECKPOINT_TABLE_QUERY)
+        connection.commit()
+        cursor.execute(CREATE_SEEN_TABLE_QUERY)
+        cursor.execute(CREATE_SEEN_INDEX_QUERY)
+        connection.commit()
+        migrateTables(connection)
         connection.close()
     except Error as e:
         print(e)
 
 
+def migrateTables(connection: sqlite3.Connection):
+    cursor = connection.cursor()
+    cursor.execute("PRAGMA user_version;")
+    version = cursor.fetchall()[0][0]
+
+    if version < 1:
+        migrateVotersToVotesTable(connection)
+
+    if version < 2:
+        createIndexes(connection)
+
+    if version < 3:
+        enableIncrementalVacuum(connection)
+
+    if version < 4:
+        addSubredditColumns(connection)
+
+    if version < 5:
+        queueUnreviewedPosts(connection)
+
+    if version < 8:
+        dropSeenFilterTable(connection)
+
+    if version < 9:
+        dropUnreviewedIndex(connection)
+
+    if version < SCHEMA_VERSION:
+        logger.info("Migrated database from schema version %s to %s", version, SCHEMA_VERSION)
+        cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION};")
+        connection.commit()
+
+
+# Schema version 0 -> 1. Moves the comma joined Voters column into the votes table. Which option each voter picked was
+# never stored so they are added without one. Their votes stay counted in the Votes column.
+def migrateVotersToVotesTable(connection: sqlite3.Connection):
+    cursor = connection.cursor()
+    cursor.execute(f"SELECT PostID, Voters FROM {TABLE_NAME} WHERE Voters IS NOT NULL AND Voters != '';")
+    rows = [(postID, voter) for postID, voters in cursor.fetchall() for voter in decodeVoters(voters) if voter != ""]
+
+    query = f"INSERT OR IGNORE INTO {VOTES_TABLE_NAME} (PostID, Voter, Option) VALUES (?, ?, NULL);"
+    cursor.executemany(query, rows)
+    cursor.execute(f"UPDATE {TABLE_NAME} SET Voters = '';")
+    connection.commit()
+
+
+# Schema version 3 -> 4. Adds the Subreddit column for multi-subreddit mode. Tables created by this version already
+# have it.
+def addSubredditColumns(connection: sqlite3.Connection):
+    cursor = connection.cursor()
+    for table in [TABLE_NAME, MESSAGE_TABLE_NAME]:
+        cursor.execute(f"PRAGMA table_info({table});")
+        if "Subreddit" not in [column[1] for column in cursor.fetchall()]:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN Subreddit text;")
+    connection.commit()
+
+
+# Schema version 4 -> 5. Second reviews used to wait in memory (posts at ReviewState = 1, which lost them when the bot
+# stopped) and posts recovered after downtime (ReviewState = 0) were picked up by the persistence loop. Both are given a
+# job so the job queue reviews them instead. Posts past their first pass wait until their ReviewTime like before.
+def queueUnreviewedPosts(connection: sqlite3.Connection):
+    cursor = connection.cursor()
+    cursor.execute(f"INSERT OR IGNORE INTO {JOB_TABLE_NAME} (JobType, PostID, DueTime, ReviewState) "
+                   f"SELECT ?, PostID, CASE WHEN ReviewState = 0 THEN ? ELSE ReviewTime END, ReviewState "
+                   f"FROM {TABLE_NAME} WHERE ReviewState IN (0, 1);",
+                   (main.SECOND_REVIEW_JOB, clock.time()))
+    connection.commit()
+
+
+# Schema version 7 -> 8. The seen filter used to be saved as two Bloom filters, which could take a new item for a
+# handled one. Its IDs are now stored exactly in the seen table so the old snapshot is dropped.
+def dropSeenFilterTable(connection: sqlite3.Connection):
+    cursor = connection.cursor()
+    cursor.execute("DROP TABLE IF EXISTS seenfilter;")
+    connection.commit()
+
+
+# Schema version 8 -> 9. Unreviewed posts used to be found with the partial PostsUnreviewed index. The job queue tracks
+# them now so the index only cost every insert its upkeep.
+def dropUnreviewedIndex(connection: sqlite3.Connection):
+    cursor = connection.cursor()
+    cursor.execute("DROP INDEX IF EXISTS PostsUnreviewed;")
+    connection.commit()
+
+
+# Schema version 1 -> 2
+def createIndexes(connection: sqlite3.Connection):
+    cursor = connection.cursor()
+    for query in CREATE_INDEX_QUERIES:
+        cursor.execute(query)
+    connection.commit()
+
+
+# Schema version 2 -> 3. Lets removeExpiredPostsFromDB shrink the file after a spike. The auto_vacuum mode of an
+# existing database only changes with a full VACUUM, which can't run inside a transaction.
+def enableIncrementalVacuum(connection: sqlite3.Connection):
+    connection.commit()
+    cursor = connection.cursor()
+    cursor.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+    cursor.execute("VACUUM;")
+
+
 def insertSubmissionIntoDB(connection: sqlite3.Connection, submission: praw.models.Submission, reply,
                            votingOptions: list, isVoteable: bool):
     reviewTime = submission.created_utc + main.PASS_DELAY + ADDITIONAL_PASS_DELAY
     votingTime = submission.created_utc + main.VOTE_ACTION_DELAY
     query = f"INSERT INTO {TABLE_NAME} (PostID, ReviewTime, VotingTime, PostTime, ReplyID, VotingOptions, Votes, " \
-            f"Voters, IsVoteable, ReviewState) VALUES (?,?,?,?,?,?,?,?,?,?)"
+            f"Voters, IsVoteable, ReviewState, Subreddit) VALUES (?,?,?,?,?,?,?,?,?,?,?)"
 
     if (votingOptions is None) or (len(votingOptions) == 0) or (isVoteable is None):
         return
@@ -126,59 +403,48 @@ def insertSubmissionIntoDB(connection: sqlite3.Connection, submission: praw.mode
         encodedVotes = encodedVotes + "0" + SEPARATOR
     encodedVotes = encodedVotes + "0"
 
-    logger.debug(f"Encoded voting options being put into new db entry: {encodedVoteOptions}")
-    logger.debug(f"Encoded votes being put into new db entry: {encodedVotes}")
+    logger.debug("Encoded voting options being put into new db entry: %s", encodedVoteOptions)
+    logger.debug("Encoded votes being put into new db entry: %s", encodedVotes)
 
     values = None
     if (reply is not None) and (reply is not "") and (submission is not None):
         values = (submission.id, reviewTime, votingTime, submission.created_utc, reply.id, encodedVoteOptions,
-                  encodedVotes, "", int(isVoteable), 0)
+                  encodedVotes, "", int(isVoteable), 0, submission.subreddit.display_name)
     elif (reply is None) or (reply is ""):
         values = (submission.id, reviewTime, votingTime, submission.created_utc, None, encodedVoteOptions,
-                  encodedVotes, "", int(isVoteable), 0)
+                  encodedVotes, "", int(isVoteable), 0, submission.subreddit.display_name)
     else:
         return
     cursor = connection.cursor()
     cursor.execute(query, values)
-    connection.commit()
+    commit(connection)
+    notifyInsertion(submission.id, votingTime)
 
 
-# This only updates the database. It does not make any edits to posts
-def updateVotes(connection: sqlite3.Connection, submissionID: str, votes: list):
-    if (connection is None) or (submissionID is None) or (submissionID == "") or (votes is None) or (len(votes) == 0):
-        return
+# Records a vote for option by voter. The vote is only recorded if the post exists, is voteable, has option as one of
+# its voting options and voter has not voted on it before. Returns True if the vote was recorded.
+def castVote(connection: sqlite3.Connection, submissionID: str, voter: str, option: str) -> bool:
+    if (connection is None) or (submissionID is None) or (submissionID == "") or (voter is None) or (option is None):
+        return False
 
-    # Check if the amount of votes matches the amount of votingOptions
-    selectQuery = f"SELECT VotingOptions FROM {TABLE_NAME} WHERE PostID = ?;"
+    query = f"INSERT OR IGNORE INTO {VOTES_TABLE_NAME} (PostID, Voter, Option) " \
+            f"SELECT PostID, ?, ? FROM {TABLE_NAME} WHERE PostID = ? AND IsVoteable = 1 " \
+            f"AND instr('{SEPARATOR}' || VotingOptions || '{SEPARATOR}', ?) > 0;"
     cursor = connection.cursor()
-    cursor.execute(selectQuery, (submissionID,))
-    votingOptionsTupleList = cursor.fetchall()
-    connection.commit()
-    numberOfVotingOptions = len(decodeVotingOptions(votingOptionsTupleList[0][0]))
+    cursor.execute(query, (voter, option, submissionID, SEPARATOR + option + SEPARATOR))
+    commit(connection)
 
-    logger.debug(f"Voting options tuple list: {votingOptionsTupleList}")
-
-    if len(votes) != numberOfVotingOptions:
-        return
-
-    # Update the votes in the database
-    updateQuery = f"UPDATE {TABLE_NAME} SET Votes = ? WHERE PostID = ?"
-    encodedVotes = encodeVotes(votes)
-    cursor = connection.cursor()
-    cursor.execute(updateQuery, (encodedVotes, submissionID))
-    connection.commit()
+    return cursor.rowcount == 1
 
 
-def updateVoters(connection: sqlite3.Connection, submissionID: str, voters: list):
-    if (connection is None) or (submissionID is None) or (submissionID == "") or (voters is None) or (len(voters) == 0):
-        return
+def hasVoted(connection: sqlite3.Connection, submissionID: str, voter: str) -> bool:
+    if (connection is None) or (submissionID is None) or (submissionID == "") or (voter is None):
+        return False
 
-    # Update the voters in the database
-    query = f"UPDATE {TABLE_NAME} SET Voters = ? WHERE PostID = ?"
-    encodedVoters = encodeVoters(voters)
+    query = f"SELECT 1 FROM {VOTES_TABLE_NAME} WHERE PostID = ? AND Voter = ?;"
     cursor = connection.cursor()
-    cursor.execute(query, (encodedVoters, submissionID))
-    connection.commit()
+    cursor.execute(query, (submissionID, voter))
+    return cursor.fetchone() is not None
 
 
 def isVoteable(connection: sqlite3.Connection, submissionID: str) -> bool:
@@ -189,7 +455,6 @@ def isVoteable(connection: sqlite3.Connection, submissionID: str) -> bool:
     cursor = connection.cursor()
     cursor.execute(query, (submissionID,))
     tupleList = cursor.fetchall()
-    connection.commit()
 
     return bool(tupleList[0][0])
 
@@ -202,7 +467,20 @@ def updateVotingEligibility(connection: sqlite3.Connection, submissionID: str, v
     query = f"UPDATE {TABLE_NAME} SET IsVoteable = ? WHERE PostID = ?"
     cursor = connection.cursor()
     cursor.execute(query, (int(votingEligibility), submissionID))
-    connection.commit()
+    commit(connection)
+
+
+# Counts votes per option in the votes table and adds them to the tallies carried over in the Votes column
+def tallyVotes(cursor: sqlite3.Cursor, submissionID: str, votingOptions: list, carriedVotes: list) -> dict:
+    votes = dict(zip(votingOptions, carriedVotes))
+
+    query = f"SELECT Option, COUNT(*) FROM {VOTES_TABLE_NAME} WHERE PostID = ? AND Option IS NOT NULL GROUP BY Option;"
+    cursor.execute(query, (submissionID,))
+    for option, count in cursor.fetchall():
+        if option in votes:
+            votes[option] = votes[option] + count
+
+    return votes
 
 
 def fetchVotes(connection: sqlite3.Connection, submissionID: str) -> dict:
@@ -214,24 +492,41 @@ def fetchVotes(connection: sqlite3.Connection, submissionID: str) -> dict:
     cursor = connection.cursor()
     cursor.execute(query, (submissionID,))
     tupleList = cursor.fetchall()
-    connection.commit()
 
     decodedVotingOptions = decodeVotingOptions(tupleList[0][0])
     decodedVotes = decodeVotes(tupleList[0][1])
-    return dict(zip(decodedVotingOptions, decodedVotes))
+    return tallyVotes(cursor, submissionID, decodedVotingOptions, decodedVotes)
+
+
+# Everything needed to serve votes for a post. Tuple structure: [0] ReplyID, [1] PostTime, [2] VotingTime,
+# [3] Votes (dict), [4] Voters (list), [5] IsVoteable (bool). None if the post is not in the DB
+def fetchPostRecord(connection: sqlite3.Connection, submissionID: str):
+    if (connection is None) or (submissionID is None) or (submissionID == ""):
+        return None
+
+    query = f"SELECT ReplyID, PostTime, VotingTime, VotingOptions, Votes, IsVoteable FROM {TABLE_NAME} " \
+            f"WHERE PostID = ?;"
+    cursor = connection.cursor()
+    cursor.execute(query, (submissionID,))
+    tupleList = cursor.fetchall()
+
+    if len(tupleList) == 0:
+        return None
+
+    replyID, postTime, votingTime, votingOptions, votes, isVoteable = tupleList[0]
+    votes = tallyVotes(cursor, submissionID, decodeVotingOptions(votingOptions), decodeVotes(votes))
+    return replyID, postTime, votingTime, votes, fetchVoters(connection, submissionID), bool(isVoteable)
 
 
 def fetchVoters(connection: sqlite3.Connection, submissionID: str) -> list:
     if (connection is None) or (submissionID is None) or (submissionID == ""):
         return []
 
-    query = f"SELECT Voters FROM {TABLE_NAME} WHERE PostID = ?;"
+    query = f"SELECT Voter FROM {VOTES_TABLE_NAME} WHERE PostID = ?;"
     cursor = connection.cursor()
     cursor.execute(query, (submissionID,))
-    tupleList = cursor.fetchall()
-    connection.commit()
 
-    return decodeVoters(tupleList[0][0])
+    return [voterTuple[0] for voterTuple in cursor.fetchall()]
 
 
 def insertUserMessageIntoDB(connection: sqlite3.Connection, message: praw.models.Submission):
@@ -242,29 +537,30 @@ def insertUserMessageIntoDB(connection: sqlite3.Connection, message: praw.models
             f"VALUES (?,?,?,?,?,?)"
     values = None
     if message is not None:
-        values = (message.id, message.subject, message.body, message.author.name, 1, time.time())
+        values = (message.id, message.subject, message.body, message.author.name, 1, clock.time())
     else:
         return
     cursor = connection.cursor()
     cursor.execute(query, values)
-    connection.commit()
+    commit(connection)
 
 
-def insertBotMessageIntoDB(connection: sqlite3.Connection, subject: str, body: str):
+# subreddit is the subreddit whose modmail gets the message, the home subreddit when None
+def insertBotMessageIntoDB(connection: sqlite3.Connection, subject: str, body: str, subreddit: str = None):
     if connection is None:
         return
 
-    query = f"INSERT INTO {MESSAGE_TABLE_NAME} (MessageID , Subject, Body, IsUserMessage, MessageTime) " \
-            f"VALUES (?,?,?,?,?)"
+    query = f"INSERT INTO {MESSAGE_TABLE_NAME} (MessageID , Subject, Body, IsUserMessage, MessageTime, Subreddit) " \
+            f"VALUES (?,?,?,?,?,?)"
     values = None
     if subject is not None or subject is "":
-        UID = str(time.time()) + body
-        values = (UID, subject, body, 0, time.time())
+        UID = str(clock.time()) + body
+        values = (UID, subject, body, 0, clock.time(), subreddit)
     else:
         return
     cursor = connection.cursor()
     cursor.execute(query, values)
-    connection.commit()
+    commit(connection)
 
 
 def removePostFromDB(connection: sqlite3.Connection, submission: praw.models.Submission):
@@ -272,11 +568,13 @@ def removePostFromDB(connection: sqlite3.Connection, submission: praw.models.Sub
         return
 
     query = f"DELETE FROM {TABLE_NAME} WHERE PostID = ?;"
+    votesQuery = f"DELETE FROM {VOTES_TABLE_NAME} WHERE PostID = ?;"
     cursor = connection.cursor()
     cursor.execute(query, (submission.id,))
-    connection.commit()
-    print(f"{submission.id} removed from table {TABLE_NAME}")
-    print()
+    cursor.execute(votesQuery, (submission.id,))
+    commit(connection)
+    notifyRemoval([submission.id])
+    logger.debug("%s removed from table %s", submission.id, TABLE_NAME)
 
 
 def removePostByIDFromDB(connection: sqlite3.Connection, postID: str):
@@ -284,11 +582,13 @@ def removePostByIDFromDB(connection: sqlite3.Connection, postID: str):
         return
 
     query = f"DELETE FROM {TABLE_NAME} WHERE PostID = ?;"
+    votesQuery = f"DELETE FROM {VOTES_TABLE_NAME} WHERE PostID = ?;"
     cursor = connection.cursor()
     cursor.execute(query, (postID,))
-    connection.commit()
-    print(f"{postID} removed from table {TABLE_NAME}")
-    print()
+    cursor.execute(votesQuery, (postID,))
+    commit(connection)
+    notifyRemoval([postID])
+    logger.debug("%s removed from table %s", postID, TABLE_NAME)
 
 
 def removeMessageFromDB(connection: sqlite3.Connection, message: praw.models.Message):
@@ -298,9 +598,8 @@ def removeMessageFromDB(connection: sqlite3.Connection, message: praw.models.Mes
     query = f"DELETE FROM {MESSAGE_TABLE_NAME} WHERE MessageID = ?"
     cursor = connection.cursor()
     cursor.execute(query, (message.id,))
-    connection.commit()
-    print(f"{message.id} removed from table {MESSAGE_TABLE_NAME}")
-    print()
+    commit(connection)
+    logger.debug("%s removed from table %s", message.id, MESSAGE_TABLE_NAME)
 
 
 def removeMessageByIDFromDB(connection: sqlite3.Connection, messageID: str):
@@ -310,55 +609,68 @@ def removeMessageByIDFromDB(connection: sqlite3.Connection, messageID: str):
     query = f"DELETE FROM {MESSAGE_TABLE_NAME} WHERE MessageID = ?"
     cursor = connection.cursor()
     cursor.execute(query, (messageID,))
-    connection.commit()
-    print(f"{messageID} removed from database {MESSAGE_TABLE_NAME}")
-    print()
+    commit(connection)
+    logger.debug("%s removed from database %s", messageID, MESSAGE_TABLE_NAME)
 
 
+# Deletes posts older than REMOVE_AGE (with their votes) and messages older than MESSAGE_REMOVE_AGE. Each table is
+# cleared by one statement and everything is committed in a single transaction. Run through dbwriter.DBWriter the
+# writer's batch is that transaction and an error is left to the writer, which only undoes this operation.
 def removeExpiredPostsFromDB(connection: sqlite3.Connection):
     if connection is None:
         return
 
-    currentUNIXTime = time.time()
-    filter = (currentUNIXTime - REMOVE_AGE,)
-    postsQuery = f"SELECT PostID FROM {TABLE_NAME} WHERE PostTime < ?;"
-    messagesQuery = f"SELECT MessageID FROM {MESSAGE_TABLE_NAME} WHERE MessageTime < ?"
+    currentUNIXTime = clock.time()
+    postFilter = (currentUNIXTime - REMOVE_AGE,)
+    messageFilter = (currentUNIXTime - MESSAGE_REMOVE_AGE,)
 
     cursor = connection.cursor()
-    cursor.execute(postsQuery, filter)
-    postIDList = cursor.fetchall()
-    connection.commit()
-
-    for postID in postIDList:
-        try:
-            removePostByIDFromDB(connection, "".join(postID))
-        except Error as e:
-            print("There's an issue with the removePostByIDFromDB. Probably a tuple thing.")
-            print(e)
-            print("\n")
-
-    cursor.execute(messagesQuery, filter)
-    messageIDList = cursor.fetchall()
-    connection.commit()
+    try:
+        # The IDs are only needed so caches can evict them
+        cursor.execute(f"SELECT PostID FROM {TABLE_NAME} WHERE PostTime < ?;", postFilter)
+        postIDList = [postIDTuple[0] for postIDTuple in cursor.fetchall()]
+
+        cursor.execute(f"DELETE FROM {VOTES_TABLE_NAME} WHERE PostID IN "
+                       f"(SELECT PostID FROM {TABLE_NAME} WHERE PostTime < ?);", postFilter)
+        cursor.execute(f"DELETE FROM {TABLE_NAME} WHERE PostTime < ?;", postFilter)
+        cursor.execute(f"DELETE FROM {MESSAGE_TABLE_NAME} WHERE MessageTime < ?;", messageFilter)
+        removedMessages = cursor.rowcount
+
+        # Give free pages back once there are enough of them to be worth it, in the same transaction as the deletes so
+        # the writer's batch and a direct call free them the same way. sqlite3 steps a statement that returns no rows
+        # only once (fetchall doesn't step it further) and each step of the pragma frees one page, so it is executed
+        # once per free page. Closing its cursor resets the last step, which would otherwise keep the commit from going
+        # through.
+        cursor.execute("PRAGMA freelist_count;")
+        freePages = cursor.fetchall()[0][0]
+        if freePages > INCREMENTAL_VACUUM_PAGES:
+            vacuumCursor = connection.cursor()
+            for page in range(freePages):
+                vacuumCursor.execute("PRAGMA incremental_vacuum;")
+            vacuumCursor.close()
+        commit(connection)
+    except Error as e:
+        if getattr(threadState, "batching", False):
+            raise
+        connection.rollback()
+        logger.error("Unable to remove expired posts and messages from the database")
+        logger.error(e)
+        return
 
-    for messageID in messageIDList:
-        try:
-            removeMessageByIDFromDB(connection, "".join(messageID))
-        except Error as e:
-            print("There's an issue with the removePostByIDFromDB. Probably a tuple thing.")
-            print(e)
-            print("\n")
+    notifyRemoval(postIDList)
+    if (len(postIDList) > 0) or (removedMessages > 0):
+        logger.info("Removed %s expired posts and %s expired messages from the database", len(postIDList),
+                    removedMessages)
 
 
 def fetchAllMessagesFromDB(connection: sqlite3.Connection):
     if connection is None:
         return
 
-    query = f"SELECT MessageID, Subject, Body, Sender, IsUserMessage, MessageTime FROM {MESSAGE_TABLE_NAME}"
+    query = f"SELECT MessageID, Subject, Body, Sender, IsUserMessage, MessageTime, Subreddit FROM {MESSAGE_TABLE_NAME}"
     cursor = connection.cursor()
     cursor.execute(query)
     messageTuples = cursor.fetchall()
-    connection.commit()
 
     return messageTuples
 
@@ -367,55 +679,34 @@ def incrementReviewState(connection: sqlite3.Connection, submissionID: str):
     if (connection is None) or (submissionID == "") or (submissionID is None):
         return
 
+    # A single statement so two threads can't both read the old ReviewState
+    query = f"UPDATE {TABLE_NAME} SET ReviewState = ReviewState + 1 WHERE PostID = ?"
     cursor = connection.cursor()
-
-    # Get current ReviewState
-    query = f"SELECT ReviewState FROM {TABLE_NAME} WHERE PostID = ?;"
-    cursor.execute(query, (submissionID, ))
-    reviewState = cursor.fetchall()[0][0] + 1
-    connection.commit()
-
-    # Update the ReviewState
-    query = f"UPDATE {TABLE_NAME} SET ReviewState = ? WHERE PostID = ?"
-    cursor.execute(query, (reviewState, submissionID))
-    connection.commit()
+    cursor.execute(query, (submissionID,))
+    commit(connection)
 
 
-# TODO This currently only does a second review on posts that it missed. Make it more better.
-def fetchUnreviewedPostsFromDB(connection: sqlite3.Connection):
+# Returns [(PostID, VotingTime), ...] for every post, earliest deadline first
+def fetchVotingDeadlinesFromDB(connection: sqlite3.Connection) -> list:
     if connection is None:
-        return
+        return []
 
-    reviewState = (0,)
-    query = f"SELECT PostID FROM {TABLE_NAME} WHERE ReviewState = ?;"
+    query = f"SELECT PostID, VotingTime FROM {TABLE_NAME} ORDER BY VotingTime;"
     cursor = connection.cursor()
-    cursor.execute(query, reviewState)
-    postIDTupleList = cursor.fetchall()
-    connection.commit()
-
-    postIDList = []
-    for postIDTuple in postIDTupleList:
-        postIDList.append("".join(postIDTuple))
-
-    return postIDList
+    cursor.execute(query)
+    return cursor.fetchall()
 
 
-def fetchPostsNeedingVotingFromDB(connection: sqlite3.Connection):
+# PostIDs of posts the bot has replied to and that are still open for voting
+def fetchPostIDsOpenForVotingFromDB(connection: sqlite3.Connection) -> list:
     if connection is None:
-        return
+        return []
 
-    currentUNIXTime = (time.time(),)
-    query = f"SELECT PostID FROM {TABLE_NAME} WHERE VotingTime < ?;"
+    query = f"SELECT PostID FROM {TABLE_NAME} WHERE VotingTime > ? AND ReplyID IS NOT NULL AND ReplyID != '';"
     cursor = connection.cursor()
-    cursor.execute(query, currentUNIXTime)
-    postIDTupleList = cursor.fetchall()
-    connection.commit()
+    cursor.execute(query, (clock.time(),))
 
-    postIDList = []
-    for postIDTuple in postIDTupleList:
-        postIDList.append("".join(postIDTuple))
-
-    return postIDList
+    return [postIDTuple[0] for postIDTuple in cursor.fetchall()]
 
 
 def fetchCommentIDFromDB(connection: sqlite3.Connection, submission: praw.models.Submission):
@@ -427,7 +718,6 @@ def fetchCommentIDFromDB(connection: sqlite3.Connection, submission: praw.models
     cursor = connection.cursor()
     cursor.execute(query, postId)
     commentIDTupleList = cursor.fetchall()
-    connection.commit()
     try:
         if commentIDTupleList[0][0] is None:
             return ""
@@ -444,18 +734,168 @@ def fetchCommentIDFromDB(connection: sqlite3.Connection, submission: praw.models
         return ""
 
 
-def fetchAllPostIDsFromDB(connection: sqlite3.Connection):
+def isPostInDB(connection: sqlite3.Connection, submissionID: str) -> bool:
+    if (connection is None) or (submissionID is None) or (submissionID == ""):
+        return False
+
+    query = f"SELECT 1 FROM {TABLE_NAME} WHERE PostID = ?;"
+    cursor = connection.cursor()
+    cursor.execute(query, (submissionID,))
+    return cursor.fetchone() is not None
+
+
+def fetchReviewState(connection: sqlite3.Connection, submissionID: str):
+    if (connection is None) or (submissionID is None) or (submissionID == ""):
+        return None
+
+    query = f"SELECT ReviewState FROM {TABLE_NAME} WHERE PostID = ?;"
+    cursor = connection.cursor()
+    cursor.execute(query, (submissionID,))
+    row = cursor.fetchone()
+    return None if row is None else row[0]
+
+
+# PostIDs and IsVoteable of posts that are still open for voting
+def fetchVotingEligibilityFromDB(connection: sqlite3.Connection) -> list:
+    if connection is None:
+        return []
+
+    query = f"SELECT PostID, IsVoteable FROM {TABLE_NAME} WHERE VotingTime > ?;"
+    cursor = connection.cursor()
+    cursor.execute(query, (clock.time(),))
+    return cursor.fetchall()
+
+
+# Queues a job unless the same stage is already queued for the post
+def insertJobIntoDB(connection: sqlite3.Connection, jobType: str, postID: str, dueTime: float, reviewState):
+    if (connection is None) or (postID is None) or (postID == ""):
+        return
+
+    query = f"INSERT OR IGNORE INTO {JOB_TABLE_NAME} (JobType, PostID, DueTime, ReviewState) VALUES (?,?,?,?);"
+    cursor = connection.cursor()
+    cursor.execute(query, (jobType, postID, dueTime, reviewState))
+    commit(connection)
+
+
+# Leases up to limit due jobs that nobody holds (or whose lease ran out) to owner until leaseExpiry and returns them as
+# [(JobType, PostID, ReviewState, Attempts), ...] with Attempts counting this claim. Finding and leasing the jobs has to
+# happen in one write transaction, which the DBWriter's BEGIN IMMEDIATE gives, so two processes never claim the same
+# job.
+def claimJobs(connection: sqlite3.Connection, owner: str, now: float, leaseExpiry: float, limit: int) -> list:
+    if connection is None:
+        return []
+
+    query = f"SELECT JobType, PostID, ReviewState, Attempts FROM {JOB_TABLE_NAME} WHERE DueTime <= ? AND " \
+            f"(LeaseExpiry IS NULL OR LeaseExpiry <= ?) ORDER BY DueTime LIMIT ?;"
+    leaseQuery = f"UPDATE {JOB_TABLE_NAME} SET LeaseOwner = ?, LeaseExpiry = ?, Attempts = Attempts + 1 " \
+                 f"WHERE JobType = ? AND PostID = ?;"
+    cursor = connection.cursor()
+    cursor.execute(query, (now, now, limit))
+    jobs = [(jobType, postID, reviewState, attempts + 1)
+            for jobType, postID, reviewState, attempts in cursor.fetchall()]
+    cursor.executemany(leaseQuery, [(owner, leaseExpiry, jobType, postID) for jobType, postID, _, _ in jobs])
+    commit(connection)
+    return jobs
+
+
+# Extends every lease owner holds
+def renewJobLeases(connection: sqlite3.Connection, owner: str, leaseExpiry: float):
+    if connection is None:
+        return
+
+    query = f"UPDATE {JOB_TABLE_NAME} SET LeaseExpiry = ? WHERE LeaseOwner = ?;"
+    cursor = connection.cursor()
+    cursor.execute(query, (leaseExpiry, owner))
+    commit(connection)
+
+
+# Deletes a finished job. Only the worker holding the lease can, so a worker whose lease ran out and was claimed by
+# another can't finish the job under it. Returns True if the job was deleted.
+def completeJob(connection: sqlite3.Connection, jobType: str, postID: str, owner: str) -> bool:
+    if connection is None:
+        return False
+
+    query = f"DELETE FROM {JOB_TABLE_NAME} WHERE JobType = ? AND PostID = ? AND LeaseOwner = ?;"
+    cursor = connection.cursor()
+    cursor.execute(query, (jobType, postID, owner))
+    commit(connection)
+    return cursor.rowcount == 1
+
+
+# Gives a failed job back to be claimed again from dueTime
+def releaseJob(connection: sqlite3.Connection, jobType: str, postID: str, owner: str, dueTime: float):
     if connection is None:
         return
 
-    query = f"SELECT PostID FROM {TABLE_NAME};"
+    query = f"UPDATE {JOB_TABLE_NAME} SET LeaseOwner = NULL, LeaseExpiry = NULL, DueTime = ? " \
+            f"WHERE JobType = ? AND PostID = ? AND LeaseOwner = ?;"
+    cursor = connection.cursor()
+    cursor.execute(query, (dueTime, jobType, postID, owner))
+    commit(connection)
+
+
+# Earliest DueTime of a job nobody holds, None if there isn't one
+def fetchNextJobDueTime(connection: sqlite3.Connection):
+    if connection is None:
+        return None
+
+    query = f"SELECT MIN(DueTime) FROM {JOB_TABLE_NAME} WHERE LeaseOwner IS NULL;"
     cursor = connection.cursor()
     cursor.execute(query)
-    postIDTupleList = cursor.fetchall()
-    connection.commit()
+    return cursor.fetchall()[0][0]
+
 
-    postIDList = []
-    for postIDTuple in postIDTupleList:
-        postIDList.append("".join(postIDTuple))
+def countJobs(connection: sqlite3.Connection) -> int:
+    if connection is None:
+        return 0
+
+    query = f"SELECT COUNT(*) FROM {JOB_TABLE_NAME};"
+    cursor = connection.cursor()
+    cursor.execute(query)
+    return cursor.fetchall()[0][0]
+
+
+# Moves the checkpoint of stream to the item fullname posted at createdUTC
+def saveCheckpoint(connection: sqlite3.Connection, stream: str, fullname: str, createdUTC: float, updatedTime: float):
+    if connection is None:
+        return
+
+    query = f"INSERT OR REPLACE INTO {CHECKPOINT_TABLE_NAME} (Stream, Fullname, CreatedUTC, UpdatedTime) " \
+            f"VALUES (?,?,?,?);"
+    cursor = connection.cursor()
+    cursor.execute(query, (stream, fullname, createdUTC, updatedTime))
+    commit(connection)
+
+
+# Returns [(Stream, Fullname, CreatedUTC), ...]
+def fetchCheckpointsFromDB(connection: sqlite3.Connection) -> list:
+    if connection is None:
+        return []
 
-    return postIDList
+    query = f"SELECT Stream, Fullname, CreatedUTC FROM {CHECKPOINT_TABLE_NAME};"
+    cursor = connection.cursor()
+    cursor.execute(query)
+    return cursor.fetchall()
+
+
+# Stores rows of (Fullname, SeenTime) and forgets the IDs seen before expiryTime
+def saveSeenItems(connection: sqlite3.Connection, rows: list, expiryTime: float):
+    if connection is None:
+        return
+
+    cursor = connection.cursor()
+    cursor.executemany(f"INSERT OR REPLACE INTO {SEEN_TABLE_NAME} (Fullname, SeenTime) VALUES (?,?);", rows)
+    cursor.execute(f"DELETE FROM {SEEN_TABLE_NAME} WHERE SeenTime < ?;", (expiryTime,))
+    commit(connection)
+
+
+# Returns the newest limit [(Fullname, SeenTime), ...] seen from expiryTime, oldest first
+def fetchSeenItems(connection: sqlite3.Connection, expiryTime: float, limit: int) -> list:
+    if connection is None:
+        return []
+
+    query = f"SELECT Fullname, SeenTime FROM (SELECT Fullname, SeenTime FROM {SEEN_TABLE_NAME} WHERE SeenTime >= ? " \
+            f"ORDER BY SeenTime DESC LIMIT ?) ORDER BY SeenTime;"
+    cursor = connection.cursor()
+    cursor.execute(query, (expiryTime, limit))
+    return cursor.fetchall()
@@ -0,0 +1,62 @@
+import collections
+import threading
+
+import clock
+import sql
+
+# Expired entries are purged after this many misses
+PURGE_EVERY = 1000
+
+
+# Caches submission metadata fetched from Reddit (flair, duplicates, score, ...) by post ID and field. Each field has
+# its own time to live. Review passes invalidate a submission when they start so every pass sees fresh data but
+# refreshes each field at most once. Hit and miss counts are kept per field to help tune the TTLs.
+class SubmissionCache:
+    # ttls: {"field": seconds, ...}
+    def __init__(self, ttls: dict):
+        self.ttls = ttls
+        self.entries = {}  # (submissionID, field) -> (value, fetchTime)
+        self.lock = threading.Lock()
+        self.hits = collections.Counter()
+        self.misses = collections.Counter()
+        sql.removalListeners.append(self.forget)
+
+    # Returns the cached value of field for submissionID or calls fetch() to refresh it
+    def get(self, submissionID: str, field: str, fetch):
+        key = (submissionID, field)
+        with self.lock:
+            entry = self.entries.get(key)
+            if (entry is not None) and (entry[1] + self.ttls[field] > clock.time()):
+                self.hits[field] += 1
+                return entry[0]
+            self.misses[field] += 1
+            purge = sum(self.misses.values()) % PURGE_EVERY == 0
+
+        # Fetch outside the lock so a slow API call doesn't hold up lookups for other submissions
+        value = fetch()
+        with self.lock:
+            self.entries[key] = (value, clock.time())
+        if purge:
+            self.purgeExpired()
+        return value
+
+    # Drops field (or every field when None) for submissionID so the next get refreshes it
+    def invalidate(self, submissionID: str, field: str = None):
+        with self.lock:
+            fields = self.ttls.keys() if field is None else [field]
+            for name in fields:
+                self.entries.pop((submissionID, name), None)
+
+    def forget(self, submissionIDList: list):
+        for submissionID in submissionIDList:
+            self.invalidate(submissionID)
+
+    def purgeExpired(self):
+        now = clock.time()
+        with self.lock:
+            for key in [key for key, (value, fetchTime) in self.entries.items() if fetchTime + self.ttls[key[1]] <= now]:
+                del self.entries[key]
+
+    def stats(self) -> str:
+        with self.lock:
+            return ", ".join(f"{field} {self.hits[field]} hits / {self.misses[field]} misses" for field in self.ttls)
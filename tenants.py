@@ -0,0 +1,49 @@
+# Rules and texts for one subreddit the bot serves. One process serves every configured subreddit through shared
+# streams over a combined listing ("a+b+c") and routes each submission, comment and voting closure to its tenant.
+class Tenant:
+    def __init__(self, subreddit: str, standardReply: str, doubleDippingReply: str, votingText: str,
+                 votingClosedText: str, noReplyFlairTexts: list, noReplyTitleTexts: list, noVoteFlairTexts: list,
+                 noVoteTitleTexts: list, votingDictionary: dict):
+        self.subreddit = subreddit
+        self.standardReply = standardReply
+        self.doubleDippingReply = doubleDippingReply
+        self.votingText = votingText
+        self.votingClosedText = votingClosedText
+        self.noReplyFlairTexts = noReplyFlairTexts
+        self.noReplyTitleTexts = noReplyTitleTexts
+        self.noVoteFlairTexts = noVoteFlairTexts
+        self.noVoteTitleTexts = noVoteTitleTexts
+        self.votingDictionary = votingDictionary
+        self.votingCommands = list(votingDictionary.keys())
+        self.votingOptions = list(votingDictionary.values())
+
+        # The first option is the vote to keep a post and the second the vote to remove it
+        self.keepOption = self.votingOptions[0]
+        self.removeOption = self.votingOptions[1]
+
+
+# The tenants of one process keyed by lower case subreddit name. The first tenant is home: messages sent to the bot
+# account can't be tied to a subreddit so they are forwarded to its modmail.
+class Tenants:
+    def __init__(self, tenantList: list):
+        self.home = tenantList[0]
+        self.tenants = {tenant.subreddit.lower(): tenant for tenant in tenantList}
+
+    # The listing that streams every tenant's submissions and comments at once
+    def combinedName(self) -> str:
+        return "+".join(tenant.subreddit for tenant in self.tenants.values())
+
+    def forName(self, subredditName: str):
+        if subredditName is None:
+            return None
+        return self.tenants.get(subredditName.lower())
+
+    # Tenant of a submission or comment. Reading display_name doesn't need a request. None for other subreddits
+    def forThing(self, thing):
+        return self.forName(thing.subreddit.display_name)
+
+    def __iter__(self):
+        return iter(self.tenants.values())
+
+    def __len__(self) -> int:
+        return len(self.tenants)